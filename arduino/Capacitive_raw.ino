@@ -0,0 +1,44 @@
+#include <CapacitiveSensor.h>
+
+/*
+ * Raw sample streaming for host-side touch detection
+ *
+ * Instead of thresholding and debouncing on the board, send the raw
+ * capacitiveSensor() value of every button as one line per measurement,
+ * tab separated, and let artemis_ui_control.py --serial <port> --touch
+ * detect the presses (adaptive baseline and hysteresis, see capsense.py).
+ * There is no delay in the loop, so a press is seen within one or two
+ * measurements.
+ *
+ * Uses a high value resistor e.g. 10 megohm between send pin and each
+ * receive pin; the receive pins are the sensor pins.
+ */
+
+
+CapacitiveSensor sensors[] = {
+  CapacitiveSensor(9,8),        // button 0: pin 8 is sensor pin
+  CapacitiveSensor(9,10),       // button 1: pin 10 is sensor pin
+};
+const byte numSensors = sizeof(sensors) / sizeof(sensors[0]);
+
+
+void setup()
+{
+   for (byte i = 0; i < numSensors; i++)
+   {
+     sensors[i].set_CS_AutocaL_Millis(0xFFFFFFFF);   // the host tracks the baseline
+     sensors[i].set_CS_Timeout_Millis(20);           // timeouts are sent as -2
+   }
+   Serial.begin(38400);           // default --baud of artemis_ui_control.py
+}
+
+void loop()
+{
+    for (byte i = 0; i < numSensors; i++)
+    {
+      if (i > 0)
+        Serial.print('\t');
+      Serial.print(sensors[i].capacitiveSensor(10));
+    }
+    Serial.println();
+}
@@ -4,412 +4,552 @@ import sys
 import optparse
 import time
 import socket
-import select
-import serial
+import selectors
+import threading
+import collections
+import functools
+import atexit
 
-#import PIL.ImageGrab
-import ctypes
-import win32api
-import win32con
-import win32gui
+from wininput import InputMacro, DryRunStuff, VK_ESCAPE
+from latency import LatencyStats
+from dispatcher import CommandEvent, CommandDispatcher
+import logwriter as log
 
-VERBOSE = 1
-
-
-class WinMouseInput(ctypes.Structure):
-    _fields_ = [        
-        ('dx',          ctypes.c_int),
-        ('dy',          ctypes.c_int),
-        ('mouseData',   ctypes.c_uint),
-        ('dwFlags',     ctypes.c_uint),
-        ('time',        ctypes.c_uint),
-        ('dwExtraInfo', ctypes.c_void_p) ]
-
-class WinKeybdInput(ctypes.Structure): 
-    _fields_ = [
-        ('wVk',         ctypes.c_ushort),
-        ('wScan',       ctypes.c_ushort),
-        ('dwFlags',     ctypes.c_uint),
-        ('time',        ctypes.c_uint),
-        ('dwExtraInfo', ctypes.c_void_p) ]
-
-class WinHardwareInput(ctypes.Structure):    
-    _fields_ = [
-        ('uMsg',        ctypes.c_uint),
-        ('wParamL',     ctypes.c_ushort),
-        ('wParamH',     ctypes.c_ushort) ]
-
-class WinInput(ctypes.Structure):
-
-    class __InputUnion(ctypes.Union):
-        _fields_ = [
-            ('mi',      WinMouseInput),
-            ('ki',      WinKeybdInput),
-            ('hi',      WinHardwareInput) ]
-
-    _fields_ = [
-        ('type',        ctypes.c_uint),
-        ('u',           __InputUnion) ]
-
-class WinKbdLLHookStruct(ctypes.Structure):
-    _fields_ = [
-        ('keycode', ctypes.c_uint),
-        ('scancode', ctypes.c_uint),
-        ('flags', ctypes.c_uint),
-        ('time', ctypes.c_uint),
-        ('info', ctypes.POINTER(ctypes.c_ulong)) ]
-
-
-class WinError(Exception):
-    pass
-
-
-class WinStuff:
-    """Dirty Win32 tricks to control the game."""
-
-    BUTTON_LEFT = 0
-    BUTTON_RIGHT = 1
-    BUTTON_MIDDLE = 2
-
-    __wGetLastError     = ctypes.windll.kernel32.GetLastError
-    __wFormatMessage    = ctypes.windll.kernel32.FormatMessageW
-    __wGetDC            = ctypes.windll.user32.GetDC
-    __wReleaseDC        = ctypes.windll.user32.ReleaseDC
-    __wGetSystemMetrics = ctypes.windll.user32.GetSystemMetrics
-    __wSendInput        = ctypes.windll.user32.SendInput
-    __wGetPixel         = ctypes.windll.gdi32.GetPixel
-
-    def __init__(self, eventDelay=0.01):
-        """Create required system handles."""
-
-        self.eventDelay = eventDelay
-
-        if VERBOSE: print("creating device context")
-        self.hdc = self.__wGetDC(None)
-        if not self.hdc:
-            raise WinError("Can not get Device Context for display (%s)" %
-                           self.getLastErrorStr())
-
-#        setdpiaware = getattr(ctypes.windll.shcore, 'SetProcessDpiAwareness',
-#                              None)
-#        if setdpiaware is not None:
-#            setdpiaware(1)
-
-    def __del__(self):
-
-        if self.hdc:
-            self.__wReleaseDC(None, self.hdc)
-            self.hdc = 0
-
-    def close(self):
-        """Release system handles."""
-
-        assert self.hdc
-        self.__wReleaseDC(None, self.hdc)
-        self.hdc = 0
-
-    def getScreenSize(self):
-        """Return screen size as a tuple (xpixels, ypixels)."""
-
-        xsize = self.__wGetSystemMetrics(win32con.SM_CXSCREEN)
-        ysize = self.__wGetSystemMetrics(win32con.SM_CYSCREEN)
-        return (xsize, ysize)
-
-    def getPixel(self, xpos, ypos):
-        """Return color of specified pixel as
-        (R,G,B) tuple in range 0 .. 255."""
-
-        assert self.hdc
-        rgb = self.__wGetPixel(self.hdc, xpos, ypos)
-        return (rgb & 0xff, (rgb >> 8) & 0xff, (rgb >> 16) & 0xff)
-
-    def moveMouse(self, xpos, ypos):
-        """Move the mouse cursor to the specified absolute mouse coordinates.
-        
-        Coordinate range is 0 .. 65535, where (0,0) is the upper left corner
-        and (65535,65535) is the lower right corner of the screen.
-        """
-
-        inp = WinInput()
-        inp.type = win32con.INPUT_MOUSE
-        inp.u.mi.dx = xpos
-        inp.u.mi.dy = ypos
-        inp.u.mi.mouseData = 0
-        inp.u.mi.dwFlags = win32con.MOUSE_MOVED | win32con.MOUSEEVENTF_ABSOLUTE
-        inp.u.mi.time = 0
-        inp.u.mi.dwExtraInfo = None
-
-        nInputs = 1
-        pInputs = ctypes.byref(inp)
-        cbSize = ctypes.sizeof(inp)
-        ret = self.__wSendInput(nInputs, pInputs, cbSize)
-
-        if ret != 1:
-            raise WinError("Can not send mouse move input event (%s)" %
-                           self.getLastErrorStr())
-
-    def mouseButton(self, button, state):
-        """Press or release a mouse button.
-
-        button = 0 for left button, 1 for right button, 2 for middle button.
-        state = 1 for press, 0 for release.
-        """
-
-        assert button in (0, 1, 2)
-        if button == 0:
-            ev = ( win32con.MOUSEEVENTF_LEFTDOWN if state
-                   else win32con.MOUSEEVENTF_LEFTUP )
-        elif button == 1:
-            ev = ( win32con.MOUSEEVENTF_RIGHTDOWN if state
-                   else win32con.MOUSEEVENTF_RIGHTUP )
-        elif button == 2:
-            ev = ( win32con.MOUSEEVENTF_MIDDLEDOWN if state
-                   else win32con.MOUSEEVENTF_MIDDLEUP )
-
-        inp = WinInput()
-        inp.type = win32con.INPUT_MOUSE
-        inp.u.mi.dx = 0
-        inp.u.mi.dy = 0
-        inp.u.mi.mouseData = 0
-        inp.u.mi.dwFlags = ev
-        inp.u.mi.time = 0
-        inp.u.mi.dwExtraInfo = None
-
-        nInputs = 1
-        pInputs = ctypes.byref(inp)
-        cbSize = ctypes.sizeof(inp)
-        ret = self.__wSendInput(nInputs, pInputs, cbSize)
-
-        if ret != 1:
-            raise WinError("Can not send mouse click input event (%s)" %
-                           self.getLastErrorStr())
-
-    def mouseClick(self, xpos, ypos, button):
-        """Optionally move the mouse, then click the specified button."""
-
-        time.sleep(self.eventDelay)
-        self.moveMouse(xpos, ypos)
-        time.sleep(self.eventDelay)
-        self.mouseButton(button, 1)
-        time.sleep(self.eventDelay)
-        self.mouseButton(button, 0)
-
-    def keyEvent(self, key, state):
-        """Press or release the specified key."""
-
-        inp = WinInput()
-        inp.type = win32con.INPUT_KEYBOARD
-        if isinstance(key, str):
-            inp.u.ki.wVk = ord(key)
-        elif isinstance(key, bytes):
-            (inp.u.ki.wVk,) = key
-        else:
-            inp.u.ki.wVk = key
-        inp.u.ki.wScan = 0
-        inp.u.ki.dwFlags = 0 if state else win32con.KEYEVENTF_KEYUP
-        inp.u.ki.time = 0
-        inp.u.ki.dwExtraInfo = None
-
-        nInputs = 1
-        pInputs = ctypes.byref(inp)
-        cbSize = ctypes.sizeof(inp)
-        ret = self.__wSendInput(nInputs, pInputs, cbSize)
-
-        if ret != 1:
-            raise WinError("Can not send keyboard input event (%s)" %
-                           self.getLastErrorStr())
-
-    def keyType(self, key):
-        """Type the specified key.
-
-        key = '0' .. '9' or 'A' .. 'Z' or win32con.VK_xxx constant
-        """
-
-        time.sleep(self.eventDelay)
-        self.keyEvent(key, 1)
-        time.sleep(self.eventDelay)
-        self.keyEvent(key, 0)
-
-    def getLastErrorStr(self):
-        """Return error message for last error."""
-
-        buffer = ctypes.create_unicode_buffer(128)
+# Front-ends, the Win32 layer and screen capture are imported in main()
+# only when selected, so startup stays fast and the module can be
+# imported on any platform.
 
-        dwMessageId = self.__wGetLastError()
-
-        dwFlags = win32con.FORMAT_MESSAGE_FROM_SYSTEM
-        lpSource = None
-        dwLanguageId = 0
-        lpBuffer = ctypes.byref(buffer)
-        nSize = 128
-        Arguments = None
-
-        self.__wFormatMessage(dwFlags, lpSource, dwMessageId, dwLanguageId,
-                              lpBuffer, nSize, Arguments)
-
-        return buffer.value.rstrip()
-
-
-class DisplayDevice(ctypes.Structure):
-    _fields_ = [
-        ('cb',           ctypes.c_uint),
-        ('DeviceName',   ctypes.c_wchar * 32),
-        ('DeviceString', ctypes.c_wchar * 128),
-        ('StateFlags',   ctypes.c_uint),
-        ('DeviceID',     ctypes.c_wchar * 128),
-        ('DeviceKey',    ctypes.c_wchar * 128) ]
-
-
-def enumDisplayDevices():
-    """Return the full list of display devices in the system as
-    a list of DisplayDevice objects."""
-
-    devs = [ ]
-        
-    i = 0
-    while True:
+VERBOSE = 1
 
-        displayDevice = DisplayDevice()
-        displayDevice.cb = ctypes.sizeof(displayDevice)
-        lpDevice = None
-        iDevNum = i
-        lpDisplayDevice = ctypes.byref(displayDevice)
-        dwFlags = 0
 
-        ret = ctypes.windll.user32.EnumDisplayDevicesW(lpDevice,
-                                                       iDevNum,
-                                                       lpDisplayDevice,
-                                                       dwFlags)
+Command = collections.namedtuple('Command',
+                                 ('name', 'prepare', 'action', 'immediate'))
 
-        if not ret:
-            break
 
-        devs.append(displayDevice)
-        i += 1
+class CommandRegistry:
+    """Commands accepted by all control front-ends.
 
-    return devs
+    Each command name maps to an action plan: a list of steps built once
+    at startup. A step is either an InputMacro, played through the macro
+    runner, or a function called without arguments. The steps are bound
+    into a single action function when the command is registered.
 
+    A command may also have a prepare function. Front-ends call it as soon
+    as the command arrives, before the action is queued or executed.
+    It must not block.
 
-def isDesktopPrimaryDisplay(displayDevice):
-    """Return True if the specified DisplayDevices is aDISPLAY_DEVICE_ATTACHED_TO_DESKTOPttached
-    to the primary desktop."""
+    Immediate commands (such as queries) are executed by the front-end
+    without queueing them for the dispatcher. Their action must not block
+    and returns the response text as bytes.
+    """
 
-    return (displayDevice.StateFlags & win32con.DISPLAY_DEVICE_PRIMARY_DEVICE) != 0
+    def __init__(self, runner=None):
+        self.runner = runner
+        self.commands = { }
 
+    def makeAction(self, steps):
+        """Bind a list of steps into one action function."""
 
-def createDeviceContext(deviceName):
-    """Create device context for the specified display device
-    and return the device handle, or return None in case of failure."""
-
-    lpszDriver = "DISPLAY"
-    lpszDevice = str(deviceName)
-    lpszOutput = None
-    lpInitData = None
-    
-    ret = ctypes.windll.gdi32.CreateDeviceW(lpszDriver,
-                                            lpszDevice,
-                                            lpszOutput,
-                                            lpInitData)
-
-    return ret
+        funcs = [ ]
+        for step in steps:
+            if isinstance(step, InputMacro):
+                assert self.runner is not None
+                step.compile()
+                funcs.append(functools.partial(self.runner.run, step))
+            else:
+                funcs.append(step)
+
+        if len(funcs) == 1:
+            return funcs[0]
+
+        def action():
+            for func in funcs:
+                func()
+        return action
+
+    def register(self, name, steps, prepare=None, immediate=False):
+        """Register a command. Names are bytes, matched case-insensitively."""
+
+        name = name.lower()
+        self.commands[name] = Command(name, prepare, self.makeAction(steps),
+                                      immediate)
+
+    def lookup(self, name):
+        """Return the Command for a name, or None if unknown."""
+
+        return self.commands.get(name.lower())
+
+
+class PauseState:
+    """Track the paused state of the game and coalesce pause requests.
+
+    The pause button in the game toggles between paused and running.
+    Requests only set the desired state when they arrive; sync() then
+    runs the toggle plan while the game state differs from the desired
+    state. A burst of requests that arrives while the toggle runs is thus
+    reduced to its net effect, and requests for the current state are
+    dropped.
+
+    Each request is counted once: as idempotent if it asked for the
+    state already requested, otherwise as requested; sync() counts the
+    requests that did not need a toggle of their own as coalesced.
+    """
+
+    def __init__(self, toggle, paused=False):
+        self.toggle = toggle
+        self.lock = threading.Lock()
+        self.paused = paused        # state of the game
+        self.desired = paused       # state requested by the latest command
+        self.pending = 0            # requests not yet seen by sync()
+        self.counters = collections.Counter()
+
+    def request(self, paused):
+        with self.lock:
+            if paused == self.desired:
+                self.counters['idempotent'] += 1
+                self.log(log.DEBUG, 'dropped request, already %s',
+                         'paused' if paused else 'running')
+            else:
+                self.counters['requested'] += 1
+                self.pending += 1
+                self.desired = paused
+
+    def requestPause(self):
+        self.request(True)
+
+    def requestStart(self):
+        self.request(False)
+
+    def requestToggle(self):
+        with self.lock:
+            self.counters['requested'] += 1
+            self.pending += 1
+            self.desired = not self.desired
+
+    def sync(self):
+        """Run the toggle plan until the game is in the desired state."""
+
+        nrequests = 0
+        ntoggles = 0
+        while True:
+            with self.lock:
+                nrequests += self.pending
+                self.pending = 0
+                if self.paused == self.desired:
+                    # Requests without a toggle of their own.
+                    self.counters['coalesced'] += nrequests - ntoggles
+                    if not ntoggles:
+                        self.log(log.DEBUG, 'nothing to do, %d requests '
+                                 'cancelled out', nrequests)
+                    return
+            self.toggle()
+            with self.lock:
+                self.paused = not self.paused
+                self.counters['executed'] += 1
+                ntoggles += 1
+                self.log(log.INFO, 'game now %s',
+                         'paused' if self.paused else 'running')
+
+    def log(self, level, msg, *args):
+        c = self.counters
+        log.log(level, "Pause state: " + msg +
+                " (executed=%d idempotent=%d coalesced=%d)",
+                *args, c['executed'], c['idempotent'], c['coalesced'])
+
+
+class TcpClient:
+    """State of one TCP control connection."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.rxbuf = b''
+        self.txbuf = bytearray()
+        self.closed = False
+        self.npending = 0           # commands queued, not yet answered
+        self.nqueued = 0            # commands queued in total
+        # Immediate commands and Busy responses (command None) due while
+        # commands were pending, as (nqueued at arrival, reqid, command);
+        # answered in order.
+        self.deferred = collections.deque()
+
+
+class TcpCommand(CommandEvent):
+    """Command received from a TCP client, queued for execution."""
+
+    def __init__(self, client, reqid, cmd, action, tarrival, done=None):
+        CommandEvent.__init__(self, 'tcp', cmd, action, tarrival, done)
+        self.client = client
+        self.reqid = reqid
 
 
 class TcpServer:
-    
-    def __init__(self, port, handler):
+    """Non-blocking TCP server for control messages.
+
+    All sockets stay in non-blocking mode. Responses are queued per client
+    and flushed when the socket becomes writable, so a slow client does
+    not stall the other clients.
+
+    Commands are executed one at a time by the dispatcher thread, so the
+    network loop stays responsive while the game is being controlled.
+    If no dispatcher (a CommandDispatcher) is given, the server starts
+    its own.
+    Clients may send several commands without waiting for the responses.
+    A command can be prefixed with a request ID as "#<id> <command>";
+    the response then has the form "#<id> <result> exec=<s> wait=<s>",
+    where exec is the execution time and wait the time spent queued.
+    Responses to a client are sent in the order of its commands, also
+    for immediate commands such as stats and for the Busy response to
+    commands beyond MAX_PENDING, which are sent once the commands
+    received before them are done.
+
+    stats (a LatencyStats) is only used by a dispatcher started by the
+    server; see CommandDispatcher.
+    """
+
+    # Drop clients that send longer lines or stop reading responses.
+    MAX_LINE_LEN = 4096
+    MAX_TXBUF_LEN = 65536
+
+    # Maximum number of queued commands per client, and of deferred
+    # responses; clients that exceed the latter are dropped.
+    MAX_PENDING = 64
+    MAX_DEFERRED = 1024
+
+    def __init__(self, port, commands, backlog=socket.SOMAXCONN, stats=None,
+                 dispatcher=None):
         self.port = port
-        self.handler = handler
+        self.commands = commands
+        self.ownDispatcher = dispatcher is None
+        if dispatcher is None:
+            dispatcher = CommandDispatcher(stats)
+        self.dispatcher = dispatcher
         self.srvsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.srvsock.bind(('', port))
-        self.srvsock.listen(1)
-        self.clients = []
-        self.rxbufs = { }
+        self.srvsock.listen(backlog)
+        self.srvsock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.srvsock, selectors.EVENT_READ, None)
+        self.clients = set()
         self.stop = False
+        # The dispatcher signals finished commands through a socket pair.
+        self.done = collections.deque()
+        (self.wakesock, self.wakesend) = socket.socketpair()
+        self.wakesock.setblocking(False)
+        self.wakesend.setblocking(False)
+        self.selector.register(self.wakesock, selectors.EVENT_READ, None)
 
     def run(self):
         while not self.stop:
             self.step()
 
-    def step(self):
-        rfds = [ self.srvsock ] + self.clients
-        (rfds, wfds, xfds) = select.select(rfds, [], [])
-        for sock in rfds:
-            if sock is self.srvsock:
-                conn, addr = sock.accept()
-                print("New client", conn)
-                self.clients.append(conn)
-                conn.sendall(b'Hello\n')
+    def step(self, timeout=None):
+        """Wait for socket events and handle them."""
+
+        for (key, events) in self.selector.select(timeout):
+            client = key.data
+            if key.fileobj is self.srvsock:
+                self.acceptClients()
+            elif key.fileobj is self.wakesock:
+                self.finishCommands()
+            else:
+                if events & selectors.EVENT_READ:
+                    self.readClient(client)
+                if (events & selectors.EVENT_WRITE) and not client.closed:
+                    self.flushClient(client)
+
+    def acceptClients(self):
+        """Accept all pending connections."""
+
+        while True:
+            try:
+                conn, addr = self.srvsock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                log.error("ERROR: accept failed %s", exc)
+                return
+            log.info("New client %s", addr)
+            conn.setblocking(False)
+            client = TcpClient(conn, addr)
+            self.clients.add(client)
+            self.selector.register(conn, selectors.EVENT_READ, client)
+            self.send(client, b'Hello\n')
+
+    def closeClient(self, client):
+        if not client.closed:
+            client.closed = True
+            self.selector.unregister(client.sock)
+            client.sock.close()
+            self.clients.discard(client)
+
+    def readClient(self, client):
+        try:
+            w = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            log.warning("Client %s error %s", client.addr, exc)
+            self.closeClient(client)
+            return
+        if not w:
+            log.info("Client %s closed connection", client.addr)
+            self.closeClient(client)
+            return
+        tarrival = time.monotonic()
+        cmds = (client.rxbuf + w).split(b'\n')
+        client.rxbuf = cmds.pop()
+        if len(client.rxbuf) > self.MAX_LINE_LEN:
+            log.warning("Client %s sent too long line, dropping",
+                        client.addr)
+            self.closeClient(client)
+            return
+        for cmd in cmds:
+            if client.closed:
+                break
+            self.handlecmd(client, cmd.strip(), tarrival)
+
+    def send(self, client, data):
+        """Queue data for sending to the client."""
+
+        if client.closed:
+            return
+        if not client.txbuf:
+            # Try to send immediately; queue what does not fit.
+            try:
+                n = client.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError as exc:
+                log.warning("Client %s error %s", client.addr, exc)
+                self.closeClient(client)
+                return
+            if n == len(data):
+                return
+            self.selector.modify(client.sock,
+                                 selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                 client)
+            data = data[n:]
+        client.txbuf += data
+        if len(client.txbuf) > self.MAX_TXBUF_LEN:
+            log.warning("Client %s not reading responses, dropping",
+                        client.addr)
+            self.closeClient(client)
+
+    def flushClient(self, client):
+        """Send queued data to a writable client."""
+
+        try:
+            n = client.sock.send(client.txbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            log.warning("Client %s error %s", client.addr, exc)
+            self.closeClient(client)
+            return
+        del client.txbuf[:n]
+        if not client.txbuf:
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def handlecmd(self, client, cmd, tarrival=None):
+        """Queue a command for execution by the dispatcher thread."""
+
+        if tarrival is None:
+            tarrival = time.monotonic()
+        log.debug("Got command %r from %s", cmd, client.addr)
+        reqid = None
+        if cmd.startswith(b'#'):
+            (reqid, _, cmd) = cmd.partition(b' ')
+            cmd = cmd.strip()
+        command = self.commands.lookup(cmd)
+        immediate = command is not None and command.immediate
+        if immediate or client.npending >= self.MAX_PENDING:
+            if not immediate:
+                command = None
+            if not client.npending:
+                self.answer(client, reqid, command)
+            elif len(client.deferred) < self.MAX_DEFERRED:
+                client.deferred.append((client.nqueued, reqid, command))
             else:
-                sock.setblocking(False)
-                w = sock.recv(4096)
-                sock.setblocking(True)
-                if w:
-                    if sock in self.rxbufs:
-                        w = self.rxbufs[sock] + w
-                    cmds = w.split(b'\n')
-                    self.rxbufs[sock] = cmds[-1]
-                    for cmd in cmds[:-1]:
-                        self.handlecmd(sock, cmd.strip())
-                else:
-                    print("Client", sock, "closed connection")
-                    sock.close()
-                    if sock in self.rxbufs:
-                        del self.rxbufs[sock]
-                    self.clients.remove(sock)
-
-    def handlecmd(self, sock, cmd):
-        print("Got command", repr(cmd), "from", sock)
-        if cmd.lower() == b'pause':
-            self.handler.pause()
-            sock.sendall(b'Ok\n')
+                log.warning("Client %s not reading responses, dropping",
+                            client.addr)
+                self.closeClient(client)
+            return
+        client.npending += 1
+        client.nqueued += 1
+        action = None
+        if command is not None:
+            if command.prepare is not None:
+                command.prepare()
+            action = command.action
+        self.dispatcher.submit(TcpCommand(client, reqid, cmd, action,
+                                          tarrival, self.commandDone))
+
+    def answer(self, client, reqid, command):
+        """Execute an immediate command and send its response,
+        or send Busy if command is None."""
+
+        if command is None:
+            (text, status) = (b'', b'Busy')
         else:
-            sock.sendall(b'Unknown_Cmd\n')
+            (text, status) = (command.action(), b'Ok')
+        if reqid is not None:
+            status = reqid + b' ' + status
+        self.send(client, text + status + b'\n')
+
+    def commandDone(self, job):
+        """Hand a finished command back to the network loop
+        (runs in dispatcher thread)."""
+
+        self.done.append(job)
+        try:
+            self.wakesend.send(b'x')
+        except (BlockingIOError, InterruptedError):
+            # Wakeup already pending.
+            pass
+
+    def finishCommands(self):
+        """Send responses for commands finished by the dispatcher."""
+
+        try:
+            while self.wakesock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self.done:
+            job = self.done.popleft()
+            client = job.client
+            client.npending -= 1
+            if job.reqid is None:
+                self.send(client, job.result + b'\n')
+            else:
+                self.send(client, b'%s %s exec=%.3f wait=%.3f\n' %
+                          (job.reqid, job.result,
+                           job.tdone - job.tstart,
+                           job.tstart - job.tqueued))
+            # Answer immediate commands that were waiting for this one.
+            nfinished = client.nqueued - client.npending
+            deferred = client.deferred
+            while deferred and deferred[0][0] <= nfinished:
+                (_, reqid, command) = deferred.popleft()
+                self.answer(client, reqid, command)
 
+    def close(self):
+        """Stop the server's own dispatcher and close all sockets."""
+
+        if self.ownDispatcher:
+            self.dispatcher.close()
+        for client in list(self.clients):
+            self.closeClient(client)
+        self.selector.close()
+        self.srvsock.close()
+        self.wakesock.close()
+        self.wakesend.close()
+
+
+class SerialResponses:
+    """Responses of the serial front-end, written in command order.
+
+    Queued commands are answered by the dispatcher thread once executed.
+    Immediate commands that arrive while commands are pending are
+    answered right after the commands received before them. Writes are
+    bounded by the write timeout of the SerialReader.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.npending = 0           # commands queued, not yet answered
+        self.nqueued = 0            # commands queued in total
+        self.deferred = collections.deque()     # (nqueued, command)
+
+    def queued(self):
+        """Count a command submitted to the dispatcher."""
+
+        with self.lock:
+            self.npending += 1
+            self.nqueued += 1
+
+    def done(self, event):
+        """Answer an executed command (runs in dispatcher thread)."""
+
+        with self.lock:
+            self.npending -= 1
+            self.reader.write(b'Ok\n')
+            nfinished = self.nqueued - self.npending
+            deferred = self.deferred
+            while deferred and deferred[0][0] <= nfinished:
+                self.answer(deferred.popleft()[1])
+
+    def immediate(self, command):
+        """Answer an immediate command, after the pending ones."""
+
+        with self.lock:
+            if self.npending:
+                self.deferred.append((self.nqueued, command))
+            else:
+                self.answer(command)
 
-class KeyboardHook:
+    def answer(self, command):
+        print(command.action().decode(), end='')
+        self.reader.write(b'Ok\n')
 
-    def __init__(self, handler):
 
-        self.handler = handler
-        functype = ctypes.WINFUNCTYPE(ctypes.wintypes.LPARAM,
-                                      ctypes.wintypes.INT,
-                                      ctypes.wintypes.WPARAM,
-                                      ctypes.wintypes.LPARAM)
-        self.pfunc = functype(self.keyboardProc)
-        self.handle = ctypes.windll.user32.SetWindowsHookExA(win32con.WH_KEYBOARD_LL, self.pfunc, win32api.GetModuleHandle(None), 0)
+def commandLoop(reader, commands, dispatcher=None, touch=None):
+    """Command loop for serial port interfacing.
 
-    def keyboardProc(self, nCode, wParam, lParam):
-        if wParam == win32con.WM_KEYDOWN:
-            data = ctypes.cast(lParam, ctypes.POINTER(WinKbdLLHookStruct)).contents
-            self.keyboardEvent(data)
-        return ctypes.windll.user32.CallNextHookEx(self.handle, nCode, wParam, ctypes.wintypes.LPARAM(lParam))
+    reader is a SerialReader, which reconnects if the device is lost.
+    Commands are executed by the dispatcher (a CommandDispatcher, started
+    here if not given); the "Ok" response is written once a command has
+    been executed, while further lines are already being read. Responses
+    are written in command order (see SerialResponses).
 
-    def keyboardEvent(self, data):
-        if data.keycode == ord('P'):
-            # user pressed P
-            print("Got key P")
-            self.handler.pause()
+    If touch (a capsense.TouchButtons) is given, the device may also send
+    raw capacitive sensor samples. Presses detected in them submit the
+    command of the channel, with the arrival of the sample as timestamp.
+    """
 
-    def run(self):
+    if dispatcher is None:
+        dispatcher = CommandDispatcher()
+    responses = SerialResponses(reader)
 
-       while True:
-            msg = win32gui.GetMessage(None, 0, 0)
-            win32gui.TranslateMessage(ctypes.byref(msg))
-            win32gui.DispatchMessage(ctypes.byref(msg))
+    while True:
+        for (tstamp, s) in reader.readLines():
+            s = s.strip()
+            if not s:
+                continue
+            if touch is not None:
+                names = touch.feed(s)
+                if names is not None:
+                    for name in names:
+                        submitTouch(commands, dispatcher, name, tstamp)
+                    continue
+            log.debug("Got command %r", s)
+            command = commands.lookup(s)
+            if command is None:
+                log.warning("ERROR: Unknown command %r", s)
+            elif command.immediate:
+                responses.immediate(command)
+            else:
+                if command.prepare is not None:
+                    command.prepare()
+                responses.queued()
+                dispatcher.submit(CommandEvent('serial', s, command.action,
+                                               tstamp, responses.done))
 
 
-def commandLoop(dev, handler):
-    """Command loop for serial port interfacing."""
+def submitTouch(commands, dispatcher, name, tstamp):
+    """Submit the command of a pressed capacitive button."""
 
-    while True:
-        s = dev.readline()
-        s = s.strip()
-        print("Got command", repr(s))
-        if s.lower() == b'pause':
-            handler.pause()
-            dev.write(b'Ok\n')
-        else:
-            print("ERROR: Unknown command", repr(s))
+    log.debug("Touch button %r pressed", name)
+    command = commands.lookup(name)
+    if command is None:
+        log.warning("ERROR: Unknown touch command %r", name)
+        return
+    if command.prepare is not None:
+        command.prepare()
+    dispatcher.submit(CommandEvent('touch', name, command.action, tstamp))
 
 
 def ctrlc_handler(ctrlType):
@@ -432,10 +572,52 @@ def main():
                       help="Read control messages from keyboard")
     parser.add_option("--baud", action="store", type="int", default=38400,
                       help="Baud rate of serial port")
+    parser.add_option("--touch", action="store", type="string",
+                      metavar="CMD[,CMD...]",
+                      help="Detect capacitive button presses in raw sensor "
+                           "samples from the serial port; one command per "
+                           "channel (needs NumPy)")
+    parser.add_option("--touch-min-delta", action="store", type="float",
+                      default=200,
+                      help="Minimum sensor value above baseline for a press")
     parser.add_option("--typedelay", action="store", type="float", default=0.1,
                       help="Wait time between click/type actions")
+    parser.add_option("--dry-run", action="store_true",
+                      help="Print input events instead of sending them "
+                           "to the game (works on any platform)")
     parser.add_option('--screenshot', action='store_true',
                       help="Take screen shot before mouse click aciton")
+    parser.add_option('--screenshot-region', action='store', type='string',
+                      metavar='WxH',
+                      help="Only capture a WxH pixel region around "
+                           "the pause button")
+    parser.add_option('--screenshot-format', action='store', type='choice',
+                      choices=('png', 'raw'), default='png',
+                      help="Screenshot format: png or raw (PPM)")
+    parser.add_option('--screenshot-level', action='store', type='int',
+                      default=1,
+                      help="PNG compression level 0 .. 9 (default 1)")
+    parser.add_option('--confirm', action='store_true',
+                      help="Wait for visual confirmation of the menu and "
+                           "click instead of fixed delays (needs NumPy)")
+    parser.add_option('--confirm-color', action='store', type='string',
+                      metavar='R,G,B',
+                      help="Menu is open when the pause button area "
+                           "has this colour")
+    parser.add_option('--confirm-template', action='store', type='string',
+                      metavar='FILE',
+                      help="Menu is open when the pause button area "
+                           "matches this PPM image")
+    parser.add_option('--confirm-timeout', action='store', type='float',
+                      default=0.5,
+                      help="Maximum wait for visual confirmation")
+    parser.add_option('--stats-file', action='store', type='string',
+                      metavar='FILE',
+                      help="Write latency statistics as JSON on exit")
+    parser.add_option('--log-level', action='store', type='choice',
+                      choices=tuple(log.LOG_LEVELS), default='info',
+                      help="Log messages of this level and above "
+                           "(debug logs every command)")
     (options, args) = parser.parse_args()
 
     if args:
@@ -448,64 +630,187 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    if (1 if options.tcp else 0) + (1 if options.serial else 0) + (1 if options.keybd else 0) > 1:
-        print("ERROR: Combination of --tcp and --serial and --keybd not supported", file=sys.stderr)
-        parser.print_help()
+    if options.touch and not options.serial:
+        print("ERROR: --touch needs --serial <port>", file=sys.stderr)
         sys.exit(1)
 
-    if options.screenshot:
-        import PIL.ImageGrab
+    if options.dry_run and options.confirm:
+        print("ERROR: --confirm needs the game screen, not supported "
+              "with --dry-run", file=sys.stderr)
+        sys.exit(1)
 
-    if VERBOSE: print("setting ctrlc handler")
-    win32api.SetConsoleCtrlHandler(ctrlc_handler)
+    log.setup(log.LOG_LEVELS[options.log_level])
+
+    if sys.platform == 'win32':
+        import win32api
+        if VERBOSE: print("setting ctrlc handler")
+        win32api.SetConsoleCtrlHandler(ctrlc_handler)
+
+    stats = LatencyStats()
+
+    def dumpStats():
+        print(stats.report())
+        if options.stats_file:
+            stats.dump(options.stats_file)
+
+    atexit.register(dumpStats)
+
+    if options.dry_run:
+        if VERBOSE: print("dry run: not sending input to the game")
+        w = DryRunStuff(stats=stats)
+    else:
+        if VERBOSE: print("initializing Windows stuff")
+        from winstuff import WinStuff
+        w = WinStuff(stats=stats)
+
+    # click pause button (coordinates in range 0 .. 65535 for full screen)
+    PAUSE_BUTTON_X = 6143
+    PAUSE_BUTTON_Y = 6675
+
+    # With visual confirmation, the screen decides how long to wait
+    # after ESC and after the click; otherwise use fixed delays.
+    stepdelay = 0 if options.confirm else options.typedelay
+
+    # press ESC to open the menu
+    openMenuMacro = w.newMacro()
+    openMenuMacro.keyType(VK_ESCAPE)
+    openMenuMacro.wait(stepdelay)
+
+    # click pause button
+    clickMacro = w.newMacro()
+    clickMacro.mouseClick(PAUSE_BUTTON_X, PAUSE_BUTTON_Y, w.BUTTON_LEFT)
+    clickMacro.wait(stepdelay)
+
+    # press ESC again
+    closeMenuMacro = w.newMacro()
+    closeMenuMacro.keyType(VK_ESCAPE)
+    closeMenuMacro.wait(options.typedelay)
+
+    if options.confirm:
+        if VERBOSE: print("initializing visual confirmation")
+        import screenmatch
+        regionsrc = screenmatch.Win32RegionSource()
+        (xs, ys) = w.getScreenSize()
+        cx = PAUSE_BUTTON_X * xs // 65536
+        cy = PAUSE_BUTTON_Y * ys // 65536
+        menuPredicate = None
+        (rw, rh) = (32, 32)
+        if options.confirm_template:
+            template = screenmatch.loadPpm(options.confirm_template)
+            menuPredicate = screenmatch.templatePredicate(template)
+            # Allow the template to match a few pixels off centre.
+            (rh, rw) = template.shape[:2]
+            (rw, rh) = (rw + 8, rh + 8)
+        elif options.confirm_color:
+            color = [ int(v) for v in options.confirm_color.split(',') ]
+            menuPredicate = screenmatch.colorPredicate(color)
+        bbox = (max(0, cx - rw // 2), max(0, cy - rh // 2),
+                min(xs, cx - rw // 2 + rw), min(ys, cy - rh // 2 + rh))
+        # Take the reference only after the previous toggle's closing
+        # ESC has taken effect, or the menu may still be on it.
+        menuConfirm = screenmatch.ScreenConfirm(
+            'menu', regionsrc, bbox, options.confirm_timeout, menuPredicate,
+            ready=w.runner.waitReady)
+        clickConfirm = screenmatch.ScreenConfirm(
+            'click', regionsrc, bbox, options.typedelay,
+            ready=w.runner.waitReady)
 
-    if VERBOSE: print("initializing Windows stuff")
-    w = WinStuff()
+    if options.screenshot:
+        if VERBOSE: print("starting screenshot writer")
+        import screencapture
+        if options.dry_run:
+            grabber = screencapture.SyntheticSource(*w.getScreenSize())
+        else:
+            grabber = screencapture.PilGrabSource()
+        sswriter = screencapture.ScreenshotWriter(
+            encoding=options.screenshot_format,
+            level=options.screenshot_level)
+        # Save the queued frames at exit.
+        atexit.register(sswriter.close)
+        ssbbox = None
+        if options.screenshot_region:
+            (rw, rh) = [ int(v) for v in
+                         options.screenshot_region.lower().split('x') ]
+            (xs, ys) = w.getScreenSize()
+            cx = PAUSE_BUTTON_X * xs // 65536
+            cy = PAUSE_BUTTON_Y * ys // 65536
+            left = min(max(0, cx - rw // 2), max(0, xs - rw))
+            top = min(max(0, cy - rh // 2), max(0, ys - rh))
+            ssbbox = (left, top, min(xs, left + rw), min(ys, top + rh))
 
     class Handler:
 
-        sscnt = 0
-
         def screenshot(self):
-            if VERBOSE: print("saving screenshot")
-            (xs,ys) = w.getScreenSize()
-            img = PIL.ImageGrab.grab()
-            self.sscnt += 1
-            img.save('screenshot%04d.png' % self.sscnt)
-
-        def pause(self):
-            # press ESC
-            w.keyType(win32con.VK_ESCAPE)
-            time.sleep(options.typedelay)
-            if options.screenshot:
-                self.screenshot()
-            # click pause button (coordinates in range 0 .. 65535 for full screen)
-            PAUSE_BUTTON_X = 6143
-            PAUSE_BUTTON_Y = 6675
-            w.mouseClick(PAUSE_BUTTON_X, PAUSE_BUTTON_Y, w.BUTTON_LEFT)
-            time.sleep(options.typedelay)
-            # press ESC again
-            w.keyType(win32con.VK_ESCAPE)
-            time.sleep(options.typedelay)
+            # Only grab the screen here; encoding runs in the background.
+            t = time.monotonic()
+            frame = grabber.capture(ssbbox)
+            filename = sswriter.submit(frame)
+            stats.record('screenshot', time.monotonic() - t)
+            log.debug("Saving screenshot %s", filename)
 
     if VERBOSE: print("initializing command handler")
     handler = Handler()
 
+    pausePlan = [ ]
+    if options.confirm:
+        pausePlan += [ menuConfirm.snapshot, openMenuMacro, menuConfirm.wait ]
+    else:
+        pausePlan += [ openMenuMacro ]
+    if options.screenshot:
+        # The menu is only on screen after the wait following ESC.
+        pausePlan += [ w.runner.waitReady, handler.screenshot ]
+    if options.confirm:
+        pausePlan += [ clickConfirm.snapshot, clickMacro, clickConfirm.wait ]
+    else:
+        pausePlan += [ clickMacro ]
+    pausePlan.append(closeMenuMacro)
+
+    commands = CommandRegistry(w.runner)
+    pauseState = PauseState(commands.makeAction(pausePlan))
+    commands.register(b'pause', [ pauseState.sync ],
+                      prepare=pauseState.requestPause)
+    commands.register(b'start', [ pauseState.sync ],
+                      prepare=pauseState.requestStart)
+    commands.register(b'toggle', [ pauseState.sync ],
+                      prepare=pauseState.requestToggle)
+    commands.register(b'stats',
+                      [ lambda: stats.report().encode() + b'\n' ],
+                      immediate=True)
+
+    # All front-ends feed one dispatcher, which alone drives the input
+    # backend. The last front-end runs in the main thread, the others in
+    # daemon threads; the keyboard hook needs the main thread's message loop.
+    dispatcher = CommandDispatcher(stats)
+    frontends = [ ]
+
     if options.tcp:
-        srv = TcpServer(options.port, handler)
+        srv = TcpServer(options.port, commands, dispatcher=dispatcher)
         print("Waiting for TCP connections on port", options.port)
-        srv.run()
+        frontends.append(srv.run)
 
-    elif options.serial:
+    if options.serial:
         if VERBOSE: print("opening serial port")
-        dev = serial.Serial(port=options.serial, baudrate=options.baud)
+        from serialreader import SerialReader
+        reader = SerialReader(options.serial, options.baud)
+        touch = None
+        if options.touch:
+            import capsense
+            touch = capsense.TouchButtons(
+                [ name.encode() for name in options.touch.split(',') ],
+                minDelta=options.touch_min_delta)
         print("Reading commands from serial port", options.serial)
-        commandLoop(dev, handler)
+        frontends.append(functools.partial(commandLoop, reader, commands,
+                                           dispatcher, touch))
 
-    elif options.keybd:
+    if options.keybd:
         if VERBOSE: print("installing keyboard hook")
-        kbdh = KeyboardHook(handler)
-        kbdh.run()
+        from keyboardhook import KeyboardHook
+        kbdh = KeyboardHook(commands, dispatcher)
+        frontends.append(kbdh.run)
+
+    for frontend in frontends[:-1]:
+        threading.Thread(target=frontend, daemon=True).start()
+    frontends[-1]()
 
 """    
     i = 0
@@ -0,0 +1,482 @@
+#!/usr/bin/python3
+
+"""
+Benchmarks for the command paths of artemis_ui_control.
+
+Usage: benchmark.py [benchmark ...]
+
+Runs all benchmarks if none are specified. Game input is replaced
+by a recording handler, so these benchmarks also run on Linux.
+"""
+
+import sys
+import array
+import contextlib
+import ctypes
+import fcntl
+import os
+import select
+import socket
+import statistics
+import termios
+import threading
+import time
+import subprocess
+import tty
+
+
+class RecordingHandler:
+    """Command handler that records commands instead of sending input."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = [ ]
+
+    def commands(self, uictl):
+        """Return a CommandRegistry with the commands of this handler."""
+
+        commands = uictl.CommandRegistry()
+        commands.register(b'pause', [ self.pause ])
+        return commands
+
+    def pause(self):
+        self.calls.append(('pause', time.perf_counter()))
+        if self.delay:
+            time.sleep(self.delay)
+
+
+@contextlib.contextmanager
+def quietStdout():
+    """Discard the per-command messages printed by the servers."""
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values."""
+
+    values = sorted(values)
+    k = min(len(values) - 1, int(p / 100.0 * len(values)))
+    return values[k]
+
+
+def readLine(sock):
+    """Read one response line from a blocking socket."""
+
+    buf = b''
+    while not buf.endswith(b'\n'):
+        s = sock.recv(4096)
+        if not s:
+            raise EOFError('Server closed connection')
+        buf += s
+    return buf
+
+
+def benchTcp():
+    """Command round-trip latency through TcpServer with many clients."""
+
+    import artemis_ui_control as uictl
+
+    for nclients in (1, 16, 128):
+        with quietStdout():
+            result = runTcp(uictl, nclients)
+        print('tcp      clients=%-4d  median %7.1f us  p99 %7.1f us  '
+              'burst %8.0f cmds/s' % ((nclients,) + result))
+
+
+def runTcp(uictl, nclients):
+    """Run TCP benchmark with nclients connected clients.
+
+    Return (median_latency, p99_latency, burst_rate).
+    """
+
+    handler = RecordingHandler()
+    srv = uictl.TcpServer(0, handler.commands(uictl))
+    port = srv.srvsock.getsockname()[1]
+    th = threading.Thread(target=srv.run, daemon=True)
+    th.start()
+
+    clients = [ ]
+    for i in range(nclients):
+        sock = socket.create_connection(('127.0.0.1', port))
+        readLine(sock)      # greeting
+        clients.append(sock)
+
+    # Sequential round trips, spread over all clients.
+    latencies = [ ]
+    nround = 2000
+    for i in range(nround):
+        sock = clients[i % nclients]
+        t0 = time.perf_counter()
+        sock.sendall(b'pause\n')
+        readLine(sock)
+        latencies.append(time.perf_counter() - t0)
+
+    # All clients send at the same time.
+    t0 = time.perf_counter()
+    nburst = 20
+    for i in range(nburst):
+        for sock in clients:
+            sock.sendall(b'pause\n')
+        for sock in clients:
+            readLine(sock)
+    tburst = time.perf_counter() - t0
+
+    srv.stop = True
+    for sock in clients:
+        sock.close()
+    th.join(timeout=1)
+
+    return (1.0e6 * statistics.median(latencies),
+            1.0e6 * percentile(latencies, 99),
+            nburst * nclients / tburst)
+
+
+class PtyDevice:
+    """Serial device stand-in on the slave side of a pseudo terminal."""
+
+    def __init__(self, fd, timeout=0.1):
+        self.fd = fd
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        buf = array.array('i', [0])
+        fcntl.ioctl(self.fd, termios.FIONREAD, buf)
+        return buf[0]
+
+    def read(self, n):
+        (rfds, wfds, xfds) = select.select([self.fd], [], [], self.timeout)
+        if not rfds:
+            return b''
+        data = os.read(self.fd, n)
+        if not data:
+            # Same as pyserial when the device is gone.
+            raise OSError('device reports readiness to read '
+                          'but returned no data')
+        return data
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def benchSerial():
+    """Command throughput of commandLoop over a pseudo terminal."""
+
+    import artemis_ui_control as uictl
+
+    (master, slave) = os.openpty()
+    tty.setraw(slave)
+
+    import serialreader
+
+    handler = RecordingHandler()
+    reader = serialreader.SerialReader(os.ttyname(slave),
+                                       opener=lambda: PtyDevice(slave))
+    th = threading.Thread(target=uictl.commandLoop,
+                          args=(reader, handler.commands(uictl)),
+                          daemon=True)
+    th.start()
+
+    with quietStdout():
+        ncmd = 2000
+        t0 = time.perf_counter()
+        for i in range(ncmd):
+            os.write(master, b'pause\n')
+            buf = b''
+            while not buf.endswith(b'\n'):
+                buf += os.read(master, 64)
+        t1 = time.perf_counter()
+
+    print('serial   commandLoop  %8.1f us/cmd  %8.0f cmds/s' %
+          (1.0e6 * (t1 - t0) / ncmd, ncmd / (t1 - t0)))
+
+
+def benchMacro():
+    """Duration of the pause macro: one event per call with sleeps
+    in between, versus a batched macro timeline."""
+
+    import wininput
+
+    eventDelay = 0.01
+    typedelay = 0.1
+    esc = wininput.VK_ESCAPE
+
+    def sequential(backend):
+        # Event order and sleeps of the original Handler.pause().
+        def send(inp):
+            backend.sendInputs(ctypes.pointer(inp), 1)
+        for (event, arg) in (('key', esc), ('sleep', typedelay),
+                             ('click', None), ('sleep', typedelay),
+                             ('key', esc), ('sleep', typedelay)):
+            if event == 'key':
+                time.sleep(eventDelay)
+                send(wininput.keyInput(arg, 1))
+                time.sleep(eventDelay)
+                send(wininput.keyInput(arg, 0))
+            elif event == 'click':
+                time.sleep(eventDelay)
+                send(wininput.mouseInput(6143, 6675,
+                                         wininput.MOUSEEVENTF_MOVE |
+                                         wininput.MOUSEEVENTF_ABSOLUTE))
+                time.sleep(eventDelay)
+                send(wininput.mouseInput(0, 0, wininput.MOUSEEVENTF_LEFTDOWN))
+                time.sleep(eventDelay)
+                send(wininput.mouseInput(0, 0, wininput.MOUSEEVENTF_LEFTUP))
+            else:
+                time.sleep(arg)
+
+    macro = wininput.InputMacro(eventDelay)
+    macro.keyType(esc)
+    macro.wait(typedelay)
+    macro.mouseClick(6143, 6675, wininput.BUTTON_LEFT)
+    macro.wait(typedelay)
+    macro.keyType(esc)
+    macro.wait(typedelay)
+
+    def batched(backend):
+        wininput.MacroRunner(backend).run(macro)
+
+    for (name, func) in (('sequential', sequential), ('macro', batched)):
+        backend = wininput.RecordingBackend()
+        t0 = time.monotonic()
+        func(backend)
+        t1 = time.monotonic()
+        tlast = backend.events[-1][0]
+        print('macro    %-10s  %2d events  %2d SendInput calls  '
+              'last event %6.1f ms  return %6.1f ms' %
+              (name, len(backend.events), backend.ncalls,
+               1.0e3 * (tlast - t0), 1.0e3 * (t1 - t0)))
+
+
+def benchScreenshot():
+    """Hot-path cost of a screenshot: synchronous encode and save versus
+    the background writer, using synthetic 1920x1080 frames."""
+
+    import tempfile
+    import screencapture
+
+    source = screencapture.SyntheticSource(1920, 1080)
+    nshot = 10
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        for (encoding, level) in (('png', 6), ('png', 1), ('raw', None)):
+
+            (ext, encode) = screencapture.ENCODINGS[encoding]
+            t0 = time.perf_counter()
+            for i in range(nshot):
+                data = encode(source.capture(), level)
+                with open(os.path.join(tmpdir, 'sync.' + ext), 'wb') as f:
+                    f.write(data)
+            tsync = (time.perf_counter() - t0) / nshot
+
+            writer = screencapture.ScreenshotWriter(
+                encoding=encoding, level=level, directory=tmpdir,
+                maxqueue=nshot)
+            t0 = time.perf_counter()
+            for i in range(nshot):
+                writer.submit(source.capture())
+            tasync = (time.perf_counter() - t0) / nshot
+            writer.close()
+
+            print('screenshot  %-3s level=%-4s  sync %8.2f ms  '
+                  'background %8.3f ms' %
+                  (encoding, level, 1.0e3 * tsync, 1.0e3 * tasync))
+
+        # Region capture around the pause button.
+        t0 = time.perf_counter()
+        for i in range(nshot):
+            frame = source.capture((0, 0, 400, 300))
+        print('screenshot  region 400x300 capture %8.3f ms' %
+              (1.0e3 * (time.perf_counter() - t0) / nshot))
+
+
+def benchConfirm():
+    """Visual confirmation on synthetic frames: menu appears after 30 ms,
+    compared to a fixed 100 ms delay (needs NumPy)."""
+
+    import numpy
+    import screenmatch
+
+    background = numpy.zeros((1080, 1920, 3), dtype=numpy.uint8)
+    menu = background.copy()
+    menu[80:140, 150:350] = (40, 90, 200)
+    bbox = (234, 94, 266, 126)
+    template = numpy.array(menu[98:122, 238:262])
+
+    predicates = (
+        ('change',   None),
+        ('color',    screenmatch.colorPredicate((40, 90, 200))),
+        ('template', screenmatch.templatePredicate(template)),
+    )
+
+    for (name, predicate) in predicates:
+        screen = screenmatch.SyntheticScreen([ (0, background),
+                                               (0.030, menu) ])
+        confirm = screenmatch.ScreenConfirm(name, screen, bbox, 0.5,
+                                            predicate)
+        confirm.snapshot()
+        region = screen.capture(bbox)
+        check = predicate or screenmatch.changedPredicate(
+            numpy.array(region))
+        t = timePerCall(lambda: check(region), 1000)
+        screen.start()
+        t0 = time.perf_counter()
+        confirm.wait()
+        elapsed = time.perf_counter() - t0
+        print('confirm  %-8s  check %7.1f us  wait %6.1f ms  '
+              '(fixed delay 100.0 ms)' %
+              (name, 1.0e6 * t, 1.0e3 * elapsed))
+
+
+def benchTouch():
+    """Press-to-command latency of capacitive touch detection, with raw
+    samples at 200 Hz over a pseudo terminal (needs NumPy)."""
+
+    import artemis_ui_control as uictl
+    import capsense
+    import serialreader
+
+    rate = 200.0
+    nchannels = 8
+    presses = [ (100 + 40 * k, 12, k % nchannels) for k in range(20) ]
+    samples = capsense.syntheticSamples(nchannels, presses[-1][0] + 60,
+                                        presses, drift=0.5)
+    lines = capsense.formatSamples(samples)
+
+    (master, slave) = os.openpty()
+    tty.setraw(slave)
+
+    handler = RecordingHandler()
+    commands = handler.commands(uictl)
+    touch = capsense.TouchButtons([ b'pause' ] * nchannels)
+    reader = serialreader.SerialReader(os.ttyname(slave),
+                                       opener=lambda: PtyDevice(slave))
+    th = threading.Thread(target=uictl.commandLoop,
+                          args=(reader, commands, None, touch),
+                          daemon=True)
+
+    with quietStdout():
+        th.start()
+        twrite = [ ]
+        t0 = time.perf_counter()
+        for (k, line) in enumerate(lines):
+            delay = t0 + k / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            twrite.append(time.perf_counter())
+            os.write(master, line)
+        time.sleep(0.1)
+
+    latencies = [ tcall - twrite[start]
+                  for ((start, length, channel), (name, tcall))
+                  in zip(presses, handler.calls) ]
+    print('touch    %d channels  %d Hz  detected %d/%d  median %5.1f ms  '
+          'max %5.1f ms  (sketch debounce 1000 ms)' %
+          (nchannels, rate, len(handler.calls), len(presses),
+           1.0e3 * statistics.median(latencies), 1.0e3 * max(latencies)))
+
+
+def timePerCall(func, number):
+    """Return the average time per call of func in seconds."""
+
+    t0 = time.perf_counter()
+    for i in range(number):
+        func()
+    return (time.perf_counter() - t0) / number
+
+
+# Modules imported at startup by each front-end.
+STARTUP_MODULES = (
+    ('tcp',        [ 'artemis_ui_control' ]),
+    ('serial',     [ 'artemis_ui_control', 'serialreader', 'serial' ]),
+    ('touch',      [ 'artemis_ui_control', 'serialreader', 'serial',
+                     'capsense' ]),
+    ('keybd',      [ 'artemis_ui_control', 'winstuff', 'keyboardhook' ]),
+    ('screenshot', [ 'artemis_ui_control', 'screencapture' ]),
+    ('confirm',    [ 'artemis_ui_control', 'winstuff', 'screenmatch' ]),
+)
+
+
+def importTime(modules):
+    """Import modules in a fresh interpreter with -X importtime.
+
+    Return (import_time, process_time) in seconds, where import_time is
+    the total cumulative time of the listed modules, or None if
+    an import fails.
+    """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    t0 = time.perf_counter()
+    proc = subprocess.run([ sys.executable, '-X', 'importtime', '-c',
+                            'import ' + ', '.join(modules) ],
+                          cwd=here, capture_output=True, text=True)
+    t1 = time.perf_counter()
+    if proc.returncode != 0:
+        return None
+
+    # Lines are "import time: <self us> | <cumulative us> | <module>",
+    # with nested imports indented further.
+    total = 0
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2][1:] in modules:
+            total += int(fields[1])
+    return (1.0e-6 * total, t1 - t0)
+
+
+def benchStartup():
+    """Import time of each front-end, in fresh interpreters."""
+
+    nruns = 5
+    base = statistics.median(importTime([ 'sys' ])[1] for i in range(nruns))
+
+    for (name, modules) in STARTUP_MODULES:
+        results = [ importTime(modules) for i in range(nruns) ]
+        if None in results:
+            print('startup  %-10s  not available on this platform' % name)
+            continue
+        print('startup  %-10s  imports %6.1f ms  process %6.1f ms  '
+              '(interpreter %5.1f ms)' %
+              (name, 1.0e3 * statistics.median(r[0] for r in results),
+               1.0e3 * statistics.median(r[1] for r in results),
+               1.0e3 * base))
+
+
+BENCHMARKS = {
+    'tcp':        benchTcp,
+    'serial':     benchSerial,
+    'macro':      benchMacro,
+    'screenshot': benchScreenshot,
+    'confirm':    benchConfirm,
+    'touch':      benchTouch,
+    'startup':    benchStartup,
+}
+
+
+def main():
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        if name not in BENCHMARKS:
+            print(__doc__, file=sys.stderr)
+            print('Known benchmarks:', ' '.join(BENCHMARKS), file=sys.stderr)
+            sys.exit(1)
+
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
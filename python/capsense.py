@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+"""
+Touch detection for capacitive buttons from raw sensor samples.
+
+In raw streaming mode the Arduino sends one line per measurement with
+the raw capacitiveSensor() value of each channel, separated by tabs or
+spaces, instead of thresholding on the board and debouncing with
+delay(). The host tracks an adaptive baseline per channel, smooths the
+samples over a short sliding window and detects presses and releases
+with hysteresis. All channels are processed at once with NumPy.
+
+Usage: capsense.py [options] [<samplefile>]
+
+Runs the detector over a recorded sample stream (or a synthetic one)
+and prints the detected presses and releases.
+"""
+
+import sys
+import optparse
+
+import numpy
+
+
+NO_CHANNELS = numpy.zeros(0, dtype=numpy.intp)
+
+
+def parseSample(line):
+    """Return the channel values of a raw sample line as a list of ints,
+    or None if the line is not a sample (e.g. a command)."""
+
+    fields = line.replace(b',', b' ').split()
+    if not fields or fields[0][:1] not in b'-0123456789':
+        return None
+    try:
+        return [ int(field) for field in fields ]
+    except ValueError:
+        return None
+
+
+class TouchDetector:
+    """Press and release detection for a number of capacitive channels.
+
+    Each sample is averaged over the last window samples. A channel is
+    pressed when the smoothed value exceeds its baseline by more than the
+    press level, the larger of minDelta and pressSigma times the channel
+    noise, and released when it falls below releaseRatio times that level.
+
+    Baseline and noise (mean absolute deviation) are initialised from
+    the first warmup samples and then follow slow drift as exponential
+    moving averages, only while the channel is released. A channel that
+    stays pressed for maxHold samples is recalibrated and released.
+    Negative values (sensor timeouts) are ignored.
+    """
+
+    def __init__(self, nchannels, window=3, minDelta=200, pressSigma=8.0,
+                 releaseRatio=0.5, alpha=1.0/256, warmup=32, maxHold=None):
+        self.nchannels = nchannels
+        self.window = window
+        self.minDelta = minDelta
+        self.pressSigma = pressSigma
+        self.releaseRatio = releaseRatio
+        self.alpha = alpha
+        self.warmup = max(warmup, window)
+        self.maxHold = maxHold
+        self.ring = numpy.zeros((window, nchannels))
+        self.sum = numpy.zeros(nchannels)
+        self.baseline = numpy.zeros(nchannels)
+        self.noise = numpy.zeros(nchannels)
+        self.pressed = numpy.zeros(nchannels, dtype=bool)
+        self.hold = numpy.zeros(nchannels, dtype=numpy.int64)
+        self.warmupSamples = [ ]
+        self.nsamples = 0
+
+    def update(self, sample):
+        """Process one sample (sequence of nchannels values).
+
+        Return (pressed, released): arrays of the channels that were
+        pressed or released by this sample.
+        """
+
+        x = numpy.asarray(sample, dtype=numpy.float64)
+        x = numpy.where(x >= 0, x, self.sum / self.window)
+
+        # Sliding window sum; the ring holds the last window samples.
+        i = self.nsamples % self.window
+        self.sum += x - self.ring[i]
+        self.ring[i] = x
+        self.nsamples += 1
+
+        if self.nsamples <= self.warmup:
+            self.warmupSamples.append(x)
+            if self.nsamples == self.warmup:
+                samples = numpy.array(self.warmupSamples)
+                self.baseline = samples.mean(axis=0)
+                self.noise = numpy.abs(samples - self.baseline).mean(axis=0)
+                self.warmupSamples = [ ]
+            return (NO_CHANNELS, NO_CHANNELS)
+
+        smoothed = self.sum / self.window
+        delta = smoothed - self.baseline
+        level = numpy.maximum(self.minDelta, self.pressSigma * self.noise)
+
+        pressed = ~self.pressed & (delta > level)
+        released = self.pressed & (delta < self.releaseRatio * level)
+        self.pressed ^= pressed | released
+
+        if self.maxHold is not None:
+            self.hold = numpy.where(self.pressed, self.hold + 1, 0)
+            stuck = self.hold >= self.maxHold
+            if stuck.any():
+                self.baseline = numpy.where(stuck, smoothed, self.baseline)
+                self.pressed &= ~stuck
+                self.hold[stuck] = 0
+                released |= stuck
+
+        # Follow drift while released.
+        idle = ~self.pressed
+        self.baseline += idle * self.alpha * (smoothed - self.baseline)
+        self.noise += idle * self.alpha * (numpy.abs(x - self.baseline) -
+                                           self.noise)
+
+        return (pressed.nonzero()[0], released.nonzero()[0])
+
+    def process(self, samples):
+        """Process an array of samples, shape (n, nchannels).
+
+        Return a list of (sample index, channel, pressed) for all
+        presses (pressed True) and releases (pressed False).
+        """
+
+        events = [ ]
+        for (k, sample) in enumerate(samples):
+            (pressed, released) = self.update(sample)
+            events.extend((k, int(ch), True) for ch in pressed)
+            events.extend((k, int(ch), False) for ch in released)
+        return events
+
+
+class TouchButtons:
+    """Map presses of capacitive channels to command names.
+
+    names is a list of command names (bytes), one per channel, in the
+    order of the values in a sample line. Extra values are ignored.
+    """
+
+    def __init__(self, names, **params):
+        self.names = names
+        self.detector = TouchDetector(len(names), **params)
+        self.nbad = 0
+
+    def feed(self, line):
+        """Process a received line.
+
+        Return None if the line is not a sample, otherwise a list of
+        the command names of channels pressed by this sample.
+        """
+
+        values = parseSample(line)
+        if values is None:
+            return None
+        if len(values) < len(self.names):
+            self.nbad += 1
+            return [ ]
+        (pressed, released) = self.detector.update(values[:len(self.names)])
+        return [ self.names[ch] for ch in pressed ]
+
+
+def syntheticSamples(nchannels, nsamples, presses, baseline=1000.0,
+                     noise=30.0, touch=20000.0, drift=0.0, seed=0):
+    """Return a synthetic sample stream as int array (nsamples, nchannels).
+
+    presses is a list of (start, length, channel). Each channel has its
+    own baseline, Gaussian noise and linear drift per sample; a touch
+    ramps up over 3 samples.
+    """
+
+    rnd = numpy.random.default_rng(seed)
+    base = baseline * (1.0 + 0.5 * rnd.random(nchannels))
+    t = numpy.arange(nsamples)[:, None]
+    samples = base + drift * t + rnd.normal(0.0, noise, (nsamples, nchannels))
+    for (start, length, channel) in presses:
+        ramp = numpy.minimum(1.0, (numpy.arange(length) + 1) / 3.0)
+        samples[start:start+length, channel] += touch * ramp
+    return numpy.maximum(samples, 0).astype(numpy.int64)
+
+
+def formatSamples(samples):
+    """Return a list of raw sample lines, as sent by the Arduino."""
+
+    return [ b'\t'.join(b'%d' % v for v in row) + b'\r\n'
+             for row in samples ]
+
+
+def main():
+
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option("--synthetic", action="store_true",
+                      help="Use a synthetic stream with random presses")
+    parser.add_option("--channels", action="store", type="int", default=4,
+                      help="Channels of the synthetic stream (default 4)")
+    parser.add_option("--window", action="store", type="int", default=3,
+                      help="Smoothing window in samples (default 3)")
+    parser.add_option("--min-delta", action="store", type="float",
+                      default=200,
+                      help="Minimum press level above baseline "
+                           "(default 200)")
+    (options, args) = parser.parse_args()
+
+    if options.synthetic:
+        rnd = numpy.random.default_rng(1)
+        presses = [ (100 + 60 * k, int(rnd.integers(5, 40)),
+                     int(rnd.integers(options.channels)))
+                    for k in range(20) ]
+        samples = syntheticSamples(options.channels, 1400, presses,
+                                   drift=0.5)
+        print("Synthetic presses (sample, length, channel):", presses)
+    elif len(args) == 1:
+        f = sys.stdin.buffer if args[0] == '-' else open(args[0], 'rb')
+        samples = [ v for v in map(parseSample, f) if v is not None ]
+        f.close()
+        nchannels = min(len(v) for v in samples)
+        samples = numpy.array([ v[:nchannels] for v in samples ])
+    else:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+
+    detector = TouchDetector(samples.shape[1], window=options.window,
+                             minDelta=options.min_delta)
+    for (k, channel, pressed) in detector.process(samples):
+        print("sample %6d  channel %2d  %s" %
+              (k, channel, 'pressed' if pressed else 'released'))
+
+
+if __name__ == '__main__':
+    main()
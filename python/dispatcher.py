@@ -0,0 +1,106 @@
+"""
+Command dispatcher shared by the control front-ends.
+
+Front-ends (TCP, serial port, keyboard hook) only parse commands and
+queue them as events; one dispatcher thread executes them, so the
+front-ends can run concurrently without contending for the input backend.
+"""
+
+import time
+import queue
+import threading
+
+import logwriter as log
+
+
+class CommandEvent:
+    """Command received by a front-end, queued for the dispatcher.
+
+    source names the front-end ('tcp', 'serial', 'keybd'). done, if given,
+    is called by the dispatcher thread with the event after execution;
+    it must not block.
+    """
+
+    def __init__(self, source, cmd, action, tarrival, done=None):
+        self.source = source
+        self.cmd = cmd
+        self.action = action
+        self.tarrival = tarrival
+        self.done = done
+        self.tqueued = time.monotonic()
+        self.tstart = None
+        self.tdone = None
+        self.result = None
+
+
+class CommandDispatcher:
+    """Event bus shared by all control front-ends.
+
+    Front-ends submit CommandEvents from their own threads (or from the
+    keyboard hook callback); submit() never blocks. A single dispatcher
+    thread executes the events in arrival order, so it is the only thread
+    that drives the input backend, whichever front-ends are running.
+
+    If stats (a LatencyStats) is given, queueing, execution and total
+    time from receiving the command are recorded as stages
+    '<source>.queue', '<source>.exec' and '<source>.total'.
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats
+        self.events = queue.Queue()
+        self.stages = { }
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, event):
+        """Queue an event for execution."""
+
+        self.events.put(event)
+
+    def execute(self, event):
+        """Execute a command and return the result string."""
+
+        if event.action is None:
+            return b'Unknown_Cmd'
+        event.action()
+        return b'Ok'
+
+    def run(self):
+        """Execute queued events in order (runs in dispatcher thread)."""
+
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            event.tstart = time.monotonic()
+            try:
+                event.result = self.execute(event)
+            except Exception as exc:
+                log.error("ERROR: Command %r failed: %s", event.cmd, exc)
+                event.result = b'Error'
+            event.tdone = time.monotonic()
+            if self.stats is not None and event.action is not None:
+                self.record(event)
+            if event.done is not None:
+                try:
+                    event.done(event)
+                except Exception as exc:
+                    log.error("ERROR: Completion of %r failed: %s",
+                              event.cmd, exc)
+
+    def record(self, event):
+        stages = self.stages.get(event.source)
+        if stages is None:
+            stages = self.stages[event.source] = tuple(
+                '%s.%s' % (event.source, stage)
+                for stage in ('queue', 'exec', 'total'))
+        self.stats.record(stages[0], event.tstart - event.tarrival)
+        self.stats.record(stages[1], event.tdone - event.tstart)
+        self.stats.record(stages[2], event.tdone - event.tarrival)
+
+    def close(self):
+        """Stop the dispatcher thread after the queued events."""
+
+        self.events.put(None)
+        self.thread.join()
@@ -0,0 +1,71 @@
+"""
+Keyboard front-end: trigger commands with global hotkeys.
+
+This module needs Windows and pywin32. It is only imported when
+the keyboard front-end is selected.
+"""
+
+import time
+import ctypes
+import ctypes.wintypes
+import win32api
+import win32con
+import win32gui
+
+from dispatcher import CommandEvent
+import logwriter as log
+
+
+class WinKbdLLHookStruct(ctypes.Structure):
+    _fields_ = [
+        ('keycode', ctypes.c_uint),
+        ('scancode', ctypes.c_uint),
+        ('flags', ctypes.c_uint),
+        ('time', ctypes.c_uint),
+        ('info', ctypes.POINTER(ctypes.c_ulong)) ]
+
+
+class KeyboardHook:
+    """Low-level keyboard hook that submits commands to the dispatcher.
+
+    The hook callback only looks up the key and queues the command, so it
+    returns at once; Windows drops hooks that take too long.
+    """
+
+    # Commands triggered by keys.
+    KEY_COMMANDS = { ord('P'): b'toggle' }
+
+    def __init__(self, commands, dispatcher):
+
+        self.dispatcher = dispatcher
+        self.keyCommands = { key: commands.lookup(cmd)
+                             for (key, cmd) in self.KEY_COMMANDS.items() }
+        functype = ctypes.WINFUNCTYPE(ctypes.wintypes.LPARAM,
+                                      ctypes.wintypes.INT,
+                                      ctypes.wintypes.WPARAM,
+                                      ctypes.wintypes.LPARAM)
+        self.pfunc = functype(self.keyboardProc)
+        self.handle = ctypes.windll.user32.SetWindowsHookExA(win32con.WH_KEYBOARD_LL, self.pfunc, win32api.GetModuleHandle(None), 0)
+
+    def keyboardProc(self, nCode, wParam, lParam):
+        if wParam == win32con.WM_KEYDOWN:
+            tarrival = time.monotonic()
+            data = ctypes.cast(lParam, ctypes.POINTER(WinKbdLLHookStruct)).contents
+            self.keyboardEvent(data, tarrival)
+        return ctypes.windll.user32.CallNextHookEx(self.handle, nCode, wParam, ctypes.wintypes.LPARAM(lParam))
+
+    def keyboardEvent(self, data, tarrival):
+        command = self.keyCommands.get(data.keycode)
+        if command is not None:
+            log.debug("Got key %d", data.keycode)
+            if command.prepare is not None:
+                command.prepare()
+            self.dispatcher.submit(CommandEvent('keybd', command.name,
+                                                command.action, tarrival))
+
+    def run(self):
+
+       while True:
+            msg = win32gui.GetMessage(None, 0, 0)
+            win32gui.TranslateMessage(ctypes.byref(msg))
+            win32gui.DispatchMessage(ctypes.byref(msg))
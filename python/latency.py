@@ -0,0 +1,103 @@
+"""
+Low-overhead latency histograms for the command path.
+
+Each stage of the command path (queueing, execution, SendInput calls,
+screenshots, end-to-end) records its durations in a log-scale histogram.
+Recording a value costs one log2 and a list increment; histograms are
+not locked, so each stage should be recorded from one thread at a time.
+"""
+
+import math
+
+
+class LatencyHistogram:
+    """Log-scale histogram of durations from 1 us to about 1 hour,
+    with 4 buckets per factor 2."""
+
+    BUCKETS_PER_OCTAVE = 4
+    NBUCKETS = 4 * 32
+
+    def __init__(self):
+        self.counts = [ 0 ] * self.NBUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = 1.0e6 * seconds
+        if us < 1.0:
+            i = 0
+        else:
+            i = min(self.NBUCKETS - 1,
+                    int(self.BUCKETS_PER_OCTAVE * math.log2(us)))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def bucketLimit(self, i):
+        """Return the upper limit of bucket i in seconds."""
+
+        return 1.0e-6 * 2.0 ** ((i + 1) / self.BUCKETS_PER_OCTAVE)
+
+    def percentile(self, p):
+        """Return an upper bound of the p-th percentile in seconds."""
+
+        if not self.count:
+            return 0.0
+        need = p / 100.0 * self.count
+        n = 0
+        for (i, c) in enumerate(self.counts):
+            n += c
+            if n >= need and c:
+                return min(self.bucketLimit(i), self.max)
+        return self.max
+
+    def summary(self):
+        """Return a dict with count, mean, percentiles and max in seconds."""
+
+        return {
+            'count': self.count,
+            'mean':  self.total / self.count if self.count else 0.0,
+            'p50':   self.percentile(50),
+            'p90':   self.percentile(90),
+            'p99':   self.percentile(99),
+            'max':   self.max }
+
+
+class LatencyStats:
+    """Latency histograms per named stage."""
+
+    def __init__(self):
+        self.hists = { }
+
+    def record(self, stage, seconds):
+        hist = self.hists.get(stage)
+        if hist is None:
+            hist = self.hists.setdefault(stage, LatencyHistogram())
+        hist.record(seconds)
+
+    def summary(self):
+        return { stage: hist.summary()
+                 for (stage, hist) in sorted(self.hists.items()) }
+
+    def report(self):
+        """Return a text table of all stages (times in milliseconds)."""
+
+        lines = [ '%-16s %8s %9s %9s %9s %9s %9s' %
+                  ('stage', 'count', 'mean', 'p50', 'p90', 'p99', 'max') ]
+        for (stage, s) in self.summary().items():
+            lines.append('%-16s %8d %9.3f %9.3f %9.3f %9.3f %9.3f' %
+                         (stage, s['count'], 1.0e3 * s['mean'],
+                          1.0e3 * s['p50'], 1.0e3 * s['p90'],
+                          1.0e3 * s['p99'], 1.0e3 * s['max']))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Write the summary as JSON (times in seconds)."""
+
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write('\n')
@@ -0,0 +1,218 @@
+"""
+Level-gated log messages, written by a background thread.
+
+Callers pass the format arguments separately, so a disabled message
+costs one comparison and an enabled one only a queue put; formatting
+and console output happen in the writer thread. This module only uses
+the standard library modules that are imported anyway, to keep
+startup fast.
+
+Used by the UI control scripts and, through testcli.py, by the
+protocol client tools.
+"""
+
+import sys
+import time
+import atexit
+import queue
+import threading
+
+
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LOG_LEVELS = {
+    'debug':    DEBUG,
+    'info':     INFO,
+    'warning':  WARNING,
+    'error':    ERROR,
+}
+
+
+class LogWriter:
+    """Format and write log messages, in a writer thread once started.
+
+    Callers check the level before calling write(), so disabled
+    messages cost one comparison. Enabled messages are queued with
+    their arguments and formatted by the writer thread; the arguments
+    must not be changed afterwards (log len(payload), not a memoryview
+    into a receive buffer). Until start() is called, messages are
+    written synchronously.
+
+    Messages go to stream (default sys.stdout), prefixed with the UTC
+    time if timestamps is set.
+    """
+
+    def __init__(self, stream=None, level=INFO, timestamps=False):
+        self.stream = stream
+        self.level = level
+        self.timestamps = timestamps
+        self.records = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Write all queued messages and stop the writer thread."""
+
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def write(self, msg, args):
+        if self.thread is None:
+            self.output([ self.format((time.time(), msg, args)) ])
+        else:
+            self.records.put((time.time(), msg, args))
+
+    def format(self, record):
+        (tstamp, msg, args) = record
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = '%s %r' % (msg, args)
+        if not self.timestamps:
+            return msg + '\n'
+        tstr = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(tstamp)))
+        return '%s.%03d %s\n' % (
+            tstr, max(0, min(999, int(1000 * (tstamp - int(tstamp))))), msg)
+
+    def output(self, lines):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(lines))
+        stream.flush()
+
+    def run(self):
+        """Write queued messages, in batches (runs in writer thread)."""
+
+        records = self.records
+        while True:
+            record = records.get()
+            lines = [ ]
+            while record is not None:
+                lines.append(self.format(record))
+                if records.empty():
+                    break
+                record = records.get()
+            if lines:
+                self.output(lines)
+            if record is None:
+                break
+
+
+class RateLimiter:
+    """Pass the first of repeated messages per interval, count the rest.
+
+    Messages are repeated if they have the same key. The count of
+    suppressed messages is reported with the next passed message,
+    or by flush().
+    """
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.entries = { }      # key -> [tlast, nsuppressed, msg, args]
+
+    def allow(self, key, msg, args):
+        """Return the number of messages suppressed since the last passed
+        one, or None if this one is to be suppressed as well."""
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = [ now, 0, msg, args ]
+                return 0
+            if now - entry[0] < self.interval:
+                entry[1] += 1
+                entry[2] = msg
+                entry[3] = args
+                return None
+            nsuppressed = entry[1]
+            self.entries[key] = [ now, 0, msg, args ]
+            return nsuppressed
+
+    def flush(self):
+        """Return (msg, args, nsuppressed) for all keys with suppressed
+        messages, and reset their counts."""
+
+        with self.lock:
+            pending = [ (entry[2], entry[3], entry[1])
+                        for entry in self.entries.values() if entry[1] ]
+            for entry in self.entries.values():
+                entry[1] = 0
+        return pending
+
+
+writer = LogWriter()
+warnLimiter = RateLimiter()
+
+
+def setup(level=INFO, stream=None, timestamps=False):
+    """Write messages of level and above from the writer thread.
+
+    At exit, suppressed warnings are reported and the queued
+    messages are written.
+    """
+
+    writer.level = level
+    writer.stream = stream
+    writer.timestamps = timestamps
+    writer.start()
+    atexit.register(stop)
+
+
+def stop():
+    """Report suppressed warnings and write all queued messages."""
+
+    for (msg, args, nsuppressed) in warnLimiter.flush():
+        writer.write(msg + ' (%d similar suppressed)', args + (nsuppressed,))
+    writer.stop()
+
+
+def log(level, msg, *args):
+    if writer.level <= level:
+        writer.write(msg, args)
+
+
+def debug(msg, *args):
+    if writer.level <= DEBUG:
+        writer.write(msg, args)
+
+
+def info(msg, *args):
+    if writer.level <= INFO:
+        writer.write(msg, args)
+
+
+def warning(msg, *args):
+    if writer.level <= WARNING:
+        writer.write(msg, args)
+
+
+def error(msg, *args):
+    if writer.level <= ERROR:
+        writer.write(msg, args)
+
+
+def warn(key, msg, *args):
+    """Log a warning, rate-limited per key.
+
+    Repeated warnings with the same key (e.g. the same unknown ptype)
+    are logged at most once per interval, with the number suppressed.
+    """
+
+    if writer.level > WARNING:
+        return
+    nsuppressed = warnLimiter.allow(key, msg, args)
+    if nsuppressed:
+        writer.write(msg + ' (%d similar suppressed)', args + (nsuppressed,))
+    elif nsuppressed is not None:
+        writer.write(msg, args)
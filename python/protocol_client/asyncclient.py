@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+"""
+Asyncio-based Artemis client.
+
+Usage: asyncclient.py <serveripaddr> [<serveripaddr> ...]
+
+Connects to all specified servers concurrently and logs
+the received packets.
+"""
+
+import sys
+import asyncio
+import socket
+
+from testcli import (dbg, setupLogging, ConnectionType, PacketFramer,
+                     PACKET_HEADER, PACKET_PREAMBLE,
+                     ArtemisClientProtocol, ArtemisClientHandler)
+
+
+class AsyncArtemisClient:
+    """Client side of Artemis network connection, for use with asyncio.
+
+    Received packets are checked and framed in the same way as by
+    ArtemisClientConnection.getPacket().
+    """
+
+    def __init__(self, serverhost, serverport=2010):
+
+        self.sock = None
+        self.serverhost = serverhost
+        self.serverport = serverport
+        self.framer = PacketFramer(ConnectionType.Server)
+        self.recvWaiter = None
+        self.sendLock = asyncio.Lock()
+
+    async def connect(self):
+        """Connect to the server.
+
+        If the connect is cancelled or fails, no socket is left open.
+        """
+
+        assert self.sock is None
+
+        loop = asyncio.get_running_loop()
+
+        dbg('Connecting to server %s ...', self.serverhost)
+        addrs = await loop.getaddrinfo(self.serverhost, self.serverport,
+                                       type=socket.SOCK_STREAM)
+
+        err = None
+        for (family, stype, sproto, cname, addr) in addrs:
+            sock = socket.socket(family, stype, sproto)
+            try:
+                sock.setblocking(False)
+                await loop.sock_connect(sock, addr)
+            except OSError as exc:
+                sock.close()
+                err = exc
+                continue
+            except BaseException:
+                # Includes cancellation.
+                sock.close()
+                raise
+            self.sock = sock
+            self.framer.reset()
+            dbg('Connected to server %s', self.serverhost)
+            return
+
+        raise err or OSError('Can not resolve %r' % self.serverhost)
+
+    def close(self):
+        """Close the connection.
+
+        A task waiting in packets() finishes its iteration.
+        """
+
+        if self.sock is not None:
+            dbg('Closing connection to %s ...', self.serverhost)
+            sock = self.sock
+            self.sock = None
+            if self.recvWaiter is not None:
+                self.recvWaiter.cancel()
+                self.recvWaiter = None
+            sock.close()
+        self.framer.reset()
+
+    def isConnected(self):
+
+        return self.sock is not None
+
+    def subscribe(self, ptypes):
+        """Receive only packets of the specified types (None for all)."""
+
+        self.framer.ptypes = None if ptypes is None else frozenset(ptypes)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def packets(self):
+        """Asynchronously iterate over packets received from the server.
+
+        Yield tuples (ptype, payload). The payload is a memoryview into
+        the receive buffer; it remains valid until the next iteration.
+        Iteration ends when the connection is closed.
+
+        Raise ProtocolError if an invalid packet is received.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        while self.sock is not None:
+
+            self.recvWaiter = asyncio.ensure_future(
+                loop.sock_recv_into(self.sock, self.framer.writeBuffer()))
+            try:
+                n = await self.recvWaiter
+            except asyncio.CancelledError:
+                if self.sock is None:
+                    # Connection closed by close().
+                    return
+                raise
+            finally:
+                self.recvWaiter = None
+
+            if not n:
+                dbg('Server %s dropped connection', self.serverhost)
+                self.close()
+                return
+
+            self.framer.commitWrite(n)
+
+            for pkt in self.framer.splitPackets():
+                yield pkt
+
+    async def sendPacket(self, ptype, payload):
+        """Send a packet to the server.
+
+        Concurrent calls are serialised. If the send is cancelled
+        halfway through a packet, the connection is closed because
+        the stream can not be resynchronised.
+        """
+
+        assert self.sock is not None
+
+        loop = asyncio.get_running_loop()
+
+        plen = PACKET_HEADER.size + len(payload)
+        hdr = PACKET_HEADER.pack(PACKET_PREAMBLE,
+                                 plen,
+                                 ConnectionType.Client.value,
+                                 0,
+                                 plen - 20,
+                                 ptype)
+
+        async with self.sendLock:
+            try:
+                await loop.sock_sendall(self.sock, hdr + payload)
+            except asyncio.CancelledError:
+                self.close()
+                raise
+
+
+async def monitorServer(serverhost):
+    """Connect to one server and log packets until it disconnects."""
+
+    client = AsyncArtemisClient(serverhost)
+    async with client:
+
+        proto   = ArtemisClientProtocol(client)
+        handler = ArtemisClientHandler(proto)
+        proto.handler = handler
+
+        async for (ptype, payload) in client.packets():
+            proto.handlePacket(ptype, payload)
+
+
+async def amain(serverhosts):
+
+    await asyncio.gather(*[ monitorServer(host) for host in serverhosts ])
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+
+    setupLogging()
+    asyncio.run(amain(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+
+"""
+Micro-benchmarks for the Artemis protocol client.
+
+Usage: benchmark.py [benchmark ...]
+
+Runs all benchmarks if none are specified.
+"""
+
+import sys
+import random
+import socket
+import struct
+import threading
+import time
+import timeit
+
+from testcli import (ProtocolError, PacketType, ConnectionType, formatPacket,
+                     OBJECT_HEADER, OBJECT_LAYOUTS, STRING_LENGTH,
+                     decodeObjectRecords, decodeObjectUpdate,
+                     ArtemisClientConnection, ArtemisClientProtocol,
+                     NullClientHandler)
+from profiler import TrafficProfile
+from relay import PacketRelay, RelayClient
+from simserver import SimServer
+from world import WorldState
+
+
+class ChainProtocol:
+    """Reference if/elif dispatcher, as used before the schema registry."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.handler = None
+
+    def handlePacket(self, ptype, payload):
+
+        if ptype == PacketType.DifficultyPacket.value and len(payload) == 8:
+            (difficulty, gametype) = struct.unpack('<II', payload)
+            self.handler.handleDifficulty(difficulty, gametype)
+
+        elif ptype == PacketType.WelcomePacket.value:
+            msg = str(payload, 'latin-1')
+            self.handler.handleWelcome(msg)
+
+        elif ptype == PacketType.VersionPacket.value and len(payload) >= 20:
+            version = struct.unpack_from('<IfIII', payload)[2:]
+            self.handler.handleVersion(version)
+
+
+def naiveObjectUpdate(payload, world):
+    """Reference object update decoder, as used before record layouts:
+    one struct.unpack_from() per field."""
+
+    pos = 0
+    end = len(payload)
+    names = world.names
+    columns = world.columns
+    while pos < end and payload[pos] != 0:
+        (objtype, objid) = OBJECT_HEADER.unpack_from(payload, pos)
+        pos += OBJECT_HEADER.size
+        layout = OBJECT_LAYOUTS.get(objtype)
+        if layout is None:
+            raise ProtocolError('Unknown object type %d' % objtype)
+        mask = int.from_bytes(payload[pos:pos+layout.nbytes], 'little')
+        pos += layout.nbytes
+        if mask >> len(layout.fields):
+            raise ProtocolError('Unsupported fields 0x%x for object type %d' %
+                                (mask, objtype))
+
+        slot = world.slot(objid, objtype)
+        for (bit, (name, fmt)) in enumerate(layout.fields):
+            if not mask & (1 << bit):
+                continue
+            if fmt == 'S':
+                (n,) = STRING_LENGTH.unpack_from(payload, pos)
+                pos += STRING_LENGTH.size
+                s = str(payload[pos:pos+2*n], 'utf-16-le').rstrip('\0')
+                pos += 2 * n
+                if name == 'name':
+                    names[slot] = s
+                continue
+            (value,) = struct.unpack_from('<' + fmt, payload, pos)
+            pos += struct.calcsize(fmt)
+            col = columns.get(name)
+            if col is not None:
+                col[slot] = value
+
+    if pos > end:
+        raise ProtocolError('Truncated object update')
+
+
+SAMPLE_PACKETS = {
+    'difficulty': (PacketType.DifficultyPacket.value,
+                   memoryview(struct.pack('<II', 5, 0))),
+    'version':    (PacketType.VersionPacket.value,
+                   memoryview(struct.pack('<IfIII', 0, 2.7, 2, 7, 1))),
+    'welcome':    (PacketType.WelcomePacket.value,
+                   memoryview(b'You have connected to Artemis server')),
+}
+
+
+def timePerCall(func, number):
+    """Return the best time per call of func in seconds."""
+
+    t = min(timeit.repeat(func, number=number, repeat=5))
+    return t / number
+
+
+def benchDispatch():
+    """Per-packet dispatch cost of ArtemisClientProtocol.handlePacket."""
+
+    number = 200000
+
+    for (name, cls) in (('registry', ArtemisClientProtocol),
+                        ('profiled', lambda conn: ArtemisClientProtocol(
+                            conn, profile=TrafficProfile(PacketType))),
+                        ('if/elif', ChainProtocol)):
+        proto = cls(None)
+        proto.handler = NullClientHandler(proto)
+        for (pname, (ptype, payload)) in SAMPLE_PACKETS.items():
+            handle = proto.handlePacket
+            t = timePerCall(lambda: handle(ptype, payload), number)
+            print('dispatch  %-8s  %-10s  %7.3f us/packet' %
+                  (name, pname, 1.0e6 * t))
+
+
+def benchFraming():
+    """Receive and decode throughput of getPacket() and handlePacket()
+    over a local socket pair."""
+
+    npackets = 300000
+
+    # Mostly small packets, with an occasional large one.
+    block = b''.join(
+        [ formatPacket(ptype, bytes(payload))
+          for (ptype, payload) in SAMPLE_PACKETS.values() ] * 20
+        + [ formatPacket(0x80803df9, bytes(4000)) ])
+    nblock = 3 * 20 + 1
+    nrepeat = npackets // nblock
+    stream = block * nrepeat
+
+    # Overlay-style subscription to two of the four packet types.
+    subscription = (PacketType.DifficultyPacket.value,
+                    PacketType.VersionPacket.value)
+
+    for (name, decode, ptypes) in (
+            ('getPacket', False, None),
+            ('getPacket+handlePacket', True, None),
+            ('subscribed+handlePacket', True, subscription)):
+
+        (rsock, wsock) = socket.socketpair()
+        def send():
+            wsock.sendall(stream)
+            wsock.close()
+        sender = threading.Thread(target=send)
+
+        conn = ArtemisClientConnection(None)
+        conn.sock = rsock
+        proto = ArtemisClientProtocol(conn, ptypes=ptypes)
+        proto.handler = NullClientHandler(proto)
+        handle = proto.handlePacket
+        getPacket = conn.getPacket
+
+        t0 = time.perf_counter()
+        sender.start()
+        while True:
+            pkt = getPacket()
+            if pkt is None:
+                break
+            if decode:
+                handle(*pkt)
+        t1 = time.perf_counter()
+
+        sender.join()
+
+        print('framing   %-23s  %9.0f packets/s  %7.1f MB/s' %
+              (name, nblock * nrepeat / (t1 - t0),
+               1.0e-6 * len(stream) / (t1 - t0)))
+
+
+def benchWorld():
+    """Object update decoding into the world state, and snapshot cost."""
+
+    rnd = random.Random(0)
+    payloads = [ memoryview(SimServer.renderObjectUpdate(rnd, 1400))
+                 for i in range(64) ]
+    nrecords = sum(len(decodeObjectRecords(payload)) for payload in payloads)
+
+    worlds = { }
+    for (name, decode) in (('layouts', decodeObjectUpdate),
+                           ('naive', naiveObjectUpdate)):
+        world = worlds[name] = WorldState()
+        def decodeAll():
+            for payload in payloads:
+                decode(payload, world)
+        t = timePerCall(decodeAll, 20)
+        print('world     decode %-8s %5d objects  %7.3f us/record  '
+              '%9.0f records/s' %
+              (name, len(world), 1.0e6 * t / nrecords, nrecords / t))
+
+    assert (worlds['layouts'].snapshot().columns ==
+            worlds['naive'].snapshot().columns)
+
+    def decodeColumns():
+        for payload in payloads:
+            decodeObjectRecords(payload)
+    t = timePerCall(decodeColumns, 20)
+    print('world     decode %-8s %5d objects  %7.3f us/record  '
+          '%9.0f records/s' %
+          ('columns', len(world), 1.0e6 * t / nrecords, nrecords / t))
+
+    t = timePerCall(world.snapshot, 2000)
+    print('world     snapshot          %5d objects  %7.3f us/snapshot' %
+          (len(world), 1.0e6 * t))
+
+
+def benchSend():
+    """Throughput of sendPacket() for small packets over a local
+    socket pair, unbatched and batched."""
+
+    npackets = 200000
+    payload = struct.pack('<III', 0x3c, 1, 0)
+
+    def drain(sock):
+        buf = bytearray(65536)
+        while sock.recv_into(buf):
+            pass
+
+    def sendConcat(conn):
+        # Reference: one sendall() of header + payload per packet.
+        for i in range(npackets):
+            conn.sock.sendall(formatPacket(0x4c821d3c, payload,
+                                           ConnectionType.Client))
+
+    def sendQueued(conn):
+        sendPacket = conn.sendPacket
+        for i in range(npackets):
+            sendPacket(0x4c821d3c, payload)
+        conn.flush()
+
+    for (name, flushBytes, send) in (('concat', 0, sendConcat),
+                                     ('unbatched', 0, sendQueued),
+                                     ('batched', 16384, sendQueued)):
+
+        (rsock, wsock) = socket.socketpair()
+        receiver = threading.Thread(target=drain, args=(rsock,))
+        receiver.start()
+
+        conn = ArtemisClientConnection(None, flushBytes=flushBytes)
+        conn.sock = wsock
+
+        t0 = time.perf_counter()
+        send(conn)
+        t1 = time.perf_counter()
+
+        wsock.shutdown(socket.SHUT_WR)
+        receiver.join()
+        wsock.close()
+        rsock.close()
+
+        print('send      %-10s  %9.0f packets/s  %7.3f us/packet' %
+              (name, npackets / (t1 - t0), 1.0e6 * (t1 - t0) / npackets))
+
+
+def benchRelay():
+    """Relay throughput to several subscribers over local sockets."""
+
+    rnd = random.Random(0)
+    block = b''.join(
+        formatPacket(PacketType.ObjectBitStreamPacket.value,
+                     SimServer.renderObjectUpdate(rnd, 400))
+        for i in range(1000))
+    nrepeat = 100
+    npackets = 1000 * nrepeat
+
+    def consume(sock):
+        client = RelayClient(sock)
+        for pkt in client.packets():
+            pass
+        client.close()
+
+    for nsubscribers in (1, 8):
+
+        (upstream, feed) = socket.socketpair()
+        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listensock.bind(('127.0.0.1', 0))
+        listensock.listen(nsubscribers)
+        relay = PacketRelay(upstream, listensock, maxlag=1 << 30)
+
+        consumers = [ ]
+        for i in range(nsubscribers):
+            sock = socket.create_connection(listensock.getsockname())
+            consumers.append(threading.Thread(target=consume, args=(sock,)))
+            consumers[-1].start()
+        while (len(relay.subscribers) < nsubscribers or
+               not all(sub.subscribed for sub in relay.subscribers)):
+            relay.step()
+
+        def send():
+            feed.sendall(block * nrepeat)
+            feed.close()
+        sender = threading.Thread(target=send)
+        t0 = time.perf_counter()
+        sender.start()
+        relay.run()
+        sender.join()
+        for th in consumers:
+            th.join()
+        t1 = time.perf_counter()
+        listensock.close()
+
+        # Subscribers run in this process and compete for the GIL.
+        print('relay     %d subscribers  %9.0f packets/s upstream  '
+              '%9.0f packets/s delivered' %
+              (nsubscribers, npackets / (t1 - t0),
+               nsubscribers * npackets / (t1 - t0)))
+
+
+BENCHMARKS = {
+    'dispatch': benchDispatch,
+    'framing':  benchFraming,
+    'world':    benchWorld,
+    'send':     benchSend,
+    'relay':    benchRelay,
+}
+
+
+def main():
+
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        if name not in BENCHMARKS:
+            print(__doc__, file=sys.stderr)
+            print('Known benchmarks:', ' '.join(BENCHMARKS), file=sys.stderr)
+            sys.exit(1)
+
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
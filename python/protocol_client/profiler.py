@@ -0,0 +1,148 @@
+"""
+Per-packet-type traffic profile for the protocol client.
+
+For each packet type, the profile counts packets, payload bytes and the
+time spent decoding and handling them, and tracks the inter-arrival
+jitter. Counters of known packet types are allocated up front; unknown
+types go to an overflow map of bounded size. Recording a packet costs
+one dict lookup and a few additions, so the profile can stay enabled.
+"""
+
+import itertools
+import time
+
+
+class PtypeCounters:
+    """Counters of one packet type.
+
+    jitter is the smoothed mean deviation between consecutive
+    inter-arrival gaps, as for RTP (RFC 3550, with gain 1/16).
+    """
+
+    __slots__ = ('ptype', 'name', 'npackets', 'nbytes', 'decodeTime',
+                 'tfirst', 'tlast', 'gap', 'jitter')
+
+    def __init__(self, ptype, name=None):
+        self.ptype = ptype
+        self.name = name or '0x%08x' % ptype
+        self.npackets = 0
+        self.nbytes = 0
+        self.decodeTime = 0.0
+        self.tfirst = None
+        self.tlast = None
+        self.gap = None
+        self.jitter = 0.0
+
+    def summary(self):
+        """Return a dict of the counters (times in seconds)."""
+
+        n = self.npackets
+        span = self.tlast - self.tfirst if n > 1 else 0.0
+        return {
+            'ptype':        '0x%08x' % self.ptype,
+            'name':         self.name,
+            'packets':      n,
+            'bytes':        self.nbytes,
+            'decode':       self.decodeTime,
+            'decodeMean':   self.decodeTime / n if n else 0.0,
+            'gapMean':      span / (n - 1) if n > 1 else 0.0,
+            'jitter':       self.jitter,
+        }
+
+
+class TrafficProfile:
+    """Traffic counters per packet type.
+
+    known is an iterable of packet types with value and name (such as
+    the PacketType enum). At most MAX_OVERFLOW unknown types are counted
+    separately; further ones are lumped together as 'other'.
+    """
+
+    MAX_OVERFLOW = 256
+
+    def __init__(self, known=()):
+        self.counters = { pt.value: PtypeCounters(pt.value, pt.name)
+                          for pt in known }
+        self.overflow = { }
+        self.other = PtypeCounters(0, 'other')
+        self.tstart = time.perf_counter()
+
+    def unknown(self, ptype):
+        """Return the counters of a packet type that is not known."""
+
+        counters = self.overflow.get(ptype)
+        if counters is None:
+            if len(self.overflow) >= self.MAX_OVERFLOW:
+                return self.other
+            counters = self.overflow[ptype] = PtypeCounters(ptype)
+        return counters
+
+    def record(self, ptype, nbytes, tarrival, tdecode):
+        """Count one packet that arrived at tarrival (perf_counter())
+        and took tdecode seconds to decode and handle."""
+
+        c = self.counters.get(ptype)
+        if c is None:
+            c = self.unknown(ptype)
+        c.npackets += 1
+        c.nbytes += nbytes
+        c.decodeTime += tdecode
+        tlast = c.tlast
+        c.tlast = tarrival
+        if tlast is None:
+            c.tfirst = tarrival
+            return
+        gap = tarrival - tlast
+        if c.gap is not None:
+            c.jitter += (abs(gap - c.gap) - c.jitter) / 16
+        c.gap = gap
+
+    def active(self):
+        """Return the counters of all packet types seen so far."""
+
+        return [ c for c in itertools.chain(self.counters.values(),
+                                            self.overflow.values(),
+                                            (self.other,))
+                 if c.npackets ]
+
+    def summary(self):
+        """Return a dict with the elapsed time and a list of per-type
+        counters, by decreasing byte count."""
+
+        return {
+            'elapsed': time.perf_counter() - self.tstart,
+            'ptypes': [ c.summary() for c in
+                        sorted(self.active(), key=lambda c: -c.nbytes) ],
+        }
+
+    def report(self, top=10):
+        """Return a text table of the top packet types by bytes."""
+
+        summary = self.summary()
+        elapsed = max(summary['elapsed'], 1.0e-9)
+        ptypes = summary['ptypes']
+        totalBytes = max(1, sum(s['bytes'] for s in ptypes))
+        totalDecode = max(1.0e-9, sum(s['decode'] for s in ptypes))
+
+        lines = [ '%-22s %9s %9s %10s %8s %6s %9s %6s %9s' %
+                  ('ptype', 'packets', 'pkts/s', 'bytes', 'kB/s', 'bytes%',
+                   'us/pkt', 'cpu%', 'jitter ms') ]
+        for s in ptypes[:top]:
+            lines.append('%-22s %9d %9.1f %10d %8.1f %6.1f %9.2f %6.1f %9.3f' %
+                         (s['name'], s['packets'], s['packets'] / elapsed,
+                          s['bytes'], 1.0e-3 * s['bytes'] / elapsed,
+                          100.0 * s['bytes'] / totalBytes,
+                          1.0e6 * s['decodeMean'],
+                          100.0 * s['decode'] / totalDecode,
+                          1.0e3 * s['jitter']))
+        if len(ptypes) > top:
+            lines.append('(%d more packet types)' % (len(ptypes) - top))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Write the summary as JSON (times in seconds)."""
+
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write('\n')
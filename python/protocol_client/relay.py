@@ -0,0 +1,447 @@
+#!/usr/bin/python3
+
+"""
+Relay one Artemis server connection to many local subscribers.
+
+Usage: relay.py [options] <serveripaddr>
+
+The relay keeps a single connection to the server, checks every packet
+header once, and forwards the raw packets to local subscribers on a Unix
+socket (--listen) or a localhost TCP port (--port).
+
+A subscriber first sends one line with the packet types it wants, as
+hexadecimal numbers separated by spaces, or an empty line for all
+packets. It then receives a stream in capture file format: CAPTURE_MAGIC
+followed by one record per packet, each a receive timestamp and the raw
+packet. Subscribers that fall more than --max-lag bytes behind are
+disconnected, so they never stall the server connection. When the server
+closes the connection, the relay sends the remaining queued packets to
+each subscriber before closing it.
+"""
+
+import sys
+import optparse
+import os
+import selectors
+import socket
+import time
+
+from testcli import (dbg, setupLogging, LOG_LEVELS,
+                     ProtocolError, ConnectionType, PacketFramer,
+                     PacketSendQueue, PACKET_HEADER,
+                     CAPTURE_MAGIC, CAPTURE_RECORD, checkPacketHeader)
+
+
+def parseSubscription(line):
+    """Parse a subscription line into a frozenset of packet types,
+    or None for all packets."""
+
+    words = line.split()
+    if not words:
+        return None
+    return frozenset(int(w, 16) for w in words)
+
+
+class RelaySubscriber:
+    """Local subscriber connection."""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.rxbuf = b''
+        self.subscribed = False
+        self.ptypes = None
+        self.txqueue = PacketSendQueue(ConnectionType.Server)
+        self.closed = False
+        self.npackets = 0
+
+
+class PacketRelay:
+    """Fan out packets from one server connection to local subscribers.
+
+    All sockets stay in non-blocking mode. Each batch of packets received
+    from the server is rendered once per distinct subscription and the
+    same buffer is queued for all subscribers with that subscription.
+    """
+
+    # Drop subscribers that send longer subscription lines.
+    MAX_LINE_LEN = 4096
+
+    # Close subscribers that have not taken their queued packets this
+    # long after the server closed the connection.
+    DRAIN_TIMEOUT = 10.0
+
+    def __init__(self, upstream, listensock, maxlag=4*1024*1024):
+        self.upstream = upstream
+        self.listensock = listensock
+        self.maxlag = maxlag
+        self.framer = PacketFramer(ConnectionType.Server)
+        self.subscribers = set()
+        self.npackets = 0
+        self.nbytes = 0
+        self.ndropped = 0
+        self.upstream.setblocking(False)
+        self.listensock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.upstream, selectors.EVENT_READ, None)
+        self.selector.register(self.listensock, selectors.EVENT_READ, None)
+
+    def run(self):
+        """Relay packets until the server closes the connection and
+        the subscribers have received all queued packets."""
+
+        while self.upstream is not None:
+            self.step()
+
+        deadline = time.monotonic() + self.DRAIN_TIMEOUT
+        while self.subscribers:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                dbg('Closing %d subscribers that did not drain',
+                    len(self.subscribers))
+                break
+            self.step(timeout)
+        self.close()
+
+    def step(self, timeout=None):
+        """Wait for socket events and handle them."""
+
+        for (key, events) in self.selector.select(timeout):
+            sub = key.data
+            if key.fileobj is self.upstream:
+                self.readUpstream()
+            elif key.fileobj is self.listensock:
+                self.acceptSubscribers()
+            else:
+                if events & selectors.EVENT_READ:
+                    self.readSubscriber(sub)
+                if (events & selectors.EVENT_WRITE) and not sub.closed:
+                    self.flushSubscriber(sub)
+
+    def close(self):
+        """Close the server connection and all subscribers, discarding
+        queued packets."""
+
+        for sub in list(self.subscribers):
+            self.closeSubscriber(sub)
+        self.closeUpstream()
+
+    def closeUpstream(self):
+        """Close the server connection and stop accepting subscribers.
+
+        Subscribers are closed once their queued packets are sent.
+        """
+
+        if self.upstream is None:
+            return
+        self.selector.unregister(self.upstream)
+        self.upstream.close()
+        self.upstream = None
+        self.selector.unregister(self.listensock)
+        for sub in list(self.subscribers):
+            if not sub.txqueue.nbytes:
+                self.closeSubscriber(sub)
+
+    def readUpstream(self):
+        """Receive packets from the server and queue them for subscribers."""
+
+        try:
+            n = self.upstream.recv_into(self.framer.writeBuffer())
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            dbg('Server connection error (%s)', exc)
+            self.closeUpstream()
+            return
+        if not n:
+            dbg('Server dropped connection')
+            self.closeUpstream()
+            return
+
+        self.framer.commitWrite(n)
+        start = self.framer.rpos
+        packets = self.framer.splitPackets()
+        if not packets:
+            return
+
+        # Raw packets, including headers, with their packet types.
+        rec = CAPTURE_RECORD.pack(time.monotonic_ns())
+        view = self.framer.view
+        hdrlen = PACKET_HEADER.size
+        frames = [ ]
+        pos = start
+        for (ptype, payload) in packets:
+            plen = hdrlen + len(payload)
+            frames.append((ptype, view[pos:pos+plen]))
+            pos += plen
+        self.npackets += len(frames)
+        self.nbytes += pos - start
+
+        # Render once per distinct subscription: (data, npackets).
+        rendered = { }
+        for sub in list(self.subscribers):
+            if not sub.subscribed:
+                continue
+            entry = rendered.get(sub.ptypes)
+            if entry is None:
+                ptypes = sub.ptypes
+                parts = [ ]
+                for (ptype, frame) in frames:
+                    if ptypes is None or ptype in ptypes:
+                        parts.append(rec)
+                        parts.append(frame)
+                entry = rendered[ptypes] = (b''.join(parts), len(parts) // 2)
+            (data, npackets) = entry
+            if data:
+                sub.npackets += npackets
+                self.send(sub, data)
+
+    def acceptSubscribers(self):
+        """Accept all pending connections."""
+
+        while True:
+            try:
+                conn, addr = self.listensock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                dbg('ERROR: accept failed (%s)', exc)
+                return
+            addr = addr or 'subscriber %d' % conn.fileno()
+            dbg('New subscriber %s', addr)
+            conn.setblocking(False)
+            sub = RelaySubscriber(conn, addr)
+            self.subscribers.add(sub)
+            self.selector.register(conn, selectors.EVENT_READ, sub)
+
+    def closeSubscriber(self, sub):
+        if not sub.closed:
+            sub.closed = True
+            self.selector.unregister(sub.sock)
+            sub.sock.close()
+            self.subscribers.discard(sub)
+            sub.txqueue.clear()
+
+    def readSubscriber(self, sub):
+        """Read the subscription line, or notice a closed connection."""
+
+        try:
+            w = sub.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            dbg('Subscriber %s error (%s)', sub.addr, exc)
+            self.closeSubscriber(sub)
+            return
+        if not w:
+            dbg('Subscriber %s closed connection after %d packets',
+                sub.addr, sub.npackets)
+            self.closeSubscriber(sub)
+            return
+        if sub.subscribed:
+            # Ignore anything after the subscription line.
+            return
+        sub.rxbuf += w
+        (line, sep, rest) = sub.rxbuf.partition(b'\n')
+        if not sep:
+            if len(sub.rxbuf) > self.MAX_LINE_LEN:
+                dbg('Subscriber %s sent too long line, dropping', sub.addr)
+                self.closeSubscriber(sub)
+            return
+        try:
+            sub.ptypes = parseSubscription(line)
+        except ValueError:
+            dbg('Subscriber %s sent invalid subscription %r, dropping',
+                sub.addr, line)
+            self.closeSubscriber(sub)
+            return
+        sub.subscribed = True
+        sub.rxbuf = b''
+        dbg('Subscriber %s subscribed to %s', sub.addr,
+            'all packets' if sub.ptypes is None else
+            ' '.join('0x%08x' % ptype for ptype in sorted(sub.ptypes)))
+        self.send(sub, CAPTURE_MAGIC)
+
+    def send(self, sub, data):
+        """Queue data for sending to the subscriber.
+
+        The data is shared between subscribers and not copied.
+        """
+
+        if sub.closed:
+            return
+        queue = sub.txqueue
+        wasEmpty = not queue.nbytes
+        queue.append(data)
+        if wasEmpty:
+            self.flushSubscriber(sub)
+            if sub.closed:
+                return
+            if queue.nbytes:
+                self.selector.modify(
+                    sub.sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                    sub)
+        if queue.nbytes > self.maxlag:
+            dbg('Subscriber %s lags %d bytes behind, dropping',
+                sub.addr, queue.nbytes)
+            self.ndropped += 1
+            self.closeSubscriber(sub)
+
+    def flushSubscriber(self, sub):
+        """Send queued data to a writable subscriber."""
+
+        queue = sub.txqueue
+        try:
+            if hasattr(sub.sock, 'sendmsg'):
+                n = sub.sock.sendmsg(queue.buffers())
+            else:
+                n = sub.sock.send(queue.bufs[0])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as exc:
+            dbg('Subscriber %s error (%s)', sub.addr, exc)
+            self.closeSubscriber(sub)
+            return
+        queue.consume(n)
+        if not queue.nbytes and self.upstream is None:
+            # Drained after the server closed the connection.
+            self.closeSubscriber(sub)
+            return
+        if not queue.nbytes:
+            self.selector.modify(sub.sock, selectors.EVENT_READ, sub)
+
+
+class RelayClient:
+    """Subscriber side of a relay connection.
+
+    sock is a socket connected to the relay. ptypes is an iterable
+    of packet types to receive, or None for all packets.
+    """
+
+    def __init__(self, sock, ptypes=None, bufsize=1024*1024):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.rpos = 0
+        self.wpos = 0
+        line = b'' if ptypes is None else b' '.join(
+            b'%08x' % ptype for ptype in ptypes)
+        self.sock.sendall(line + b'\n')
+
+    def close(self):
+        self.sock.close()
+
+    def fill(self):
+        """Receive more data. Return False if the relay closed the
+        connection."""
+
+        if self.rpos == self.wpos:
+            (self.rpos, self.wpos) = (0, 0)
+        elif len(self.buf) - self.wpos < 2 * PACKET_HEADER.size:
+            n = self.wpos - self.rpos
+            self.view[:n] = self.view[self.rpos:self.wpos]
+            (self.rpos, self.wpos) = (0, n)
+        n = self.sock.recv_into(self.view[self.wpos:])
+        self.wpos += n
+        return n > 0
+
+    def packets(self):
+        """Iterate over relayed packets until the relay closes
+        the connection.
+
+        Yield tuples (tstamp, ptype, payload) as CaptureReplay.packets()
+        does. The payload is a memoryview into the receive buffer and
+        remains valid until the next packet is requested.
+        """
+
+        while self.wpos - self.rpos < len(CAPTURE_MAGIC):
+            if not self.fill():
+                return
+        if self.view[self.rpos:self.rpos+len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ProtocolError('Not a packet relay stream')
+        self.rpos += len(CAPTURE_MAGIC)
+
+        unpackRecord = CAPTURE_RECORD.unpack_from
+        unpackHeader = PACKET_HEADER.unpack_from
+        reclen = CAPTURE_RECORD.size
+        hdrlen = PACKET_HEADER.size
+
+        while True:
+            pos = self.rpos
+            avail = self.wpos - pos
+            if avail >= reclen + hdrlen:
+                (preamb, plen, origin, padding, remain, ptype
+                    ) = unpackHeader(self.buf, pos + reclen)
+                checkPacketHeader(preamb, plen, origin, remain,
+                                  ConnectionType.Server)
+                if avail >= reclen + plen:
+                    (tstamp,) = unpackRecord(self.buf, pos)
+                    self.rpos = pos + reclen + plen
+                    yield (tstamp, ptype,
+                           self.view[pos+reclen+hdrlen:pos+reclen+plen])
+                    continue
+                if len(self.buf) - pos < reclen + plen:
+                    # Make room for the whole record.
+                    self.view[:avail] = self.view[pos:self.wpos]
+                    (self.rpos, self.wpos) = (0, avail)
+            if not self.fill():
+                return
+
+
+def main():
+
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option("--listen", action="store", type="string",
+                      metavar="PATH",
+                      help="Accept subscribers on a Unix socket")
+    parser.add_option("--port", action="store", type="int",
+                      help="Accept subscribers on a localhost TCP port")
+    parser.add_option("--max-lag", action="store", type="int",
+                      default=4*1024*1024, metavar="BYTES",
+                      help="Drop subscribers that lag more than this")
+    parser.add_option("--log-level", action="store", type="choice",
+                      choices=tuple(LOG_LEVELS), default='info',
+                      help="Log messages of this level and above "
+                           "(debug, info, warning, error)")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or not (options.listen or options.port):
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+
+    setupLogging(LOG_LEVELS[options.log_level])
+
+    if options.listen:
+        if os.path.exists(options.listen):
+            os.unlink(options.listen)
+        listensock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listensock.bind(options.listen)
+        dbg('Accepting subscribers on %s', options.listen)
+    else:
+        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listensock.bind(('127.0.0.1', options.port))
+        dbg('Accepting subscribers on port %d', options.port)
+    listensock.listen(socket.SOMAXCONN)
+
+    dbg('Connecting to server ...')
+    upstream = socket.create_connection((args[0], 2010))
+    dbg('Connected to server')
+
+    relay = PacketRelay(upstream, listensock, options.max_lag)
+    try:
+        relay.run()
+    except (KeyboardInterrupt, ProtocolError) as exc:
+        dbg('Stopping relay (%s)', exc or 'interrupted')
+        relay.close()
+    finally:
+        listensock.close()
+        if options.listen:
+            os.unlink(options.listen)
+
+    dbg('Relayed %d packets, %d bytes; dropped %d subscribers',
+        relay.npackets, relay.nbytes, relay.ndropped)
+
+
+if __name__ == '__main__':
+    main()
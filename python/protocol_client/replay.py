@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+"""
+Replay a packet capture file through the Artemis client protocol.
+
+Usage: replay.py [--realtime] [--quiet] <capturefile>
+
+A capture file is written by "testcli.py --capture <file>"; sessions
+appended with --append are replayed one after the other.
+"""
+
+import sys
+import mmap
+import optparse
+import time
+
+from testcli import (dbg, setupLogging, ProtocolError, ConnectionType,
+                     PACKET_HEADER, CAPTURE_MAGIC, CAPTURE_RECORD,
+                     checkPacketHeader,
+                     ArtemisClientProtocol, ArtemisClientHandler,
+                     NullClientHandler)
+
+
+class CaptureReplay:
+    """Memory-mapped reader for packet capture files."""
+
+    def __init__(self, filename):
+
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+
+        if self.view[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self.close()
+            raise ProtocolError('Not a packet capture file: %s' % filename)
+
+    def close(self):
+        """Unmap and close the capture file.
+
+        Payloads handed out by packets() become invalid.
+        """
+
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            try:
+                self.mm.close()
+            except BufferError:
+                # Payload views still exist; unmapped when they are gone.
+                pass
+            self.file.close()
+
+    def packets(self):
+        """Iterate over captured packets.
+
+        Yield tuples (tstamp, ptype, payload) where tstamp is the
+        monotonic receive time in nanoseconds and payload a memoryview
+        into the mapped file. Timestamps of appended sessions are
+        shifted to follow the previous session directly. A truncated
+        record at the end of the file is ignored.
+        """
+
+        view = self.view
+        unpackRecord = CAPTURE_RECORD.unpack_from
+        unpackHeader = PACKET_HEADER.unpack_from
+        reclen = CAPTURE_RECORD.size
+        hdrlen = PACKET_HEADER.size
+        end = len(view)
+        pos = len(CAPTURE_MAGIC)
+        # An appended session starts with CAPTURE_MAGIC in place of
+        # a record; as a timestamp, it is over a century of uptime.
+        (sessionMark,) = CAPTURE_RECORD.unpack(CAPTURE_MAGIC)
+        shift = 0           # added to the timestamps of this session
+        tlast = None        # last timestamp, shifted
+        newSession = False
+
+        while end - pos >= reclen + hdrlen:
+
+            (tstamp,) = unpackRecord(view, pos)
+            pos += reclen
+            if tstamp == sessionMark:
+                newSession = tlast is not None
+                continue
+            if newSession:
+                shift = tlast - tstamp
+                newSession = False
+            tstamp += shift
+            tlast = tstamp
+
+            (preamb, plen, origin, padding, remain, ptype
+                ) = unpackHeader(view, pos)
+            checkPacketHeader(preamb, plen, origin, remain,
+                              ConnectionType.Server)
+
+            if end - pos < plen:
+                break
+
+            yield (tstamp, ptype, view[pos+hdrlen:pos+plen])
+            pos += plen
+
+    def replay(self, proto, realtime=False):
+        """Feed all captured packets to proto.handlePacket().
+
+        With realtime=True, packets are delivered at the recorded pace.
+        Otherwise they are delivered as fast as possible.
+
+        Return a tuple (npackets, nbytes, elapsed_seconds).
+        """
+
+        handlePacket = proto.handlePacket
+        npackets = 0
+        nbytes = 0
+        tstart = time.monotonic_ns()
+        tfirst = None
+
+        for (tstamp, ptype, payload) in self.packets():
+
+            if realtime:
+                if tfirst is None:
+                    tfirst = tstamp
+                wait = (tstamp - tfirst) - (time.monotonic_ns() - tstart)
+                if wait > 0:
+                    time.sleep(1.0e-9 * wait)
+
+            handlePacket(ptype, payload)
+            npackets += 1
+            nbytes += len(payload)
+
+        elapsed = 1.0e-9 * (time.monotonic_ns() - tstart)
+        return (npackets, nbytes, elapsed)
+
+
+def main():
+
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option("--realtime", action="store_true",
+                      help="Replay packets at the recorded pace")
+    parser.add_option("--quiet", action="store_true",
+                      help="Decode packets without logging them")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+
+    setupLogging()
+    capture = CaptureReplay(args[0])
+
+    proto = ArtemisClientProtocol(None)
+    if options.quiet:
+        proto.handler = NullClientHandler(proto)
+    else:
+        proto.handler = ArtemisClientHandler(proto)
+
+    (npackets, nbytes, elapsed) = capture.replay(proto, options.realtime)
+    capture.close()
+
+    rate = npackets / elapsed if elapsed > 0 else 0.0
+    dbg('Replayed %d packets, %d payload bytes in %.3f s (%.0f packets/s)',
+        npackets, nbytes, elapsed, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+
+"""
+Simulated Artemis server for load testing the protocol client.
+
+Usage: simserver.py [options]
+
+Each client receives a WelcomePacket, VersionPacket and DifficultyPacket,
+followed by a flood of synthetic packets. All packets are rendered once
+at startup and sent as slices of a shared buffer.
+"""
+
+import sys
+import optparse
+import random
+import socket
+import struct
+import threading
+import time
+
+from testcli import (dbg, setupLogging, PacketType, ObjectType,
+                     formatPacket, formatObjectRecord)
+
+
+# Packet type used for synthetic flood packets (object updates).
+FLOOD_PTYPE = PacketType.ObjectBitStreamPacket.value
+
+# Number of distinct object IDs in synthetic object updates.
+FLOOD_OBJECTS = 1000
+
+
+def parseSizeMix(s):
+    """Parse a size mix "size:weight,size:weight,..." into a list
+    of (size, weight) tuples."""
+
+    mix = [ ]
+    for w in s.split(','):
+        (size, weight) = w.split(':')
+        mix.append((int(size), float(weight)))
+    return mix
+
+
+class SimServer:
+    """Listening socket and pre-rendered packet streams."""
+
+    def __init__(self, port, sizemix, rate, count, fragment,
+                 maxclients, seed=0):
+
+        self.port = port
+        self.rate = rate
+        self.count = count
+        self.maxclients = maxclients
+        self.nclients = 0
+        self.lock = threading.Lock()
+
+        rnd = random.Random(seed)
+
+        self.intro = (
+            formatPacket(PacketType.WelcomePacket.value,
+                         b'You have connected to the Artemis simulator') +
+            formatPacket(PacketType.VersionPacket.value,
+                         struct.pack('<IfIII', 0, 2.7, 2, 7, 1)) +
+            formatPacket(PacketType.DifficultyPacket.value,
+                         struct.pack('<II', 5, 0)))
+
+        # Render a block of flood packets according to the size mix.
+        # frameEnds[i] is the end offset of packet i in the block.
+        nframes = 4096
+        sizes = [ s for (s, w) in sizemix ]
+        weights = [ w for (s, w) in sizemix ]
+        frames = [ ]
+        self.frameEnds = [ 0 ]
+        for size in rnd.choices(sizes, weights, k=nframes):
+            payload = self.renderObjectUpdate(rnd, size)
+            frames.append(formatPacket(FLOOD_PTYPE, payload))
+            self.frameEnds.append(self.frameEnds[-1] + len(frames[-1]))
+        self.block = memoryview(b''.join(frames))
+        self.nframes = nframes
+
+        # Pre-computed fragment sizes, or None to send whole batches.
+        if fragment:
+            self.fragments = [ rnd.randint(1, fragment) for i in range(997) ]
+        else:
+            self.fragments = None
+
+        self.srvsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.srvsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srvsock.bind(('', port))
+        self.srvsock.listen(128)
+
+    @staticmethod
+    def renderObjectUpdate(rnd, size):
+        """Return an object update payload of the specified size with
+        random NPC ship and mine positions, padded with zero bytes."""
+
+        records = [ ]
+        n = 0
+        while True:
+            objid = rnd.randrange(1, FLOOD_OBJECTS + 1)
+            pos = { 'x': rnd.uniform(0, 100000), 'y': 0.0,
+                    'z': rnd.uniform(0, 100000) }
+            if objid % 4:
+                pos['heading'] = rnd.uniform(-3.14, 3.14)
+                pos['velocity'] = rnd.uniform(0, 1)
+                rec = formatObjectRecord(ObjectType.NpcShip.value, objid, pos)
+            else:
+                rec = formatObjectRecord(ObjectType.Mine.value, objid, pos)
+            if n + len(rec) > size:
+                break
+            records.append(rec)
+            n += len(rec)
+        return b''.join(records) + bytes(size - n)
+
+    def run(self):
+        """Accept clients until interrupted."""
+
+        dbg('Listening on port %d', self.port)
+        while True:
+            (conn, addr) = self.srvsock.accept()
+            with self.lock:
+                if self.maxclients and self.nclients >= self.maxclients:
+                    dbg('Rejecting client %r: too many clients', addr)
+                    conn.close()
+                    continue
+                self.nclients += 1
+            dbg('New client %r', addr)
+            th = threading.Thread(target=self.serveClient, args=(conn, addr),
+                                  daemon=True)
+            th.start()
+
+    def serveClient(self, conn, addr):
+
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.sendData(conn, self.intro, 0)
+            nsent = self.flood(conn)
+            dbg('Sent %d packets to %r, closing', nsent, addr)
+        except OSError as exc:
+            dbg('Client %r disconnected (%s)', addr, exc)
+        finally:
+            conn.close()
+            with self.lock:
+                self.nclients -= 1
+
+    def sendData(self, conn, data, fragpos):
+        """Send data, split into fragments if configured.
+
+        Return the new position in the fragment size table.
+        """
+
+        if self.fragments is None:
+            conn.sendall(data)
+            return fragpos
+
+        fragments = self.fragments
+        pos = 0
+        while pos < len(data):
+            n = fragments[fragpos]
+            fragpos = (fragpos + 1) % len(fragments)
+            conn.sendall(data[pos:pos+n])
+            pos += n
+        return fragpos
+
+    def flood(self, conn):
+        """Send flood packets until the count is reached.
+
+        Return the number of packets sent.
+        """
+
+        block = self.block
+        frameEnds = self.frameEnds
+        nframes = self.nframes
+
+        # Send in batches of up to 10 ms worth of packets.
+        if self.rate:
+            batch = max(1, int(self.rate / 100))
+            interval = batch / self.rate
+        else:
+            batch = 256
+            interval = 0
+
+        nsent = 0
+        frame = 0
+        fragpos = 0
+        deadline = time.monotonic()
+
+        while (not self.count) or nsent < self.count:
+
+            n = batch
+            if self.count:
+                n = min(n, self.count - nsent)
+            n = min(n, nframes - frame)
+
+            data = block[frameEnds[frame]:frameEnds[frame+n]]
+            fragpos = self.sendData(conn, data, fragpos)
+
+            nsent += n
+            frame = (frame + n) % nframes
+
+            if interval:
+                deadline += interval * n / batch
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+        return nsent
+
+
+def main():
+
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option("--port", action="store", type="int", default=2010,
+                      help="TCP port to listen on (default 2010)")
+    parser.add_option("--rate", action="store", type="float", default=1000,
+                      help="Flood packets per second per client, "
+                           "0 for unlimited (default 1000)")
+    parser.add_option("--sizes", action="store", type="string",
+                      default="40:70,200:25,2000:5",
+                      help="Payload size mix as size:weight,... "
+                           "(default 40:70,200:25,2000:5)")
+    parser.add_option("--count", action="store", type="int", default=0,
+                      help="Close each connection after this many "
+                           "flood packets (default unlimited)")
+    parser.add_option("--fragment", action="store", type="int", default=0,
+                      help="Split the stream in random chunks of "
+                           "1 .. N bytes (default no splitting)")
+    parser.add_option("--max-clients", action="store", type="int",
+                      default=0, dest="maxclients",
+                      help="Maximum number of concurrent clients")
+    (options, args) = parser.parse_args()
+
+    if args:
+        print("ERROR: Unexpected arguments", file=sys.stderr)
+        parser.print_help()
+        sys.exit(1)
+
+    sizemix = parseSizeMix(options.sizes)
+    if any(size + 24 > 65536 for (size, weight) in sizemix):
+        print("ERROR: Payload size too large", file=sys.stderr)
+        sys.exit(1)
+
+    setupLogging()
+    srv = SimServer(port=options.port,
+                    sizemix=sizemix,
+                    rate=options.rate,
+                    count=options.count,
+                    fragment=options.fragment,
+                    maxclients=options.maxclients)
+    srv.run()
+
+
+if __name__ == '__main__':
+    main()
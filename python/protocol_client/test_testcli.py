@@ -0,0 +1,297 @@
+"""
+Tests of packet framing, queueing and payload decoding.
+
+Run with: python3 -m unittest test_testcli (or pytest)
+"""
+
+import os
+import socket
+import struct
+import tempfile
+import time
+import unittest
+
+from testcli import (
+    ArtemisClientConnection, ArtemisClientProtocol, CaptureWriter,
+    ConnectionType, NullClientHandler, ObjectType, PacketFramer,
+    PacketSendQueue, PacketType, ProtocolError, decodeObjectRecords,
+    decodeVersion, formatObjectRecord, formatPacket)
+from profiler import TrafficProfile
+from replay import CaptureReplay
+
+
+def feed(framer, data):
+    """Write data into the framer and return the split packets as
+    (ptype, bytes)."""
+
+    buf = framer.writeBuffer()
+    buf[:len(data)] = data
+    framer.commitWrite(len(data))
+    return [ (ptype, bytes(payload))
+             for (ptype, payload) in framer.splitPackets() ]
+
+
+class PacketFramerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.framer = PacketFramer(ConnectionType.Server)
+        self.packets = [
+            (PacketType.WelcomePacket.value, b'hello'),
+            (PacketType.DifficultyPacket.value, struct.pack('<II', 3, 1)),
+            (PacketType.VersionPacket.value, b''),
+        ]
+        self.stream = b''.join(formatPacket(ptype, payload)
+                               for (ptype, payload) in self.packets)
+
+    def testWhole(self):
+        self.assertEqual(feed(self.framer, self.stream), self.packets)
+
+    def testByteByByte(self):
+        packets = [ ]
+        for i in range(len(self.stream)):
+            packets += feed(self.framer, self.stream[i:i+1])
+        self.assertEqual(packets, self.packets)
+
+    def testSplitHeader(self):
+        # Split in the middle of the second header.
+        split = len(formatPacket(*self.packets[0])) + 10
+        self.assertEqual(feed(self.framer, self.stream[:split]),
+                         self.packets[:1])
+        self.assertEqual(feed(self.framer, self.stream[split:]),
+                         self.packets[1:])
+
+    def testSubscribe(self):
+        self.framer.ptypes = frozenset([ PacketType.DifficultyPacket.value ])
+        self.assertEqual(feed(self.framer, self.stream), self.packets[1:2])
+
+    def testBadPreamble(self):
+        data = bytearray(self.stream)
+        data[0] ^= 0xff
+        with self.assertRaises(ProtocolError):
+            feed(self.framer, data)
+
+    def testBadOrigin(self):
+        data = formatPacket(1, b'x', origin=ConnectionType.Client)
+        with self.assertRaises(ProtocolError):
+            feed(self.framer, data)
+
+    def testWrapAround(self):
+        # Enough partial packets to move data to the start of the buffer.
+        pkt = formatPacket(2, bytes(1000))
+        packets = [ ]
+        for i in range(600):
+            packets += feed(self.framer, pkt[:500])
+            packets += feed(self.framer, pkt[500:])
+        self.assertEqual(packets, [ (2, bytes(1000)) ] * 600)
+
+
+class PacketSendQueueTest(unittest.TestCase):
+
+    def testPartialWrites(self):
+        queue = PacketSendQueue(ConnectionType.Server)
+        queue.add(1, b'abc')
+        queue.add(2, bytearray(b'defg'))
+        queue.add(3, b'')
+        expect = b''.join([ formatPacket(1, b'abc'),
+                            formatPacket(2, b'defg'),
+                            formatPacket(3, b'') ])
+        sent = b''
+        while queue.nbytes:
+            data = b''.join(queue.buffers())
+            n = min(7, len(data))
+            sent += data[:n]
+            queue.consume(n)
+        self.assertEqual(sent, expect)
+        self.assertEqual(len(queue.bufs), 0)
+
+
+class SendPacketTest(unittest.TestCase):
+
+    def send(self, flushBytes):
+        (rsock, wsock) = socket.socketpair()
+        conn = ArtemisClientConnection(None, flushBytes=flushBytes)
+        conn.sock = wsock
+        conn.sendPacket(1, b'abc')
+        conn.sendPacket(2, memoryview(b'defg'))
+        conn.sendPacket(3, bytes(100))
+        conn.flush()
+        wsock.close()
+        data = b''
+        while True:
+            w = rsock.recv(4096)
+            if not w:
+                break
+            data += w
+        rsock.close()
+        return data
+
+    def testUnbatchedAndBatched(self):
+        expect = b''.join([
+            formatPacket(1, b'abc', ConnectionType.Client),
+            formatPacket(2, b'defg', ConnectionType.Client),
+            formatPacket(3, bytes(100), ConnectionType.Client) ])
+        self.assertEqual(self.send(0), expect)
+        self.assertEqual(self.send(64), expect)
+        self.assertEqual(self.send(65536), expect)
+
+
+class ProfileArrivalTest(unittest.TestCase):
+
+    def testArrivalIsReceiveTime(self):
+        (rsock, wsock) = socket.socketpair()
+        conn = ArtemisClientConnection(None)
+        conn.sock = rsock
+        profile = TrafficProfile(PacketType)
+        proto = ArtemisClientProtocol(conn, profile=profile)
+        proto.handler = NullClientHandler(proto)
+        ptype = PacketType.DifficultyPacket.value
+        wsock.sendall(formatPacket(ptype, struct.pack('<II', 3, 1)) * 2)
+        tarrivals = [ ]
+        for i in range(2):
+            (ptype, payload) = conn.getPacket(1.0)
+            tarrivals.append(conn.tarrival)
+            time.sleep(0.01)
+            proto.handlePacket(ptype, payload, conn.tarrival)
+        conn.close()
+        wsock.close()
+        # Both packets came with one recv, however late they are handled.
+        counters = profile.counters[ptype]
+        self.assertEqual(counters.npackets, 2)
+        self.assertEqual(counters.tfirst, tarrivals[0])
+        self.assertEqual(counters.tlast, tarrivals[0])
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def capture(self, packets, t0, append=False):
+        writer = CaptureWriter(self.filename, append)
+        for (i, payload) in enumerate(packets):
+            writer.writePackets(formatPacket(1, payload), t0 + i)
+        writer.close()
+
+    def replay(self):
+        capture = CaptureReplay(self.filename)
+        packets = [ (tstamp, bytes(payload))
+                    for (tstamp, ptype, payload) in capture.packets() ]
+        capture.close()
+        return packets
+
+    def testOverwrite(self):
+        self.capture([ b'a', b'b' ], 1000)
+        self.capture([ b'c' ], 5000)
+        self.assertEqual(self.replay(), [ (5000, b'c') ])
+
+    def testAppendSessions(self):
+        # The second session follows the first without the gap.
+        self.capture([ b'a', b'b' ], 1000)
+        self.capture([ b'c', b'd' ], 10**12, append=True)
+        self.capture([ b'e' ], 5, append=True)
+        self.assertEqual(self.replay(), [ (1000, b'a'), (1001, b'b'),
+                                          (1001, b'c'), (1002, b'd'),
+                                          (1002, b'e') ])
+
+    def testAppendToOtherFile(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'something else')
+        with self.assertRaises(ProtocolError):
+            CaptureWriter(self.filename, append=True)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), b'something else')
+
+    def testAppendToEmptyFile(self):
+        self.capture([ b'a' ], 7, append=True)
+        self.assertEqual(self.replay(), [ (7, b'a') ])
+
+
+class DecodeVersionTest(unittest.TestCase):
+
+    def testVersion(self):
+        payload = struct.pack('<IfIII', 0, 2.7, 2, 7, 1)
+        self.assertEqual(decodeVersion(payload), ((2, 7, 1),))
+        self.assertEqual(decodeVersion(memoryview(payload + b'xx')),
+                         ((2, 7, 1),))
+
+    def testTruncated(self):
+        with self.assertRaises(struct.error):
+            decodeVersion(struct.pack('<III', 2, 7, 1))
+
+
+class DecodeObjectRecordsTest(unittest.TestCase):
+
+    def decode(self, payload):
+        batch = decodeObjectRecords(payload)
+        columns = batch.columns()
+        return (batch.objtypes, batch.objids,
+                { name: [ v for (row, v) in sorted(zip(*column)) ]
+                  for (name, column) in columns.items() })
+
+    def testFixed(self):
+        mine = ObjectType.Mine.value
+        payload = (formatObjectRecord(mine, 10, { 'x': 1.0, 'z': 3.0 }) +
+                   formatObjectRecord(mine, 11, { 'x': 4.0, 'z': 6.0 }) +
+                   formatObjectRecord(mine, 12, { 'y': 8.0 }))
+        (objtypes, objids, columns) = self.decode(payload)
+        self.assertEqual(objtypes, [ mine ] * 3)
+        self.assertEqual(objids, [ 10, 11, 12 ])
+        self.assertEqual(columns, { 'x': [ 1.0, 4.0 ], 'y': [ 8.0 ],
+                                    'z': [ 3.0, 6.0 ] })
+
+    def testString(self):
+        base = ObjectType.Base.value
+        payload = formatObjectRecord(base, 7, { 'name': 'DS1', 'index': 2,
+                                                'x': 0.5 })
+        (objtypes, objids, columns) = self.decode(payload)
+        self.assertEqual(objids, [ 7 ])
+        self.assertEqual(columns, { 'name': [ 'DS1' ], 'index': [ 2 ],
+                                    'x': [ 0.5 ] })
+
+    def testEndMarker(self):
+        mine = ObjectType.Mine.value
+        payload = (formatObjectRecord(mine, 1, { 'x': 1.0 }) +
+                   b'\0\0\0\0\0' + b'garbage')
+        self.assertEqual(self.decode(payload)[1], [ 1 ])
+
+    def testEmpty(self):
+        self.assertEqual(len(decodeObjectRecords(b'')), 0)
+
+    def testHeaderOnly(self):
+        # Record that ends right after the header, before the bitfield.
+        with self.assertRaises(ProtocolError):
+            decodeObjectRecords(b'\x07' + struct.pack('<I', 5))
+        with self.assertRaises(ProtocolError):
+            decodeObjectRecords(b'\x01' + struct.pack('<I', 5) + b'\x01\x00')
+
+    def testTruncated(self):
+        base = ObjectType.Base.value
+        payload = formatObjectRecord(base, 7, { 'name': 'DS1', 'x': 0.5 })
+        for n in range(1, len(payload)):
+            with self.assertRaises(ProtocolError, msg='length %d' % n):
+                decodeObjectRecords(payload[:n])
+
+    def testTruncatedString(self):
+        base = ObjectType.Base.value
+        payload = (struct.pack('<BI', base, 7) + b'\x01\x00' +
+                   struct.pack('<I', 100) + 'abc\0'.encode('utf-16-le'))
+        with self.assertRaises(ProtocolError):
+            decodeObjectRecords(payload)
+
+    def testUnknownFields(self):
+        mine = ObjectType.Mine.value
+        payload = struct.pack('<BI', mine, 1) + b'\x08' + bytes(16)
+        with self.assertRaises(ProtocolError):
+            decodeObjectRecords(payload)
+
+    def testUnknownType(self):
+        with self.assertRaises(ProtocolError):
+            decodeObjectRecords(struct.pack('<BI', 99, 1) + b'\x01')
+
+
+if __name__ == '__main__':
+    unittest.main()
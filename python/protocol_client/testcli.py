@@ -3,21 +3,41 @@
 """
 Command-line Artemis client for protocol debugging.
 
-Usage: testcli.py <serveripaddr>
+Usage: testcli.py [--capture <file> [--append]] [--profile] <serveripaddr>
 """
 
 import sys
+import collections
 import enum
+import itertools
+import optparse
+import os
 import socket
 import struct
 import time
 
+from world import WorldState
+from profiler import TrafficProfile
 
-def dbg(msg):
-    tstamp = time.time()
-    tstr = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(int(tstamp)))
-    tstr += '.%03d' % max(0, min(999, int(1000 * (tstamp - int(tstamp)))))
-    print(tstr, msg, file=sys.stderr)
+
+# The protocol client shares the log writer of the UI control scripts,
+# one directory up; the path is only extended if it is not importable.
+# dbg() logs at info level; pass the arguments separately rather than
+# formatting msg with them, they are only formatted if enabled.
+try:
+    import logwriter
+except ImportError:
+    sys.path.append(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    import logwriter
+from logwriter import LOG_LEVELS, debug, info as dbg, warn
+
+
+def setupLogging(level=logwriter.INFO, stream=None):
+    """Log messages of level and above through the writer thread,
+    with a timestamp, to stream (default sys.stderr)."""
+
+    logwriter.setup(level, stream or sys.stderr, timestamps=True)
 
 
 class ProtocolError(Exception):
@@ -29,18 +49,296 @@ class ConnectionType(enum.Enum):
     Client = 2
 
 class PacketType(enum.Enum):
+    DestroyObjectPacket = 0xcc5a3e30
     DifficultyPacket = 0x3de66711
+    ObjectBitStreamPacket = 0x80803df9
     VersionPacket = 0xe548e74a
     WelcomePacket = 0x6d04b3da
 
+class ObjectType(enum.Enum):
+    PlayerShip = 1
+    NpcShip = 5
+    Base = 6
+    Mine = 7
+    Anomaly = 8
+    Torpedo = 11
+    BlackHole = 12
+    Asteroid = 13
+
+
+# Packet header: preamble, length, origin, padding, remain, ptype.
+PACKET_HEADER = struct.Struct('<IIIIII')
+PACKET_PREAMBLE = 0xdeadbeef
+MAX_PACKET_LEN = 65536
+
+
+def checkPacketHeader(preamb, plen, origin, remain, expectOrigin):
+    """Check the fields of a received packet header.
+
+    Raise ProtocolError if the header is invalid.
+    """
+
+    if preamb != PACKET_PREAMBLE:
+        raise ProtocolError('Expected preamble 0xdeadbeef but got 0x%08x' %
+                            preamb)
+
+    if plen < PACKET_HEADER.size or plen > MAX_PACKET_LEN:
+        raise ProtocolError('Got invalid packet length %d' % plen)
+
+    if origin != expectOrigin.value:
+        raise ProtocolError('Expected origin=%r but got %d' %
+                            (expectOrigin, origin))
+
+    if remain != plen - 20:
+        raise ProtocolError('Expected remain=%d for plen=%d but got %d' %
+                            (plen - 20, plen, remain))
+
+
+def formatPacket(ptype, payload, origin=ConnectionType.Server):
+    """Return a raw packet, including header, as bytes."""
+
+    plen = PACKET_HEADER.size + len(payload)
+    hdr = PACKET_HEADER.pack(PACKET_PREAMBLE, plen, origin.value,
+                             0, plen - 20, ptype)
+    return hdr + payload
+
+
+class PacketFramer:
+    """Split a stream of received bytes into Artemis packets.
+
+    The framer does not do any I/O. The caller receives data directly
+    into the buffer returned by writeBuffer(), reports the number of
+    bytes with commitWrite(), then calls splitPackets() to obtain all
+    complete packets received so far.
+
+    Payloads are returned as memoryview slices of the internal buffer.
+    They remain valid until the next call to writeBuffer().
+
+    If ptypes is a set of packet types, other packets are skipped
+    after their header is checked.
+    """
+
+    def __init__(self, origin=ConnectionType.Server,
+                 bufsize=4*MAX_PACKET_LEN):
+
+        assert bufsize >= 2 * MAX_PACKET_LEN
+
+        self.origin = origin
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.rpos = 0       # start of data not yet split into packets
+        self.wpos = 0       # end of received data
+        self.ptypes = None
+
+    def reset(self):
+        """Discard all buffered data."""
+
+        self.rpos = 0
+        self.wpos = 0
+
+    def writeBuffer(self):
+        """Return a writable memoryview of the free space in the buffer.
+
+        The returned buffer always has room for at least one packet
+        of maximum size.
+        """
+
+        if self.rpos == self.wpos:
+            self.rpos = 0
+            self.wpos = 0
+        elif len(self.buf) - self.wpos < MAX_PACKET_LEN:
+            # Move the partial packet to the start of the buffer.
+            n = self.wpos - self.rpos
+            self.view[:n] = self.view[self.rpos:self.wpos]
+            self.rpos = 0
+            self.wpos = n
+
+        return self.view[self.wpos:]
+
+    def commitWrite(self, nbytes):
+        """Add nbytes, just written to the write buffer, to the stream."""
+
+        assert 0 <= nbytes <= len(self.buf) - self.wpos
+        self.wpos += nbytes
+
+    def splitPackets(self):
+        """Return a list of (ptype, payload) for all complete packets
+        in the buffer.
+
+        Raise ProtocolError if an invalid packet header is found.
+        """
+
+        packets = [ ]
+        buf = self.buf
+        view = self.view
+        unpack = PACKET_HEADER.unpack_from
+        hdrlen = PACKET_HEADER.size
+        ptypes = self.ptypes
+        pos = self.rpos
+        end = self.wpos
+
+        while end - pos >= hdrlen:
+
+            (preamb, plen, origin, padding, remain, ptype
+                ) = unpack(buf, pos)
+
+            checkPacketHeader(preamb, plen, origin, remain, self.origin)
+
+            if end - pos < plen:
+                break
+
+            if ptypes is None or ptype in ptypes:
+                packets.append((ptype, view[pos+hdrlen:pos+plen]))
+            pos += plen
+
+        self.rpos = pos
+        return packets
+
+
+# Maximum number of buffers passed to one sendmsg() call.
+MAX_SEND_BUFFERS = 512
+
+
+class PacketSendQueue:
+    """Queue of outgoing Artemis packets.
+
+    The queue does not do any I/O. The caller passes buffers() to a
+    vectored write such as socket.sendmsg() and reports the number of
+    bytes written with consume(), so many packets are sent with one
+    call and without joining them into one buffer. Data that is already
+    formatted, such as relayed packets, is queued with append().
+    """
+
+    def __init__(self, origin=ConnectionType.Client):
+
+        self.origin = origin
+        self.bufs = collections.deque()
+        self.nbytes = 0
+
+    def clear(self):
+        """Discard all queued data."""
+
+        self.bufs.clear()
+        self.nbytes = 0
+
+    def add(self, ptype, payload):
+        """Queue a packet. The payload is not copied if it is bytes."""
+
+        plen = PACKET_HEADER.size + len(payload)
+        self.bufs.append(PACKET_HEADER.pack(PACKET_PREAMBLE, plen,
+                                            self.origin.value, 0,
+                                            plen - 20, ptype))
+        if payload:
+            if not isinstance(payload, bytes):
+                payload = bytes(payload)
+            self.bufs.append(payload)
+        self.nbytes += plen
+
+    def append(self, data):
+        """Queue raw bytes. The data is not copied."""
+
+        self.bufs.append(data)
+        self.nbytes += len(data)
+
+    def buffers(self):
+        """Return a sequence of at most MAX_SEND_BUFFERS buffers with
+        the queued data, in order."""
+
+        if len(self.bufs) <= MAX_SEND_BUFFERS:
+            return self.bufs
+        return list(itertools.islice(self.bufs, MAX_SEND_BUFFERS))
+
+    def consume(self, nbytes):
+        """Remove nbytes, just written, from the start of the queue."""
+
+        assert 0 <= nbytes <= self.nbytes
+        if nbytes == self.nbytes:
+            self.clear()
+            return
+        self.nbytes -= nbytes
+        bufs = self.bufs
+        while nbytes:
+            n = len(bufs[0])
+            if nbytes < n:
+                bufs[0] = memoryview(bufs[0])[nbytes:]
+                break
+            bufs.popleft()
+            nbytes -= n
+
+
+# Capture file: CAPTURE_MAGIC followed by one record per received packet.
+# Each record is a monotonic timestamp in nanoseconds followed by
+# the raw packet, including its header. Each session appended to a
+# capture starts with CAPTURE_MAGIC again, in place of a record; its
+# timestamps are not comparable with those of the previous session.
+CAPTURE_MAGIC = b'ARTCAP01'
+CAPTURE_RECORD = struct.Struct('<q')
+
+
+class CaptureWriter:
+    """Write received packets to a capture file.
+
+    The file is truncated, unless append is set. Appending to a file
+    that is not a capture raises ProtocolError.
+    """
+
+    def __init__(self, filename, append=False):
+
+        if append and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                magic = f.read(len(CAPTURE_MAGIC))
+            if magic and magic != CAPTURE_MAGIC:
+                raise ProtocolError('Not a packet capture file: %s' %
+                                    filename)
+
+        self.file = open(filename, 'ab' if append else 'wb')
+        # Also marks the start of an appended session.
+        self.file.write(CAPTURE_MAGIC)
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+    def writePackets(self, data, tstamp):
+        """Write a block of consecutive raw packets, all received
+        at monotonic time tstamp (in nanoseconds)."""
+
+        assert self.file is not None
+
+        write = self.file.write
+        rec = CAPTURE_RECORD.pack(tstamp)
+        pos = 0
+        while pos < len(data):
+            (plen,) = struct.unpack_from('<I', data, pos + 4)
+            write(rec)
+            write(data[pos:pos+plen])
+            pos += plen
+
 
 class ArtemisClientConnection:
-    """Client side of Artemis network connection."""
+    """Client side of Artemis network connection.
 
-    def __init__(self, serverhost):
+    Sent packets are queued, and sent when at least flushBytes are
+    queued, when flush() is called, or before getPacket() waits for
+    data. With flushBytes=0, every packet is sent immediately.
+    nodelay sets TCP_NODELAY, so small packets are not delayed
+    by the kernel.
+    """
+
+    def __init__(self, serverhost, nodelay=True, flushBytes=0):
 
         self.sock = None
         self.serverhost = serverhost
+        self.nodelay = nodelay
+        self.flushBytes = flushBytes
+        self.sockTimeout = None
+        self.framer = PacketFramer(ConnectionType.Server)
+        self.pending = collections.deque()
+        self.tarrival = None    # perf_counter() when pending was received
+        self.sendQueue = PacketSendQueue(ConnectionType.Client)
+        self.capture = None
 
     def connect(self):
 
@@ -49,6 +347,9 @@ class ArtemisClientConnection:
         dbg('Connecting to server ...')
         serverport = 2010
         self.sock = socket.create_connection((self.serverhost, serverport))
+        self.sockTimeout = None
+        if self.nodelay:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         dbg('Connected to server')
 
     def close(self):
@@ -57,105 +358,547 @@ class ArtemisClientConnection:
             dbg('Closing connection ...')
             self.sock.close()
         self.sock = None
+        self.framer.reset()
+        self.pending.clear()
+        self.sendQueue.clear()
 
     def isConnected(self):
 
         return self.sock is not None
 
-    def getPacket(self, timeout=None):
+    def subscribe(self, ptypes):
+        """Receive only packets of the specified types (None for all).
 
-        assert self.sock is not None
+        Other packets are skipped right after their header is checked.
+        """
 
-        self.sock.settimeout(timeout)
+        self.framer.ptypes = None if ptypes is None else frozenset(ptypes)
+        if self.framer.ptypes is not None:
+            self.pending = collections.deque(
+                pkt for pkt in self.pending if pkt[0] in self.framer.ptypes)
 
-        try:
-            hdr = self.sock.recv(24)
-        except socket.timeout:
-            return None
+    def getPacket(self, timeout=None):
+        """Return the next packet from the server as a tuple (ptype, payload).
 
-        if timeout is not None:
-            self.sock.settimeout(None)
+        Return None if the timeout expires or the server closes
+        the connection. A partially received packet is kept and
+        completed by a later call.
 
-        while len(hdr) < 24:
-            s = self.sock.recv(24 - len(hdr))
-            if not s:
-                dbg('Server dropped connection')
-                self.close()
-                return None
-            hdr += s
+        The payload is a memoryview into the receive buffer.
+        It remains valid until the next call to getPacket().
+        The time it was received (perf_counter()) is in tarrival.
+        """
 
-        assert len(hdr) == 24
+        assert self.sock is not None
 
-        (preamb, plen, origin, padding, remain, ptype
-            ) = struct.unpack('<IIIIII', hdr)
+        if self.pending:
+            return self.pending.popleft()
 
-        if preamb != 0xdeadbeef:
-            raise ProtocolError('Expected preamble 0xdeadbeef but got 0x%08x' %
-                                preamb)
+        if self.sendQueue.nbytes:
+            self.flush()
 
-        if plen < 24 or plen > 65536:
-            raise ProtocolError('Got invalid packet length %d' % plen)
+        if timeout != self.sockTimeout:
+            self.sock.settimeout(timeout)
+            self.sockTimeout = timeout
 
-        if origin != ConnectionType.Server.value:
-            raise ProtocolError('Expected origin=%r but got %d' %
-                                (ConectionType.Server, origin))
+        while True:
 
-        if remain != plen - 20:
-            raise ProtocolError('Expected remain=%d for plen=%d but got %d' %
-                                (remain, plen, remain))
+            try:
+                n = self.sock.recv_into(self.framer.writeBuffer())
+            except socket.timeout:
+                return None
+            tarrival = time.perf_counter()
 
-        payload = b''
-        while len(payload) < plen - 24:
-            s = self.sock.recv(plen - 24 - len(payload))
-            if not s:
+            if not n:
                 dbg('Server dropped connection')
                 self.close()
                 return None
-            payload += s
 
-        return (ptype, payload)
+            self.framer.commitWrite(n)
+            rpos = self.framer.rpos
+            packets = self.framer.splitPackets()
+
+            # Captures include packets skipped by the subscription.
+            if self.capture is not None and self.framer.rpos != rpos:
+                self.capture.writePackets(
+                    self.framer.view[rpos:self.framer.rpos],
+                    time.monotonic_ns())
+
+            if packets:
+                self.tarrival = tarrival
+                self.pending.extend(packets)
+                return self.pending.popleft()
 
     def sendPacket(self, ptype, payload):
+        """Queue a packet to the server, and flush the queue if
+        flushBytes are queued."""
 
         assert self.sock is not None
 
-        preamb = 0xdeadbeef
-        plen = 24 + len(payload)
-        origin = 2
-        padding = 0
-        remain = 4 + len(payload)
+        queue = self.sendQueue
+        if (not queue.nbytes and
+                PACKET_HEADER.size + len(payload) >= self.flushBytes):
+            # Nothing to batch with: one sendall() is cheaper than
+            # going through the queue and sendmsg().
+            if self.sockTimeout is not None:
+                self.sock.settimeout(None)
+                self.sockTimeout = None
+            self.sock.sendall(formatPacket(ptype, payload, queue.origin))
+            return
+
+        queue.add(ptype, payload)
+        if queue.nbytes >= self.flushBytes:
+            self.flush()
 
-        hdr = struct.pack('<IIIII',
-                          preamb, plen, origin, padding, remain, ptype)
+    def flush(self):
+        """Send all queued packets. Block until they are sent."""
 
-        self.sock.send(hdr + payload)
+        assert self.sock is not None
+
+        if self.sockTimeout is not None:
+            self.sock.settimeout(None)
+            self.sockTimeout = None
+
+        queue = self.sendQueue
+        sendmsg = getattr(self.sock, 'sendmsg', None)
+        while queue.nbytes:
+            if sendmsg is not None:
+                n = sendmsg(queue.buffers())
+            else:
+                # No sendmsg() on Windows.
+                n = self.sock.send(b''.join(queue.buffers()))
+            queue.consume(n)
+
+
+def structDecoder(fmt, prefix=False, packed=False):
+    """Return a payload decoder for a fixed binary layout.
+
+    The decoder returns the tuple of arguments for the handler method,
+    or raises struct.error if the payload does not match the layout.
+
+    prefix=True accepts payloads with trailing data after the layout.
+    packed=True passes the decoded values as one tuple argument.
+    """
+
+    s = struct.Struct(fmt)
+    unpack = s.unpack_from if prefix else s.unpack
+    if not packed:
+        return unpack
+    return lambda payload: (unpack(payload),)
+
+
+def decodeString(payload):
+    """Decode a payload consisting of a single latin-1 string."""
+
+    return (str(payload, 'latin-1'),)
+
+
+# VersionPacket: unknown, legacy float version, major, minor, patch.
+VERSION_LAYOUT = struct.Struct('<IfIII')
+
+
+def decodeVersion(payload):
+    """Decode a VersionPacket into a (major, minor, patch) argument."""
+
+    return (VERSION_LAYOUT.unpack_from(payload)[2:],)
+
+
+def decodeRaw(payload):
+    """Pass the payload on undecoded."""
+
+    return (payload,)
+
+
+ObjectLayout = collections.namedtuple('ObjectLayout', ('nbytes', 'fields'))
+
+# Object update layouts: bitfield length in bytes and the fields as
+# (name, format) in bit order. Format 'S' is a string (32-bit character
+# count, then UTF-16LE characters including a terminating NUL); other
+# formats are struct format characters. Only the leading fields of each
+# object type are known; records with later bits set are rejected.
+OBJECT_LAYOUTS = {
+    ObjectType.PlayerShip.value: ObjectLayout(6, (
+        ('target', 'i'), ('impulse', 'f'), ('rudder', 'f'),
+        ('topSpeed', 'f'), ('turnRate', 'f'), ('autoBeams', 'B'),
+        ('warp', 'B'), ('energy', 'f'), ('shieldsUp', 'H'),
+        ('shipNumber', 'i'), ('hullId', 'i'), ('x', 'f'), ('y', 'f'),
+        ('z', 'f'), ('pitch', 'f'), ('roll', 'f'), ('heading', 'f'),
+        ('velocity', 'f'))),
+    ObjectType.NpcShip.value: ObjectLayout(6, (
+        ('name', 'S'), ('impulse', 'f'), ('rudder', 'f'),
+        ('topSpeed', 'f'), ('turnRate', 'f'), ('isEnemy', 'i'),
+        ('hullId', 'i'), ('x', 'f'), ('y', 'f'), ('z', 'f'),
+        ('pitch', 'f'), ('roll', 'f'), ('heading', 'f'),
+        ('velocity', 'f'))),
+    ObjectType.Base.value: ObjectLayout(2, (
+        ('name', 'S'), ('shieldsFront', 'f'), ('shieldsRear', 'f'),
+        ('index', 'i'), ('hullId', 'i'), ('x', 'f'), ('y', 'f'),
+        ('z', 'f'))),
+    ObjectType.Mine.value: ObjectLayout(1, (
+        ('x', 'f'), ('y', 'f'), ('z', 'f'))),
+    ObjectType.Anomaly.value: ObjectLayout(1, (
+        ('x', 'f'), ('y', 'f'), ('z', 'f'), ('anomalyType', 'i'))),
+    ObjectType.Torpedo.value: ObjectLayout(1, (
+        ('x', 'f'), ('y', 'f'), ('z', 'f'), ('dx', 'f'), ('dy', 'f'),
+        ('dz', 'f'), ('target', 'i'), ('origin', 'i'))),
+    ObjectType.BlackHole.value: ObjectLayout(1, (
+        ('x', 'f'), ('y', 'f'), ('z', 'f'))),
+    ObjectType.Asteroid.value: ObjectLayout(1, (
+        ('x', 'f'), ('y', 'f'), ('z', 'f'))),
+}
+
+OBJECT_HEADER = struct.Struct('<BI')
+STRING_LENGTH = struct.Struct('<I')
+
+
+def formatObjectRecord(objtype, objid, values):
+    """Return an object update record for the fields in a dict."""
+
+    layout = OBJECT_LAYOUTS[objtype]
+    mask = 0
+    data = [ ]
+    for (bit, (name, fmt)) in enumerate(layout.fields):
+        if name not in values:
+            continue
+        mask |= 1 << bit
+        if fmt == 'S':
+            s = values[name] + '\0'
+            data.append(STRING_LENGTH.pack(len(s)) + s.encode('utf-16-le'))
+        else:
+            data.append(struct.pack('<' + fmt, values[name]))
+    return (OBJECT_HEADER.pack(objtype, objid) +
+            mask.to_bytes(layout.nbytes, 'little') + b''.join(data))
+
+
+class RecordLayout:
+    """Layout of object update records with one object type and bitfield.
+
+    names are the fields present, in order. segments is a tuple of
+    struct.Struct objects for runs of fixed-size fields, and None
+    for each string field.
+    """
+
+    def __init__(self, objtype, mask):
+
+        layout = OBJECT_LAYOUTS.get(objtype)
+        if layout is None:
+            raise ProtocolError('Unknown object type %d' % objtype)
+        if mask >> len(layout.fields):
+            raise ProtocolError('Unsupported fields 0x%x for object type %d' %
+                                (mask, objtype))
+
+        names = [ ]
+        segments = [ ]
+        fmt = ''
+        for (bit, (name, ftype)) in enumerate(layout.fields):
+            if not mask & (1 << bit):
+                continue
+            names.append(name)
+            if ftype == 'S':
+                if fmt:
+                    segments.append(struct.Struct('<' + fmt))
+                    fmt = ''
+                segments.append(None)
+            else:
+                fmt += ftype
+        if fmt or not segments:
+            segments.append(struct.Struct('<' + fmt))
+
+        self.objtype = objtype
+        self.mask = mask
+        self.names = tuple(names)
+        self.segments = tuple(segments)
+        # Single Struct for records without strings, else None.
+        self.fixed = segments[0] if len(segments) == 1 else None
+
+
+# Cache of RecordLayout by (objtype, mask).
+RECORD_LAYOUTS = { }
+
+
+def recordLayout(objtype, mask):
+    """Return the cached RecordLayout for an object type and bitfield."""
+
+    key = (objtype, mask)
+    layout = RECORD_LAYOUTS.get(key)
+    if layout is None:
+        layout = RECORD_LAYOUTS[key] = RecordLayout(objtype, mask)
+    return layout
+
+
+class ObjectUpdateBatch:
+    """Decoded records of an object update packet in columnar form.
+
+    objtypes and objids have one entry per record. Records are grouped
+    by RecordLayout; groups maps each layout to (rows, values), where
+    rows are record numbers and values the tuples of decoded fields.
+    """
+
+    def __init__(self):
+        self.objtypes = [ ]
+        self.objids = [ ]
+        self.groups = { }
+
+    def __len__(self):
+        return len(self.objids)
+
+    def columns(self):
+        """Return a dict of field name -> (rows, values)."""
+
+        columns = { }
+        for (layout, (rows, values)) in self.groups.items():
+            for (name, column) in zip(layout.names, zip(*values)):
+                (crows, cvalues) = columns.setdefault(name, ([ ], [ ]))
+                crows.extend(rows)
+                cvalues.extend(column)
+        return columns
+
+    def apply(self, world):
+        """Write all records into a WorldState."""
+
+        slot = world.slot
+        slots = [ slot(objid, objtype)
+                  for (objid, objtype) in zip(self.objids, self.objtypes) ]
+        names = world.names
+        columns = world.columns
+        for (layout, (rows, values)) in self.groups.items():
+            gslots = [ slots[row] for row in rows ]
+            for (name, column) in zip(layout.names, zip(*values)):
+                col = names if name == 'name' else columns.get(name)
+                if col is None:
+                    continue
+                for (i, value) in zip(gslots, column):
+                    col[i] = value
+
+
+def decodeObjectRecords(payload):
+    """Decode all records of an object update payload.
+
+    Return an ObjectUpdateBatch. The records end at the end of the
+    payload or at objtype 0. Raise ProtocolError if a record can not
+    be decoded.
+    """
+
+    batch = ObjectUpdateBatch()
+    objtypes = batch.objtypes
+    objids = batch.objids
+    groups = batch.groups
+    unpackHeader = OBJECT_HEADER.unpack_from
+    hdrlen = OBJECT_HEADER.size
+    layouts = OBJECT_LAYOUTS
+    cache = RECORD_LAYOUTS
+
+    pos = 0
+    end = len(payload)
+    row = 0
+    try:
+        while pos < end and payload[pos] != 0:
+            (objtype, objid) = unpackHeader(payload, pos)
+            pos += hdrlen
+            base = layouts.get(objtype)
+            if base is None:
+                raise ProtocolError('Unknown object type %d' % objtype)
+            nbytes = base.nbytes
+            if pos + nbytes > end:
+                raise ProtocolError('Truncated object update')
+            if nbytes == 1:
+                mask = payload[pos]
+            else:
+                mask = int.from_bytes(payload[pos:pos+nbytes], 'little')
+            pos += nbytes
+
+            layout = cache.get((objtype, mask))
+            if layout is None:
+                layout = recordLayout(objtype, mask)
+
+            fixed = layout.fixed
+            if fixed is not None:
+                values = fixed.unpack_from(payload, pos)
+                pos += fixed.size
+            else:
+                values = ()
+                for seg in layout.segments:
+                    if seg is not None:
+                        values += seg.unpack_from(payload, pos)
+                        pos += seg.size
+                        continue
+                    (n,) = STRING_LENGTH.unpack_from(payload, pos)
+                    pos += STRING_LENGTH.size
+                    if pos + 2 * n > end:
+                        raise ProtocolError('Truncated object update')
+                    values += (str(payload[pos:pos+2*n],
+                                   'utf-16-le').rstrip('\0'),)
+                    pos += 2 * n
+
+            group = groups.get(layout)
+            if group is None:
+                group = groups[layout] = ([ ], [ ])
+            group[0].append(row)
+            group[1].append(values)
+            objtypes.append(objtype)
+            objids.append(objid)
+            row += 1
+    except struct.error as exc:
+        raise ProtocolError('Truncated object update: %s' % exc) from None
+
+    return batch
+
+
+def decodeObjectUpdate(payload, world):
+    """Apply all records of an object update payload to a WorldState."""
+
+    decodeObjectRecords(payload).apply(world)
+
+
+PacketSchema = collections.namedtuple('PacketSchema',
+                                      ('ptype', 'handler', 'decode'))
+
+# Known packet types received by the client.
+# Each entry maps a packet type to its payload decoder and
+# the name of the ArtemisClientHandler method that receives it.
+PACKET_SCHEMAS = (
+    PacketSchema(PacketType.DestroyObjectPacket, 'handleDestroyObject',
+                 structDecoder('<BI')),
+    PacketSchema(PacketType.DifficultyPacket, 'handleDifficulty',
+                 structDecoder('<II')),
+    PacketSchema(PacketType.ObjectBitStreamPacket, 'handleObjectUpdate',
+                 decodeRaw),
+    PacketSchema(PacketType.VersionPacket, 'handleVersion',
+                 decodeVersion),
+    PacketSchema(PacketType.WelcomePacket, 'handleWelcome',
+                 decodeString),
+)
+
+
+class PacketView:
+    """Received packet, decoded on first access.
+
+    The payload is a memoryview into the receive buffer, valid until
+    the next packet is received. Decoded arguments remain valid.
+    """
+
+    __slots__ = ('ptype', 'payload', 'schema', '_args')
+
+    def __init__(self, ptype, payload, schema):
+        self.ptype = ptype
+        self.payload = payload
+        self.schema = schema
+        self._args = None
+
+    @property
+    def name(self):
+        if self.schema is None:
+            return 'UnknownPacket(0x%08x)' % self.ptype
+        return self.schema.ptype.name
+
+    @property
+    def args(self):
+        """Decoded payload, as tuple of handler arguments.
+
+        Raise ProtocolError if the packet type is unknown.
+        """
+
+        if self._args is None:
+            if self.schema is None:
+                raise ProtocolError('Can not decode unknown packet '
+                                    'ptype=0x%08x' % self.ptype)
+            self._args = self.schema.decode(self.payload)
+        return self._args
+
+    def __getitem__(self, i):
+        return self.args[i]
 
 
 class ArtemisClientProtocol:
-    """Artemis client-side packet parser/formatter."""
+    """Artemis client-side packet parser/formatter.
+
+    If ptypes is a set of packet types, all other packets are ignored.
+    The subscription is passed to the connection, which skips the
+    other packets without decoding or copying them.
 
-    def __init__(self, conn):
+    If profile (a TrafficProfile) is given, each packet passed to
+    handlePacket() is recorded in it with its arrival and decode time.
+    """
+
+    def __init__(self, conn, schemas=PACKET_SCHEMAS, ptypes=None,
+                 profile=None):
         self.conn = conn
-        self.handler = None
+        self.schemas = { schema.ptype.value: schema for schema in schemas }
+        self.dispatch = { }
+        self._handler = None
+        self.ptypes = None if ptypes is None else frozenset(ptypes)
+        if conn is not None and ptypes is not None:
+            conn.subscribe(self.ptypes)
+        self.profile = profile
+        if profile is not None:
+            self.handlePacket = self.profilePacket
+
+    @property
+    def handler(self):
+        return self._handler
+
+    @handler.setter
+    def handler(self, handler):
+        """Set the client message handler and bind its methods
+        into the dispatch table."""
+
+        self._handler = handler
+        self.dispatch = { }
+        if handler is not None:
+            for (ptype, schema) in self.schemas.items():
+                self.dispatch[ptype] = (schema.decode,
+                                        getattr(handler, schema.handler))
+
+    def packetView(self, ptype, payload):
+        """Return a PacketView for a received packet."""
+
+        return PacketView(ptype, payload, self.schemas.get(ptype))
+
+    def getPacketView(self, timeout=None):
+        """Return the next subscribed packet from the connection as
+        PacketView, or None (see ArtemisClientConnection.getPacket())."""
+
+        pkt = self.conn.getPacket(timeout)
+        if pkt is None:
+            return None
+        return PacketView(pkt[0], pkt[1], self.schemas.get(pkt[0]))
 
-    def handlePacket(self, ptype, payload):
-        """Decode received packet and pass it to the client message handler."""
+    def handlePacket(self, ptype, payload, tarrival=None):
+        """Decode received packet and pass it to the client message handler.
 
-        if ptype == PacketType.DifficultyPacket.value and len(payload) == 8:
-            (difficulty, gametype) = struct.unpack('<II', payload)
-            self.handler.handleDifficulty(difficulty, gametype)
+        tarrival is the perf_counter() time the packet was received,
+        for the profile; None means now.
+        """
 
-        elif ptype == PacketType.WelcomePacket.value:
-            msg = payload.decode('latin-1')
-            self.handler.handleWelcome(msg)
+        if self.ptypes is not None and ptype not in self.ptypes:
+            return
 
-        elif ptype == PacketType.VersionPacket and len(payload) == 24:
-            version = struct.unpack('<III', payload)
-            self.handler.handleVersion(version)
+        entry = self.dispatch.get(ptype)
 
-        else:
-            dbg('WARNING: Got unknown packet ptype=0x%08x payload_len=%d' %
-                (ptype, len(payload)))
+        if entry is not None:
+            (decode, handle) = entry
+            try:
+                args = decode(payload)
+                handle(*args)
+                return
+            except (struct.error, ProtocolError) as exc:
+                warn(('decode', ptype),
+                     'WARNING: Can not decode packet ptype=0x%08x '
+                     'payload_len=%d: %s', ptype, len(payload), str(exc))
+                return
+
+        warn(('unknown', ptype),
+             'WARNING: Got unknown packet ptype=0x%08x payload_len=%d',
+             ptype, len(payload))
+
+    def profilePacket(self, ptype, payload, tarrival=None):
+        """handlePacket() with profiling; replaces it if a profile is set."""
+
+        t0 = time.perf_counter()
+        ArtemisClientProtocol.handlePacket(self, ptype, payload)
+        self.profile.record(ptype, len(payload),
+                            t0 if tarrival is None else tarrival,
+                            time.perf_counter() - t0)
 
 
 class ArtemisClientHandler:
@@ -163,38 +906,120 @@ class ArtemisClientHandler:
 
     def __init__(self, proto):
         self.proto = proto
+        self.world = WorldState()
+
+    def handleDestroyObject(self, objtype, objid):
+        self.world.remove(objid)
 
     def handleDifficulty(self, difficulty, gametype):
-        dbg('DifficultyPacket: difficulty=%d gametype=%d' % (difficulty, gametype))    
+        dbg('DifficultyPacket: difficulty=%d gametype=%d',
+            difficulty, gametype)
+
+    def handleObjectUpdate(self, payload):
+        decodeObjectUpdate(payload, self.world)
 
     def handleVersion(self, version):
-        dbg('VersionPacket: %r' % (version,))
+        dbg('VersionPacket: %r', version)
 
     def handleWelcome(self, msg):
-        dbg('WelcomePacket: %r' % (msg,))
+        dbg('WelcomePacket: %r', msg)
+
+
+class NullClientHandler:
+    """Client message handler that ignores all messages."""
+
+    def __init__(self, proto=None):
+        self.proto = proto
+
+    def __getattr__(self, name):
+        if name.startswith('handle'):
+            setattr(self, name, self.ignore)
+            return self.ignore
+        raise AttributeError(name)
+
+    def ignore(self, *args):
+        pass
 
 
 def main():
 
-    if len(sys.argv) != 2:
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option("--capture", action="store", type="string",
+                      help="Write received packets to capture file")
+    parser.add_option("--append", action="store_true",
+                      help="Append to the capture file as a new session "
+                           "instead of overwriting it")
+    parser.add_option("--log-level", action="store", type="choice",
+                      choices=tuple(LOG_LEVELS), default='info',
+                      help="Log messages of this level and above "
+                           "(debug, info, warning, error)")
+    parser.add_option("--profile", action="store_true",
+                      help="Count packets, bytes and decode time "
+                           "per packet type")
+    parser.add_option("--profile-interval", action="store", type="float",
+                      default=10.0, metavar="SECONDS",
+                      help="Log the top packet types this often "
+                           "(default 10)")
+    parser.add_option("--profile-top", action="store", type="int",
+                      default=10, metavar="N",
+                      help="Number of packet types in the table (default 10)")
+    parser.add_option("--profile-file", action="store", type="string",
+                      metavar="FILE",
+                      help="Write the profile as JSON on exit "
+                           "(implies --profile)")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
         print(__doc__, file=sys.stderr)
         sys.exit(1)
 
-    serverhost = sys.argv[1]
+    setupLogging(LOG_LEVELS[options.log_level])
+
+    serverhost = args[0]
 
     conn = ArtemisClientConnection(serverhost)
     conn.connect()
 
-    proto   = ArtemisClientProtocol(conn)
+    if options.capture:
+        dbg('Writing capture to %s', options.capture)
+        conn.capture = CaptureWriter(options.capture, options.append)
+
+    profile = None
+    timeout = None
+    if options.profile or options.profile_file:
+        profile = TrafficProfile(PacketType)
+        timeout = options.profile_interval
+        tnext = time.monotonic() + timeout
+
+    proto   = ArtemisClientProtocol(conn, profile=profile)
     handler = ArtemisClientHandler(proto)
     proto.handler = handler
 
-    while conn.isConnected():
-
-        pkt = conn.getPacket()
-        if pkt is not None:
-            (ptype, payload) = pkt
-            proto.handlePacket(ptype, payload)
+    try:
+        while conn.isConnected():
+
+            pkt = conn.getPacket(timeout)
+            if pkt is not None:
+                (ptype, payload) = pkt
+                debug('Packet ptype=0x%08x payload_len=%d',
+                      ptype, len(payload))
+                proto.handlePacket(ptype, payload, conn.tarrival)
+
+            if (profile is not None and conn.isConnected() and
+                    time.monotonic() >= tnext):
+                dbg('Traffic profile:\n%s',
+                    profile.report(options.profile_top))
+                tnext = time.monotonic() + timeout
+    except KeyboardInterrupt:
+        dbg('Interrupted')
+
+    if conn.capture is not None:
+        conn.capture.close()
+
+    if profile is not None:
+        dbg('Traffic profile:\n%s', profile.report(options.profile_top))
+        if options.profile_file:
+            profile.dump(options.profile_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+"""
+Live model of game objects for the protocol client.
+
+Objects are stored in struct-of-arrays form: one typed array per field,
+indexed by slot, plus a dict from object ID to slot. Updates write into
+the arrays in place, and slots of removed objects are reused. Snapshots
+copy whole columns, which is cheap even with thousands of objects.
+"""
+
+import array
+
+
+# World state columns as (field name, array typecode).
+# Fields of object updates that have no column are not stored.
+WORLD_COLUMNS = (
+    ('objtype',         'B'),
+    ('x',               'f'),
+    ('y',               'f'),
+    ('z',               'f'),
+    ('heading',         'f'),
+    ('velocity',        'f'),
+    ('impulse',         'f'),
+    ('hullId',          'i'),
+    ('shieldsFront',    'f'),
+    ('shieldsRear',     'f'),
+)
+
+
+class WorldSnapshot:
+    """Copy of the world state at one moment.
+
+    ids and the columns are arrays indexed by slot. Free slots
+    have objtype 0.
+    """
+
+    def __init__(self, index, ids, columns, names):
+        self.index = index
+        self.ids = ids
+        self.columns = columns
+        self.names = names
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, objid):
+        """Return the fields of an object as dict, or None."""
+
+        slot = self.index.get(objid)
+        if slot is None:
+            return None
+        obj = { name: col[slot] for (name, col) in self.columns.items() }
+        obj['objid'] = objid
+        obj['name'] = self.names[slot]
+        return obj
+
+    def slots(self):
+        """Return a list of slots in use."""
+
+        return sorted(self.index.values())
+
+
+class WorldState:
+    """Game objects, keyed by object ID."""
+
+    def __init__(self, columns=WORLD_COLUMNS, capacity=256):
+        self.typecodes = columns
+        self.index = { }
+        self.free = [ ]
+        self.nslots = 0
+        self.capacity = capacity
+        self.ids = array.array('I', bytes(4 * capacity))
+        self.columns = { name: array.array(code, [ 0 ]) * capacity
+                         for (name, code) in columns }
+        self.names = [ None ] * capacity
+
+    def __len__(self):
+        return len(self.index)
+
+    def grow(self):
+        """Double the capacity. Arrays are extended in place."""
+
+        n = self.capacity
+        self.ids.extend(array.array('I', bytes(4 * n)))
+        for (name, code) in self.typecodes:
+            self.columns[name].extend(array.array(code, [ 0 ]) * n)
+        self.names.extend([ None ] * n)
+        self.capacity = 2 * n
+
+    def slot(self, objid, objtype):
+        """Return the slot of an object, allocating one if it is new."""
+
+        slot = self.index.get(objid)
+        if slot is not None:
+            return slot
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.nslots == self.capacity:
+                self.grow()
+            slot = self.nslots
+            self.nslots += 1
+        self.index[objid] = slot
+        self.ids[slot] = objid
+        self.columns['objtype'][slot] = objtype
+        return slot
+
+    def update(self, objid, objtype, values):
+        """Set fields of an object from a dict. Unknown fields are ignored."""
+
+        slot = self.slot(objid, objtype)
+        for (name, value) in values.items():
+            if name == 'name':
+                self.names[slot] = value
+                continue
+            col = self.columns.get(name)
+            if col is not None:
+                col[slot] = value
+
+    def remove(self, objid):
+        """Remove an object. Return False if it was not known."""
+
+        slot = self.index.pop(objid, None)
+        if slot is None:
+            return False
+        self.ids[slot] = 0
+        for col in self.columns.values():
+            col[slot] = 0
+        self.names[slot] = None
+        self.free.append(slot)
+        return True
+
+    def clear(self):
+        """Remove all objects, keeping the allocated capacity."""
+
+        for objid in list(self.index):
+            self.remove(objid)
+        self.free = [ ]
+        self.nslots = 0
+
+    def get(self, objid):
+        """Return the fields of an object as dict, or None."""
+
+        return WorldSnapshot(self.index, self.ids, self.columns,
+                             self.names).get(objid)
+
+    def snapshot(self):
+        """Return a WorldSnapshot with copies of all columns."""
+
+        n = self.nslots
+        return WorldSnapshot(self.index.copy(), self.ids[:n],
+                             { name: col[:n]
+                               for (name, col) in self.columns.items() },
+                             self.names[:n])
@@ -0,0 +1,181 @@
+"""
+Screen capture sources and background screenshot writer.
+
+A capture source returns Frame objects. PilGrabSource grabs the screen
+with PIL.ImageGrab; SyntheticSource produces generated frames and works
+on any platform.
+
+ScreenshotWriter encodes and saves frames in background threads, so
+taking a screenshot only costs the screen grab itself.
+"""
+
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import logwriter as log
+
+
+class Frame:
+    """Captured RGB image.
+
+    The pixel data is either RGB bytes or a PIL image; PIL images are
+    converted in the writer thread, off the hot path.
+    """
+
+    def __init__(self, width, height, data):
+        self.width = width
+        self.height = height
+        self.data = data
+
+    def pixels(self):
+        """Return pixel data as RGB bytes, row by row."""
+
+        if isinstance(self.data, (bytes, bytearray, memoryview)):
+            return self.data
+        return self.data.convert('RGB').tobytes()
+
+
+class PilGrabSource:
+    """Capture the screen with PIL.ImageGrab."""
+
+    def __init__(self):
+        import PIL.ImageGrab
+        self.grab = PIL.ImageGrab.grab
+
+    def capture(self, bbox=None):
+        """Capture the screen, or the region (left, top, right, bottom)."""
+
+        img = self.grab(bbox=bbox)
+        return Frame(img.width, img.height, img)
+
+
+class SyntheticSource:
+    """Produce generated frames of a fixed size."""
+
+    def __init__(self, width=1920, height=1080):
+        self.width = width
+        self.height = height
+        # Horizontal gradient with some structure, so PNG has work to do.
+        row = bytes((x * 255 // max(1, width - 1)) & 0xff if c == 0 else
+                    (x * 7) & 0xff if c == 1 else 0x40
+                    for x in range(width) for c in range(3))
+        self.image = b''.join(row[y % 3:] + row[:y % 3] for y in range(height))
+        self.count = 0
+
+    def capture(self, bbox=None):
+        """Return the generated frame, or the region bbox
+        (left, top, right, bottom) of it."""
+
+        self.count += 1
+        if bbox is None:
+            return Frame(self.width, self.height, self.image)
+        (left, top, right, bottom) = bbox
+        rowlen = 3 * self.width
+        data = b''.join(self.image[y*rowlen+3*left:y*rowlen+3*right]
+                        for y in range(top, bottom))
+        return Frame(right - left, bottom - top, data)
+
+
+def pngChunk(ctype, data):
+    chunk = ctype + data
+    return (struct.pack('>I', len(data)) + chunk +
+            struct.pack('>I', zlib.crc32(chunk) & 0xffffffff))
+
+
+def encodePng(frame, level=1):
+    """Encode a frame as PNG with the specified zlib compression level."""
+
+    pixels = frame.pixels()
+    rowlen = 3 * frame.width
+    # Each row is prefixed with filter type 0 (none).
+    raw = b''.join(b'\x00' + pixels[y*rowlen:(y+1)*rowlen]
+                   for y in range(frame.height))
+    ihdr = struct.pack('>IIBBBBB', frame.width, frame.height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' +
+            pngChunk(b'IHDR', ihdr) +
+            pngChunk(b'IDAT', zlib.compress(raw, level)) +
+            pngChunk(b'IEND', b''))
+
+
+def encodePpm(frame, level=None):
+    """Encode a frame as uncompressed binary PPM."""
+
+    return (b'P6\n%d %d\n255\n' % (frame.width, frame.height) +
+            bytes(frame.pixels()))
+
+
+# Screenshot file formats: name -> (file extension, encoder).
+ENCODINGS = {
+    'png': ('png', encodePng),
+    'raw': ('ppm', encodePpm),
+}
+
+
+class ScreenshotWriter:
+    """Encode and save frames in background threads.
+
+    The queue is bounded. When it is full, new frames are dropped
+    instead of blocking the caller.
+    """
+
+    def __init__(self, encoding='png', level=1, directory='.',
+                 prefix='screenshot', nthreads=2, maxqueue=8):
+
+        (self.extension, self.encode) = ENCODINGS[encoding]
+        self.level = level
+        self.directory = directory
+        self.prefix = prefix
+        self.count = 0
+        self.ndropped = 0
+        self.queue = queue.Queue(maxqueue)
+        self.threads = [ threading.Thread(target=self.workerLoop, daemon=True)
+                         for i in range(nthreads) ]
+        for th in self.threads:
+            th.start()
+
+    def submit(self, frame):
+        """Queue a frame for saving. Return the file name, or None
+        if the frame was dropped."""
+
+        self.count += 1
+        filename = os.path.join(self.directory, '%s%04d.%s' %
+                                (self.prefix, self.count, self.extension))
+        try:
+            self.queue.put_nowait((filename, frame))
+        except queue.Full:
+            self.ndropped += 1
+            log.warning("WARNING: Screenshot queue full, dropping %s",
+                        filename)
+            return None
+        return filename
+
+    def workerLoop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                (filename, frame) = item
+                data = self.encode(frame, self.level)
+                with open(filename, 'wb') as f:
+                    f.write(data)
+            except Exception as exc:
+                log.error("ERROR: Can not save screenshot: %s", exc)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until all queued frames are saved."""
+
+        self.queue.join()
+
+    def close(self):
+        """Save remaining frames and stop the worker threads."""
+
+        for th in self.threads:
+            self.queue.put(None)
+        for th in self.threads:
+            th.join()
@@ -0,0 +1,291 @@
+"""
+Bulk screen region readback and visual confirmation of macro steps.
+
+A region source returns a screen region as a NumPy array of shape
+(height, width, 3) with RGB values. Win32RegionSource copies the region
+with one BitBlt into a DIB section; SyntheticScreen plays a timeline of
+generated frames and works on any platform.
+
+ScreenConfirm waits until a region matches a colour or template, or
+changes, instead of sleeping for a fixed worst-case delay.
+"""
+
+import ctypes
+import time
+
+import numpy
+
+from wininput import WinError
+import logwriter as log
+
+
+class BitmapInfoHeader(ctypes.Structure):
+    _fields_ = [
+        ('biSize',          ctypes.c_uint32),
+        ('biWidth',         ctypes.c_int32),
+        ('biHeight',        ctypes.c_int32),
+        ('biPlanes',        ctypes.c_uint16),
+        ('biBitCount',      ctypes.c_uint16),
+        ('biCompression',   ctypes.c_uint32),
+        ('biSizeImage',     ctypes.c_uint32),
+        ('biXPelsPerMeter', ctypes.c_int32),
+        ('biYPelsPerMeter', ctypes.c_int32),
+        ('biClrUsed',       ctypes.c_uint32),
+        ('biClrImportant',  ctypes.c_uint32) ]
+
+
+class Win32RegionSource:
+    """Read screen regions with GDI BitBlt into a DIB section.
+
+    The returned array is a view of the DIB section memory.
+    It remains valid until the next call to capture().
+    """
+
+    SRCCOPY = 0x00cc0020
+    DIB_RGB_COLORS = 0
+    BI_RGB = 0
+
+    def __init__(self):
+
+        self.user32 = ctypes.windll.user32
+        self.gdi32 = ctypes.windll.gdi32
+        for func in (self.user32.GetDC, self.gdi32.CreateCompatibleDC,
+                     self.gdi32.CreateDIBSection, self.gdi32.SelectObject):
+            func.restype = ctypes.c_void_p
+        self.gdi32.BitBlt.argtypes = (
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+            ctypes.c_uint32)
+
+        self.hdcScreen = self.user32.GetDC(None)
+        if not self.hdcScreen:
+            raise WinError("Can not get Device Context for display")
+        self.hdcMem = self.gdi32.CreateCompatibleDC(
+            ctypes.c_void_p(self.hdcScreen))
+        if not self.hdcMem:
+            raise WinError("Can not create memory Device Context")
+
+        self.size = None
+        self.hbmp = None
+        self.pixels = None
+
+    def close(self):
+        """Release system handles."""
+
+        if self.hbmp:
+            self.gdi32.DeleteObject(ctypes.c_void_p(self.hbmp))
+            self.hbmp = None
+        if self.hdcMem:
+            self.gdi32.DeleteDC(ctypes.c_void_p(self.hdcMem))
+            self.hdcMem = None
+        if self.hdcScreen:
+            self.user32.ReleaseDC(None, ctypes.c_void_p(self.hdcScreen))
+            self.hdcScreen = None
+
+    def allocate(self, width, height):
+        """Create a DIB section of the specified size."""
+
+        if self.hbmp:
+            self.gdi32.DeleteObject(ctypes.c_void_p(self.hbmp))
+            self.hbmp = None
+
+        bmi = BitmapInfoHeader()
+        bmi.biSize = ctypes.sizeof(bmi)
+        bmi.biWidth = width
+        bmi.biHeight = -height      # top-down rows
+        bmi.biPlanes = 1
+        bmi.biBitCount = 32
+        bmi.biCompression = self.BI_RGB
+
+        bits = ctypes.c_void_p()
+        hbmp = self.gdi32.CreateDIBSection(ctypes.c_void_p(self.hdcScreen),
+                                           ctypes.byref(bmi),
+                                           self.DIB_RGB_COLORS,
+                                           ctypes.byref(bits),
+                                           None, 0)
+        if not hbmp:
+            raise WinError("Can not create DIB section")
+
+        self.gdi32.SelectObject(ctypes.c_void_p(self.hdcMem),
+                                ctypes.c_void_p(hbmp))
+        self.hbmp = hbmp
+        self.size = (width, height)
+
+        buf = (ctypes.c_uint8 * (4 * width * height)).from_address(bits.value)
+        bgra = numpy.ctypeslib.as_array(buf).reshape((height, width, 4))
+        self.pixels = bgra[:, :, 2::-1]
+
+    def capture(self, bbox):
+        """Return the region (left, top, right, bottom) as RGB array."""
+
+        (left, top, right, bottom) = bbox
+        (width, height) = (right - left, bottom - top)
+        if self.size != (width, height):
+            self.allocate(width, height)
+
+        ok = self.gdi32.BitBlt(self.hdcMem, 0, 0, width, height,
+                               self.hdcScreen, left, top, self.SRCCOPY)
+        if not ok:
+            raise WinError("Can not copy screen region")
+        self.gdi32.GdiFlush()
+
+        return self.pixels
+
+
+class SyntheticScreen:
+    """Synthetic region source that plays a timeline of frames.
+
+    frames is a list of (delay, image) tuples, sorted by delay, where
+    image is a (height, width, 3) uint8 array. capture() returns a region
+    of the last frame whose delay has passed since start().
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.t0 = time.monotonic()
+
+    def start(self):
+        self.t0 = time.monotonic()
+
+    def capture(self, bbox):
+        (left, top, right, bottom) = bbox
+        t = time.monotonic() - self.t0
+        image = self.frames[0][1]
+        for (delay, img) in self.frames:
+            if delay > t:
+                break
+            image = img
+        return image[top:bottom, left:right]
+
+
+def loadPpm(filename):
+    """Load a binary PPM (P6) image as (height, width, 3) uint8 array."""
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    fields = data.split(None, 4)
+    if len(fields) < 5 or fields[0] != b'P6' or fields[3] != b'255':
+        raise ValueError('Not a binary 8-bit PPM file: %s' % filename)
+    (width, height) = (int(fields[1]), int(fields[2]))
+    pixels = numpy.frombuffer(fields[4], dtype=numpy.uint8,
+                              count=3*width*height)
+    return pixels.reshape((height, width, 3))
+
+
+def colorFraction(region, color, tolerance=16):
+    """Return the fraction of pixels within tolerance of an RGB colour."""
+
+    diff = numpy.abs(region.astype(numpy.int16) -
+                     numpy.asarray(color, dtype=numpy.int16))
+    inside = diff.max(axis=2) <= tolerance
+    return numpy.count_nonzero(inside) / inside.size
+
+
+def templateDistance(region, template):
+    """Return the mean absolute difference between region and template."""
+
+    return numpy.abs(region.astype(numpy.int16) -
+                     template.astype(numpy.int16)).mean()
+
+
+def findTemplate(region, template):
+    """Find the best match of a template within a region.
+
+    Return (x, y, distance) for the offset with the smallest mean
+    absolute difference. All offsets are evaluated in one vectorised pass,
+    so the region should be small.
+    """
+
+    (th, tw) = template.shape[:2]
+    windows = numpy.lib.stride_tricks.sliding_window_view(
+        region.astype(numpy.int16), (th, tw, 3))[:, :, 0]
+    dist = numpy.abs(windows - template.astype(numpy.int16)).mean(
+        axis=(2, 3, 4))
+    (y, x) = numpy.unravel_index(numpy.argmin(dist), dist.shape)
+    return (int(x), int(y), float(dist[y, x]))
+
+
+def colorPredicate(color, tolerance=16, minfraction=0.5):
+    """Region predicate: enough pixels have the specified colour."""
+
+    return lambda region: (colorFraction(region, color, tolerance) >=
+                           minfraction)
+
+
+def templatePredicate(template, maxdist=10.0):
+    """Region predicate: region matches the template.
+
+    If the region is larger than the template, the template may
+    match anywhere within the region.
+    """
+
+    def predicate(region):
+        if region.shape == template.shape:
+            return templateDistance(region, template) <= maxdist
+        return findTemplate(region, template)[2] <= maxdist
+    return predicate
+
+
+def changedPredicate(reference, mindist=4.0):
+    """Region predicate: region differs from a reference snapshot."""
+
+    return lambda region: templateDistance(region, reference) >= mindist
+
+
+def waitForRegion(source, bbox, predicate, timeout, interval=0.002):
+    """Poll a screen region until the predicate holds.
+
+    Return the elapsed time in seconds, or None on timeout.
+    """
+
+    t0 = time.monotonic()
+    while True:
+        if predicate(source.capture(bbox)):
+            return time.monotonic() - t0
+        elapsed = time.monotonic() - t0
+        if elapsed >= timeout:
+            return None
+        time.sleep(min(interval, timeout - elapsed))
+
+
+class ScreenConfirm:
+    """Wait for the screen to confirm a macro step.
+
+    With a predicate, wait() returns as soon as the region satisfies it.
+    Without one, wait() returns as soon as the region differs from the
+    reference taken by snapshot(). On timeout, a warning is printed
+    and the macro continues.
+
+    If ready is given, snapshot() calls it first, so that the reference
+    is not taken while the previous macro step is still taking effect
+    (e.g. MacroRunner.waitReady).
+    """
+
+    def __init__(self, name, source, bbox, timeout, predicate=None,
+                 ready=None):
+        self.name = name
+        self.source = source
+        self.bbox = bbox
+        self.timeout = timeout
+        self.predicate = predicate
+        self.ready = ready
+        self.reference = None
+        self.ntimeout = 0
+
+    def snapshot(self):
+        """Store the current region as reference for change detection."""
+
+        if self.ready is not None:
+            self.ready()
+        self.reference = numpy.array(self.source.capture(self.bbox))
+
+    def wait(self):
+        predicate = self.predicate
+        if predicate is None:
+            predicate = changedPredicate(self.reference)
+        elapsed = waitForRegion(self.source, self.bbox, predicate,
+                                self.timeout)
+        if elapsed is None:
+            self.ntimeout += 1
+            log.warning("WARNING: No visual confirmation of %s after %.3f s",
+                        self.name, self.timeout)
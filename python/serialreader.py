@@ -0,0 +1,132 @@
+"""
+Buffered, reconnecting reader for command lines from a serial port.
+
+The reader reads whatever bytes are available in one call, splits them
+into lines in an internal buffer, and timestamps each line on arrival.
+If the device disappears (e.g. USB unplugged), it is reopened with
+exponential backoff until it comes back.
+"""
+
+import time
+
+import logwriter as log
+
+
+class SerialReader:
+    """Read timestamped command lines from a serial device.
+
+    The device is created by opener(), which defaults to opening
+    the port with pyserial. Any object with in_waiting, read(), write()
+    and close() like serial.Serial can be used, e.g. a pty stand-in.
+    Writes time out after the read timeout as well, so write() does
+    not block a caller on another thread for long.
+    """
+
+    # Discard lines longer than this.
+    MAX_LINE_LEN = 4096
+
+    def __init__(self, port, baudrate=38400, timeout=0.1, opener=None,
+                 minbackoff=0.1, maxbackoff=5.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.opener = opener if opener is not None else self.openSerial
+        self.minbackoff = minbackoff
+        self.maxbackoff = maxbackoff
+        self.backoff = minbackoff
+        self.dev = None
+        self.buf = b''
+        self.nreconnect = 0
+        # Set by write() on another thread; readLines() disconnects.
+        self.lost = None
+
+    def openSerial(self):
+        import serial
+        return serial.Serial(port=self.port, baudrate=self.baudrate,
+                             timeout=self.timeout,
+                             write_timeout=self.timeout)
+
+    def connect(self):
+        """Open the device, retrying with backoff until it succeeds."""
+
+        while self.dev is None:
+            try:
+                self.dev = self.opener()
+            except (OSError, ValueError) as exc:
+                # serial.SerialException is a subclass of OSError.
+                log.warning("Can not open serial port %s (%s), "
+                            "retrying in %.1f s",
+                            self.port, exc, self.backoff)
+                time.sleep(self.backoff)
+                self.backoff = min(2 * self.backoff, self.maxbackoff)
+            else:
+                log.info("Opened serial port %s", self.port)
+                self.backoff = self.minbackoff
+                self.buf = b''
+                self.lost = None
+
+    def disconnect(self, reason):
+        if self.dev is not None:
+            log.warning("Serial port %s lost: %s", self.port, reason)
+            try:
+                self.dev.close()
+            except OSError:
+                pass
+            self.dev = None
+            self.nreconnect += 1
+
+    def close(self):
+        self.disconnect("closed")
+
+    def readLines(self):
+        """Wait up to the timeout for input.
+
+        Return a list of (timestamp, line) for all complete lines received,
+        where timestamp is the monotonic arrival time. Reconnect if the
+        device was lost.
+        """
+
+        if self.lost is not None:
+            self.disconnect(self.lost)
+        if self.dev is None:
+            self.connect()
+
+        dev = self.dev
+        try:
+            # Block for the first byte (up to the timeout),
+            # then take everything that is already buffered.
+            data = dev.read(1)
+            if data:
+                n = dev.in_waiting
+                if n:
+                    data += dev.read(n)
+        except OSError as exc:
+            self.disconnect(exc)
+            return [ ]
+
+        if not data:
+            return [ ]
+
+        tstamp = time.monotonic()
+        lines = (self.buf + data).split(b'\n')
+        self.buf = lines.pop()
+        if len(self.buf) > self.MAX_LINE_LEN:
+            log.warning("WARNING: Discarding too long line from serial port")
+            self.buf = b''
+        return [ (tstamp, line) for line in lines ]
+
+    def write(self, data):
+        """Write data to the device; drop it if the device is lost.
+
+        May be called from another thread than readLines(). A failed
+        or timed out write only marks the device as lost; the next
+        readLines() call closes and reopens it.
+        """
+
+        dev = self.dev
+        if dev is None or self.lost is not None:
+            return
+        try:
+            dev.write(data)
+        except OSError as exc:
+            self.lost = exc
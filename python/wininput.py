@@ -0,0 +1,401 @@
+"""
+Input event macros for controlling the game.
+
+An InputMacro is a precompiled timeline of mouse and keyboard events.
+Events scheduled at the same moment are submitted with a single SendInput
+call, and waits are deadline-based: time spent sending events counts
+towards the next wait.
+
+Events are delivered by a backend. SendInputBackend uses Win32 SendInput;
+RecordingBackend only records the events and works on any platform.
+
+InputStuff plays macros through a backend. winstuff.WinStuff adds the
+Win32 display functions; DryRunStuff is a portable stand-in that only
+records (and optionally prints) the events.
+"""
+
+import ctypes
+import time
+
+
+# Win32 constants (from WinUser.h), so this module does not need pywin32.
+INPUT_MOUSE             = 0
+INPUT_KEYBOARD          = 1
+MOUSEEVENTF_MOVE        = 0x0001
+MOUSEEVENTF_LEFTDOWN    = 0x0002
+MOUSEEVENTF_LEFTUP      = 0x0004
+MOUSEEVENTF_RIGHTDOWN   = 0x0008
+MOUSEEVENTF_RIGHTUP     = 0x0010
+MOUSEEVENTF_MIDDLEDOWN  = 0x0020
+MOUSEEVENTF_MIDDLEUP    = 0x0040
+MOUSEEVENTF_ABSOLUTE    = 0x8000
+KEYEVENTF_KEYUP         = 0x0002
+VK_ESCAPE               = 0x1b
+
+BUTTON_LEFT = 0
+BUTTON_RIGHT = 1
+BUTTON_MIDDLE = 2
+
+# Mouse button event flags for (press, release).
+BUTTON_FLAGS = {
+    BUTTON_LEFT:    (MOUSEEVENTF_LEFTDOWN,   MOUSEEVENTF_LEFTUP),
+    BUTTON_RIGHT:   (MOUSEEVENTF_RIGHTDOWN,  MOUSEEVENTF_RIGHTUP),
+    BUTTON_MIDDLE:  (MOUSEEVENTF_MIDDLEDOWN, MOUSEEVENTF_MIDDLEUP),
+}
+
+
+class WinMouseInput(ctypes.Structure):
+    _fields_ = [
+        ('dx',          ctypes.c_int),
+        ('dy',          ctypes.c_int),
+        ('mouseData',   ctypes.c_uint),
+        ('dwFlags',     ctypes.c_uint),
+        ('time',        ctypes.c_uint),
+        ('dwExtraInfo', ctypes.c_void_p) ]
+
+class WinKeybdInput(ctypes.Structure):
+    _fields_ = [
+        ('wVk',         ctypes.c_ushort),
+        ('wScan',       ctypes.c_ushort),
+        ('dwFlags',     ctypes.c_uint),
+        ('time',        ctypes.c_uint),
+        ('dwExtraInfo', ctypes.c_void_p) ]
+
+class WinHardwareInput(ctypes.Structure):
+    _fields_ = [
+        ('uMsg',        ctypes.c_uint),
+        ('wParamL',     ctypes.c_ushort),
+        ('wParamH',     ctypes.c_ushort) ]
+
+class WinInput(ctypes.Structure):
+
+    class __InputUnion(ctypes.Union):
+        _fields_ = [
+            ('mi',      WinMouseInput),
+            ('ki',      WinKeybdInput),
+            ('hi',      WinHardwareInput) ]
+
+    _fields_ = [
+        ('type',        ctypes.c_uint),
+        ('u',           __InputUnion) ]
+
+
+class WinError(Exception):
+    pass
+
+
+def mouseInput(dx, dy, flags):
+    """Return a WinInput structure for a mouse event."""
+
+    inp = WinInput()
+    inp.type = INPUT_MOUSE
+    inp.u.mi.dx = dx
+    inp.u.mi.dy = dy
+    inp.u.mi.mouseData = 0
+    inp.u.mi.dwFlags = flags
+    inp.u.mi.time = 0
+    inp.u.mi.dwExtraInfo = None
+    return inp
+
+
+def keyInput(key, state):
+    """Return a WinInput structure for a key press or release.
+
+    key = '0' .. '9' or 'A' .. 'Z' or VK_xxx constant
+    """
+
+    inp = WinInput()
+    inp.type = INPUT_KEYBOARD
+    if isinstance(key, str):
+        inp.u.ki.wVk = ord(key)
+    elif isinstance(key, bytes):
+        (inp.u.ki.wVk,) = key
+    else:
+        inp.u.ki.wVk = key
+    inp.u.ki.wScan = 0
+    inp.u.ki.dwFlags = 0 if state else KEYEVENTF_KEYUP
+    inp.u.ki.time = 0
+    inp.u.ki.dwExtraInfo = None
+    return inp
+
+
+class InputMacro:
+    """Timeline of input events, built once and replayed many times.
+
+    Events added without a wait in between are scheduled at the same
+    moment and submitted in one SendInput call. The eventDelay is used
+    as hold time between press and release in mouseClick() and keyType().
+    """
+
+    def __init__(self, eventDelay=0.01):
+        self.eventDelay = eventDelay
+        self.events = [ ]       # list of (offset, WinInput)
+        self.tend = 0.0
+        self.runs = None
+
+    def addInput(self, inp):
+        """Add an event at the current end of the timeline."""
+
+        self.events.append((self.tend, inp))
+        self.runs = None
+
+    def wait(self, seconds):
+        """Advance the end of the timeline."""
+
+        self.tend += seconds
+
+    def moveMouse(self, xpos, ypos):
+        """Move the mouse cursor to the specified absolute mouse coordinates.
+
+        Coordinate range is 0 .. 65535, where (0,0) is the upper left corner
+        and (65535,65535) is the lower right corner of the screen.
+        """
+
+        self.addInput(mouseInput(xpos, ypos,
+                                 MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE))
+
+    def mouseButton(self, button, state):
+        """Press (state=1) or release (state=0) a mouse button."""
+
+        flags = BUTTON_FLAGS[button][0 if state else 1]
+        self.addInput(mouseInput(0, 0, flags))
+
+    def mouseClick(self, xpos, ypos, button):
+        """Move the mouse, then click the specified button."""
+
+        self.moveMouse(xpos, ypos)
+        self.mouseButton(button, 1)
+        self.wait(self.eventDelay)
+        self.mouseButton(button, 0)
+
+    def keyEvent(self, key, state):
+        """Press (state=1) or release (state=0) the specified key."""
+
+        self.addInput(keyInput(key, state))
+
+    def keyType(self, key):
+        """Type the specified key."""
+
+        self.keyEvent(key, 1)
+        self.wait(self.eventDelay)
+        self.keyEvent(key, 0)
+
+    def compile(self):
+        """Group the events into runs of simultaneous events.
+
+        Return a list of (offset, inputs, count) where inputs is
+        a ctypes array of WinInput structures.
+        """
+
+        if self.runs is None:
+            runs = [ ]
+            group = [ ]
+            for (offset, inp) in self.events:
+                if group and offset != group[0][0]:
+                    runs.append(self.makeRun(group))
+                    group = [ ]
+                group.append((offset, inp))
+            if group:
+                runs.append(self.makeRun(group))
+            self.runs = runs
+        return self.runs
+
+    @staticmethod
+    def makeRun(group):
+        count = len(group)
+        inputs = (WinInput * count)(*[ inp for (offset, inp) in group ])
+        return (group[0][0], inputs, count)
+
+
+class MacroRunner:
+    """Play input macros through a backend.
+
+    Waits are scheduled against deadlines. The trailing wait of a macro
+    is not slept; instead, the next macro does not start before it ends.
+    Steps that are not macros but depend on the trailing wait (such as
+    reading the screen) call waitReady() first.
+
+    If stats (a LatencyStats) is given, the duration of each backend call
+    is recorded as stage 'sendinput' and of each macro as stage 'macro'.
+    """
+
+    def __init__(self, backend, stats=None):
+        self.backend = backend
+        self.stats = stats
+        self.readyAt = 0.0
+
+    def run(self, macro):
+        """Play the macro and return when its last event is sent."""
+
+        runs = macro.compile()
+        tcall = time.monotonic()
+        t0 = max(tcall, self.readyAt)
+        sendInputs = self.backend.sendInputs
+        stats = self.stats
+
+        for (offset, inputs, count) in runs:
+            wait = t0 + offset - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if stats is None:
+                sendInputs(inputs, count)
+            else:
+                t = time.monotonic()
+                sendInputs(inputs, count)
+                stats.record('sendinput', time.monotonic() - t)
+
+        self.readyAt = t0 + macro.tend
+        if stats is not None:
+            stats.record('macro', time.monotonic() - tcall)
+
+    def waitReady(self):
+        """Sleep until the trailing wait of the last macro has ended."""
+
+        wait = self.readyAt - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SendInputBackend:
+    """Deliver input events with the Win32 SendInput call."""
+
+    def __init__(self):
+        self.sendInput = ctypes.windll.user32.SendInput
+
+    def sendInputs(self, inputs, count):
+        ret = self.sendInput(count, inputs, ctypes.sizeof(WinInput))
+        if ret != count:
+            raise WinError("Can not send input events (%s)" %
+                           ctypes.FormatError().rstrip())
+
+
+class RecordingBackend:
+    """Record input events instead of delivering them.
+
+    Each event is recorded as a tuple (time, type, ...):
+      (time, 'mouse', dx, dy, flags)
+      (time, 'key', vk, flags)
+
+    With log=True, each event is also printed.
+    """
+
+    def __init__(self, log=False):
+        self.events = [ ]
+        self.ncalls = 0
+        self.log = log
+
+    def sendInputs(self, inputs, count):
+        t = time.monotonic()
+        self.ncalls += 1
+        for i in range(count):
+            inp = inputs[i]
+            if inp.type == INPUT_MOUSE:
+                self.events.append((t, 'mouse', inp.u.mi.dx, inp.u.mi.dy,
+                                    inp.u.mi.dwFlags))
+            else:
+                self.events.append((t, 'key', inp.u.ki.wVk,
+                                    inp.u.ki.dwFlags))
+            if self.log:
+                print("dry run:", *self.events[-1][1:])
+
+
+class InputStuff:
+    """Send game input through a backend.
+
+    Single events are played as one-off macros; prebuilt macros from
+    newMacro() are cheaper to replay.
+    """
+
+    BUTTON_LEFT = BUTTON_LEFT
+    BUTTON_RIGHT = BUTTON_RIGHT
+    BUTTON_MIDDLE = BUTTON_MIDDLE
+
+    def __init__(self, eventDelay=0.01, backend=None, stats=None):
+        self.eventDelay = eventDelay
+        self.backend = backend if backend is not None else RecordingBackend()
+        self.runner = MacroRunner(self.backend, stats)
+
+    def close(self):
+        pass
+
+    def moveMouse(self, xpos, ypos):
+        """Move the mouse cursor to the specified absolute mouse coordinates.
+        
+        Coordinate range is 0 .. 65535, where (0,0) is the upper left corner
+        and (65535,65535) is the lower right corner of the screen.
+        """
+
+        macro = InputMacro(self.eventDelay)
+        macro.moveMouse(xpos, ypos)
+        self.runMacro(macro)
+
+    def mouseButton(self, button, state):
+        """Press or release a mouse button.
+
+        button = 0 for left button, 1 for right button, 2 for middle button.
+        state = 1 for press, 0 for release.
+        """
+
+        macro = InputMacro(self.eventDelay)
+        macro.mouseButton(button, state)
+        self.runMacro(macro)
+
+    def mouseClick(self, xpos, ypos, button):
+        """Optionally move the mouse, then click the specified button."""
+
+        macro = InputMacro(self.eventDelay)
+        macro.mouseClick(xpos, ypos, button)
+        self.runMacro(macro)
+
+    def keyEvent(self, key, state):
+        """Press or release the specified key."""
+
+        macro = InputMacro(self.eventDelay)
+        macro.keyEvent(key, state)
+        self.runMacro(macro)
+
+    def keyType(self, key):
+        """Type the specified key.
+
+        key = '0' .. '9' or 'A' .. 'Z' or VK_xxx constant
+        """
+
+        macro = InputMacro(self.eventDelay)
+        macro.keyType(key)
+        self.runMacro(macro)
+
+    def newMacro(self):
+        """Return an empty InputMacro using this event delay."""
+
+        return InputMacro(self.eventDelay)
+
+    def runMacro(self, macro):
+        """Play an InputMacro; return when its last event is sent."""
+
+        self.runner.run(macro)
+
+
+class DryRunStuff(InputStuff):
+    """Portable stand-in for winstuff.WinStuff.
+
+    Input events are recorded instead of sent, and the screen is
+    a blank one of the specified size.
+    """
+
+    def __init__(self, eventDelay=0.01, backend=None, stats=None,
+                 screenSize=(1920, 1080), log=True):
+        if backend is None:
+            backend = RecordingBackend(log)
+        InputStuff.__init__(self, eventDelay, backend, stats)
+        self.screenSize = screenSize
+
+    def getScreenSize(self):
+        """Return screen size as a tuple (xpixels, ypixels)."""
+
+        return self.screenSize
+
+    def getPixel(self, xpos, ypos):
+        """Return color of specified pixel as
+        (R,G,B) tuple in range 0 .. 255."""
+
+        return (0, 0, 0)
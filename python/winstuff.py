@@ -0,0 +1,153 @@
+"""
+Win32 display and input access for controlling the game.
+
+This module needs Windows and pywin32. It is only imported when the game
+is actually controlled; see wininput.DryRunStuff for a portable stand-in.
+"""
+
+import ctypes
+import win32con
+
+from wininput import WinError, InputStuff, SendInputBackend
+
+VERBOSE = 1
+
+
+class WinStuff(InputStuff):
+    """Dirty Win32 tricks to control the game."""
+
+    __wGetLastError     = ctypes.windll.kernel32.GetLastError
+    __wFormatMessage    = ctypes.windll.kernel32.FormatMessageW
+    __wGetDC            = ctypes.windll.user32.GetDC
+    __wReleaseDC        = ctypes.windll.user32.ReleaseDC
+    __wGetSystemMetrics = ctypes.windll.user32.GetSystemMetrics
+    __wGetPixel         = ctypes.windll.gdi32.GetPixel
+
+    def __init__(self, eventDelay=0.01, backend=None, stats=None):
+        """Create required system handles."""
+
+        if backend is None:
+            backend = SendInputBackend()
+        InputStuff.__init__(self, eventDelay, backend, stats)
+
+        if VERBOSE: print("creating device context")
+        self.hdc = self.__wGetDC(None)
+        if not self.hdc:
+            raise WinError("Can not get Device Context for display (%s)" %
+                           self.getLastErrorStr())
+
+#        setdpiaware = getattr(ctypes.windll.shcore, 'SetProcessDpiAwareness',
+#                              None)
+#        if setdpiaware is not None:
+#            setdpiaware(1)
+
+    def __del__(self):
+
+        if self.hdc:
+            self.__wReleaseDC(None, self.hdc)
+            self.hdc = 0
+
+    def close(self):
+        """Release system handles."""
+
+        assert self.hdc
+        self.__wReleaseDC(None, self.hdc)
+        self.hdc = 0
+
+    def getScreenSize(self):
+        """Return screen size as a tuple (xpixels, ypixels)."""
+
+        xsize = self.__wGetSystemMetrics(win32con.SM_CXSCREEN)
+        ysize = self.__wGetSystemMetrics(win32con.SM_CYSCREEN)
+        return (xsize, ysize)
+
+    def getPixel(self, xpos, ypos):
+        """Return color of specified pixel as
+        (R,G,B) tuple in range 0 .. 255."""
+
+        assert self.hdc
+        rgb = self.__wGetPixel(self.hdc, xpos, ypos)
+        return (rgb & 0xff, (rgb >> 8) & 0xff, (rgb >> 16) & 0xff)
+
+    def getLastErrorStr(self):
+        """Return error message for last error."""
+
+        buffer = ctypes.create_unicode_buffer(128)
+
+        dwMessageId = self.__wGetLastError()
+
+        dwFlags = win32con.FORMAT_MESSAGE_FROM_SYSTEM
+        lpSource = None
+        dwLanguageId = 0
+        lpBuffer = ctypes.byref(buffer)
+        nSize = 128
+        Arguments = None
+
+        self.__wFormatMessage(dwFlags, lpSource, dwMessageId, dwLanguageId,
+                              lpBuffer, nSize, Arguments)
+
+        return buffer.value.rstrip()
+
+
+class DisplayDevice(ctypes.Structure):
+    _fields_ = [
+        ('cb',           ctypes.c_uint),
+        ('DeviceName',   ctypes.c_wchar * 32),
+        ('DeviceString', ctypes.c_wchar * 128),
+        ('StateFlags',   ctypes.c_uint),
+        ('DeviceID',     ctypes.c_wchar * 128),
+        ('DeviceKey',    ctypes.c_wchar * 128) ]
+
+
+def enumDisplayDevices():
+    """Return the full list of display devices in the system as
+    a list of DisplayDevice objects."""
+
+    devs = [ ]
+        
+    i = 0
+    while True:
+
+        displayDevice = DisplayDevice()
+        displayDevice.cb = ctypes.sizeof(displayDevice)
+        lpDevice = None
+        iDevNum = i
+        lpDisplayDevice = ctypes.byref(displayDevice)
+        dwFlags = 0
+
+        ret = ctypes.windll.user32.EnumDisplayDevicesW(lpDevice,
+                                                       iDevNum,
+                                                       lpDisplayDevice,
+                                                       dwFlags)
+
+        if not ret:
+            break
+
+        devs.append(displayDevice)
+        i += 1
+
+    return devs
+
+
+def isDesktopPrimaryDisplay(displayDevice):
+    """Return True if the specified DisplayDevices is aDISPLAY_DEVICE_ATTACHED_TO_DESKTOPttached
+    to the primary desktop."""
+
+    return (displayDevice.StateFlags & win32con.DISPLAY_DEVICE_PRIMARY_DEVICE) != 0
+
+
+def createDeviceContext(deviceName):
+    """Create device context for the specified display device
+    and return the device handle, or return None in case of failure."""
+
+    lpszDriver = "DISPLAY"
+    lpszDevice = str(deviceName)
+    lpszOutput = None
+    lpInitData = None
+    
+    ret = ctypes.windll.gdi32.CreateDeviceW(lpszDriver,
+                                            lpszDevice,
+                                            lpszOutput,
+                                            lpInitData)
+
+    return ret